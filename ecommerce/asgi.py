@@ -0,0 +1,14 @@
+"""
+ASGI config for ecommerce project.
+
+It exposes the ASGI callable as a module-level variable named ``application``
+for servers such as uvicorn or daphne (``uvicorn ecommerce.asgi:application``).
+"""
+
+import os
+
+from main.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ecommerce.settings')
+
+application = get_asgi_application()
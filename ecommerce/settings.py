@@ -11,6 +11,9 @@ https://docs.djangoproject.com/en/2.2/ref/settings/
 """
 
 import os
+from importlib.util import find_spec
+
+from django.core.exceptions import ImproperlyConfigured
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -47,6 +50,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'main.metrics.PerformanceMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -60,7 +64,7 @@ ROOT_URLCONF = 'ecommerce.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'BACKEND': 'main.metrics.InstrumentedDjangoTemplates',
         'DIRS': [os.path.join(BASE_DIR, 'main', 'templates')],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -69,6 +73,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'main.context_processors.cart',
             ],
         },
     },
@@ -76,6 +81,9 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'ecommerce.wsgi.application'
 
+# Worker threads running views behind ecommerce.asgi on Django < 3.0
+ASGI_THREADS = int(os.environ.get('DJANGO_ASGI_THREADS', 10))
+
 
 # Database
 # https://docs.djangoproject.com/en/2.2/ref/settings/#databases
@@ -88,6 +96,75 @@ DATABASES = {
 }
 
 
+# Caches
+# DJANGO_CACHE_BACKEND is 'locmem', 'file' or 'redis'; unset, Redis is used
+# when DJANGO_REDIS_URL is given and django-redis is installed.
+# Bumping DJANGO_CACHE_VERSION orphans every key written before.
+
+CACHE_BACKEND = os.environ.get('DJANGO_CACHE_BACKEND') or (
+    'redis' if os.environ.get('DJANGO_REDIS_URL') and find_spec('django_redis')
+    else 'locmem')
+CACHE_DIR = os.environ.get(
+    'DJANGO_CACHE_DIR', os.path.join(BASE_DIR, '.cache'))
+CACHE_VERSION = int(os.environ.get('DJANGO_CACHE_VERSION', 1))
+
+
+def cache_config(alias):
+    config = {'KEY_PREFIX': alias, 'VERSION': CACHE_VERSION}
+    if CACHE_BACKEND == 'redis':
+        if not find_spec('django_redis'):
+            raise ImproperlyConfigured('The redis cache needs django-redis.')
+        config.update({
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': os.environ.get(
+                'DJANGO_REDIS_URL', 'redis://127.0.0.1:6379/1'),
+        })
+    elif CACHE_BACKEND == 'file':
+        config.update({
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.path.join(CACHE_DIR, alias),
+        })
+    elif CACHE_BACKEND == 'locmem':
+        config.update({
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': alias,
+        })
+    else:
+        raise ImproperlyConfigured(
+            f'Unknown DJANGO_CACHE_BACKEND {CACHE_BACKEND!r}.')
+    return config
+
+
+CACHES = {
+    alias: cache_config(alias)
+    for alias in ('default', 'catalog', 'carts', 'sessions')
+}
+
+
+# Sessions and messages
+# DJANGO_SESSION_ENGINE is one of SESSION_ENGINES below. 'cached_db'
+# serves reads from the sessions cache but still writes every change to
+# the database; 'cache' and 'signed_cookies' write nothing there. Pure
+# cache sessions are the default when the cache is shared (Redis); local
+# memory would lose them between worker processes, so without Redis the
+# session rides in a signed cookie. It holds little more than the login
+# and the anonymous cart, which stays well under the cookie size limit.
+
+SESSION_ENGINES = {
+    'db': 'django.contrib.sessions.backends.db',
+    'cached_db': 'django.contrib.sessions.backends.cached_db',
+    'cache': 'django.contrib.sessions.backends.cache',
+    'signed_cookies': 'django.contrib.sessions.backends.signed_cookies',
+}
+SESSION_ENGINE = SESSION_ENGINES[os.environ.get(
+    'DJANGO_SESSION_ENGINE',
+    'cache' if CACHE_BACKEND == 'redis' else 'signed_cookies')]
+SESSION_CACHE_ALIAS = 'sessions'
+
+# Flash messages ride along in a cookie instead of the session
+MESSAGE_STORAGE = 'django.contrib.messages.storage.cookie.CookieStorage'
+
+
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
 
@@ -125,9 +202,29 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/2.2/howto/static-files/
 
 STATIC_URL = '/static/'
+STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
+
+# Production asset mode: hashed, precompressed static files from
+# collectstatic served with far-future cache headers
+PRODUCTION_ASSETS = os.environ.get('DJANGO_PRODUCTION_ASSETS') == '1'
+if PRODUCTION_ASSETS:
+    STATICFILES_STORAGE = 'main.storage.CompressedManifestStaticFilesStorage'
+
+# Hand file bodies to the front-end server, e.g. 'X-Sendfile' for Apache
+# or 'X-Accel-Redirect' for nginx with SENDFILE_ROOTS mapping directories
+# to internal locations such as {MEDIA_ROOT: '/protected-media/'}
+SENDFILE_HEADER = os.environ.get('DJANGO_SENDFILE_HEADER') or None
+SENDFILE_ROOTS = {}
 
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
+MEDIA_CACHE_MAX_AGE = 60 * 60 * 24
+
+# Widths of the resized copies of item images served through srcset;
+# images narrower than a width get a copy at their own width instead
+IMAGE_VARIANT_WIDTHS = (320, 640, 1024)
+IMAGE_VARIANT_QUALITY = 80
+IMAGE_VARIANT_CACHE_TIMEOUT = 60 * 60 * 24
 
 
 # Auth
@@ -150,3 +247,51 @@ CRISPY_TEMPLATE_PACK = 'bootstrap4'
 # STRIPE
 
 STRIPE_SECRET_KEY = 'sk_test_4eC39HqLyjWDarjtT1zdp7dc'
+
+
+# PAYMENTS
+
+# 'main.payments.StripeGateway' charges through Stripe; the fake gateway
+# approves every card token but 'tok_chargeDeclined'
+PAYMENT_GATEWAY = os.environ.get(
+    'DJANGO_PAYMENT_GATEWAY', 'main.payments.FakeGateway')
+
+# Threads charging new payments inside the web process; with 0 they wait
+# for the process_payments command, which also runs the retries
+PAYMENT_WORKER_THREADS = int(os.environ.get('DJANGO_PAYMENT_THREADS', 2))
+
+# Tries per payment, with exponential backoff from PAYMENT_RETRY_DELAY
+# seconds, and how long a worker may hold a payment before another one
+# takes it over
+PAYMENT_MAX_TRIES = 5
+PAYMENT_RETRY_DELAY = 2
+PAYMENT_MAX_RETRY_DELAY = 60 * 5
+PAYMENT_LEASE = 60
+
+
+# CART
+
+CART_SUMMARY_TIMEOUT = 60 * 15
+
+
+# CATALOG
+
+CATALOG_CACHE_TIMEOUT = 60 * 60
+
+# 'offset' for numbered pages, 'cursor' for keyset pagination (?after=...)
+HOME_PAGINATION = 'offset'
+
+# SEARCH
+# Dotted path to a main.search backend; picked from the database vendor
+# (FTS5 on SQLite, tsvector on PostgreSQL) when unset
+SEARCH_BACKEND = None
+
+
+# PERFORMANCE
+
+# Requests slower than this many seconds are logged with their queries
+SLOW_REQUEST_THRESHOLD = 0.5
+
+# Bearer token letting a Prometheus scraper read /stats/metrics/ without
+# a staff login
+METRICS_TOKEN = os.environ.get('DJANGO_METRICS_TOKEN') or None
@@ -1,5 +1,9 @@
 from django.contrib import admin
-from .models import Item, OrderItem, Order, Payment, Coupon, Address
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Q
+from .models import (Item, OrderItem, Order, Payment, PaymentAttempt, Coupon,
+                     Address)
+from .pagination import EstimatedCountPaginator
 
 
 def make_refund_accepted(modeladmin, request, queryset):
@@ -9,7 +13,45 @@ def make_refund_accepted(modeladmin, request, queryset):
 make_refund_accepted.short_description = 'Update oreders to refund granted'
 
 
-class OrderAdmin(admin.ModelAdmin):
+class LargeTableAdmin(admin.ModelAdmin):
+    '''Changelist of a table too large to count or scan on every page.
+
+    ``search_fields`` may only name indexed columns: ``^field`` matches
+    the start of the value with a range on its index, ``=field`` matches
+    it exactly, and fields on a related model are looked up there first.
+    '''
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+        query = Q()
+        for field in self.search_fields:
+            kind, path = field[0], field[1:]
+            if kind == '^':
+                lookups = {'gte': term, 'lt': term + '\uffff'}
+            elif kind == '=':
+                lookups = {'exact': term}
+            else:
+                raise ImproperlyConfigured(
+                    f'Search field {field!r} is neither ^prefix nor =exact.')
+            relation, _, column = path.rpartition('__')
+            if relation:
+                # Search the related table on its own index so that the
+                # OR of the fields is not evaluated over a join
+                model = queryset.model._meta.get_field(relation).related_model
+                query |= Q(**{f'{relation}__in': model._default_manager.filter(
+                    **{f'{column}__{lookup}': value
+                       for lookup, value in lookups.items()})})
+            else:
+                query |= Q(**{f'{column}__{lookup}': value
+                              for lookup, value in lookups.items()})
+        return queryset.filter(query), False
+
+
+class OrderAdmin(LargeTableAdmin):
     list_display = ['user', 'ordered', 'being_delivered',
                     'received', 'refund_requested',
                     'refund_granted', 'billing_address',
@@ -22,12 +64,17 @@ class OrderAdmin(admin.ModelAdmin):
                    'received', 'refund_requested',
                    'refund_granted']
 
-    search_fields = ['user__username', 'ref_code']
+    # Addresses and payments show their user's name
+    list_select_related = ['user', 'billing_address__user',
+                           'shipping_address__user', 'payment__user',
+                           'coupon']
+
+    search_fields = ['^ref_code', '=user__username']
 
     actions = [make_refund_accepted]
 
 
-class AddressAdmin(admin.ModelAdmin):
+class AddressAdmin(LargeTableAdmin):
     list_display = ['user', 'street_address',
                     'apartment_address', 'country',
                     'zip_address', 'address_type',
@@ -35,13 +82,46 @@ class AddressAdmin(admin.ModelAdmin):
 
     list_filter = ['default', 'address_type', 'country']
 
-    search_fields = ['user__username', 'street_address',
-                     'apartment_address', 'zip_address']
+    list_select_related = ['user']
+
+    search_fields = ['=user__username', '^zip_address']
+
+
+class OrderItemAdmin(LargeTableAdmin):
+    list_display = ['__str__', 'user', 'ordered', 'unit_price',
+                    'line_total']
+
+    list_filter = ['ordered']
+
+    list_select_related = ['user', 'item']
+
+    search_fields = ['=user__username', '^item__slug']
+
+
+class PaymentAdmin(LargeTableAdmin):
+    list_display = ['stripe_charge_id', 'user', 'amount', 'timestamp']
+
+    list_select_related = ['user']
+
+    search_fields = ['=stripe_charge_id', '=user__username']
+
+
+class PaymentAttemptAdmin(LargeTableAdmin):
+    list_display = ['idempotency_key', 'user', 'order', 'amount', 'status',
+                    'tries', 'next_attempt_at', 'charge_id']
+
+    list_filter = ['status']
+
+    # Orders show their user's name
+    list_select_related = ['user', 'order__user']
+
+    search_fields = ['=idempotency_key', '=charge_id', '=user__username']
 
 
 admin.site.register(Item)
-admin.site.register(OrderItem)
+admin.site.register(OrderItem, OrderItemAdmin)
 admin.site.register(Order, OrderAdmin)
-admin.site.register(Payment)
+admin.site.register(Payment, PaymentAdmin)
+admin.site.register(PaymentAttempt, PaymentAttemptAdmin)
 admin.site.register(Coupon)
 admin.site.register(Address, AddressAdmin)
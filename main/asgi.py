@@ -0,0 +1,136 @@
+import asyncio
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+
+from django.conf import settings
+from django.core.wsgi import get_wsgi_application
+
+# Request bodies larger than this are spooled to disk
+BODY_SPOOL_SIZE = 1024 * 1024
+
+
+def get_asgi_application(threads=None):
+    '''Django's own ASGI handler where it exists, else the adapter below'''
+    try:
+        from django.core import asgi
+    except ImportError:  # Django < 3.0
+        return WsgiToAsgi(
+            get_wsgi_application(), threads or settings.ASGI_THREADS)
+    return asgi.get_asgi_application()
+
+
+class WsgiToAsgi:
+    '''Serve a WSGI application over ASGI.
+
+    The event loop reads every request body and writes every response, so
+    slow clients only cost a coroutine; the application itself runs in a
+    pool of ``threads`` workers and holds one only while it computes.
+    '''
+
+    def __init__(self, wsgi_application, threads):
+        self.wsgi_application = wsgi_application
+        self.executor = ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix='asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError(f'Unsupported ASGI scope {scope["type"]!r}.')
+
+        body = SpooledTemporaryFile(max_size=BODY_SPOOL_SIZE)
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                body.close()
+                return
+            body.write(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        body.seek(0)
+
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(
+                self.executor, self.run_application,
+                loop, send, self.environ(scope, body))
+        finally:
+            body.close()
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    def environ(scope, body):
+        server_name, server_port = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', ''),
+            # WSGI carries the raw path bytes as a latin-1 string
+            'PATH_INFO': scope['path'].encode().decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server_name,
+            'SERVER_PORT': str(server_port),
+            'SERVER_PROTOCOL': f'HTTP/{scope.get("http_version", "1.1")}',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        if scope.get('client'):
+            environ['REMOTE_ADDR'] = scope['client'][0]
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                name = f'HTTP_{name}'
+            value = value.decode('latin-1')
+            if name in environ:
+                value = f'{environ[name]},{value}'
+            environ[name] = value
+        return environ
+
+    def run_application(self, loop, send, environ):
+        '''Call the application on a worker thread, streaming its output'''
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [
+                (name.lower().encode('latin-1'), value.encode('latin-1'))
+                for name, value in headers]
+
+        def send_message(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        def send_start():
+            if not response.get('started'):
+                response['started'] = True
+                send_message({'type': 'http.response.start',
+                              'status': response['status'],
+                              'headers': response['headers']})
+
+        result = self.wsgi_application(environ, start_response)
+        try:
+            for chunk in result:
+                if chunk:
+                    send_start()
+                    send_message({'type': 'http.response.body',
+                                  'body': chunk, 'more_body': True})
+        finally:
+            # Fires request_finished on this thread, which closes its
+            # database connection
+            if hasattr(result, 'close'):
+                result.close()
+        send_start()
+        send_message({'type': 'http.response.body', 'body': b''})
@@ -0,0 +1,112 @@
+import math
+import random
+import threading
+import time
+from collections import Counter
+
+from django.core.cache import caches
+from django.core.cache.backends.base import InvalidCacheBackendError
+
+from .metrics import record_cache
+
+
+MISSING = object()
+
+_stats_lock = threading.Lock()
+_hits, _misses = Counter(), Counter()
+
+
+def record(alias, hits=0, misses=0):
+    with _stats_lock:
+        _hits[alias] += hits
+        _misses[alias] += misses
+    record_cache(hits, misses)
+
+
+def cache_stats():
+    '''``{alias: {'hits': n, 'misses': n}}`` counted by this process'''
+    with _stats_lock:
+        return {alias: {'hits': _hits[alias], 'misses': _misses[alias]}
+                for alias in sorted(set(_hits) | set(_misses))}
+
+
+def reset_cache_stats():
+    with _stats_lock:
+        _hits.clear()
+        _misses.clear()
+
+
+class InstrumentedCache:
+    '''Cache proxy that counts hits and misses of its alias'''
+
+    def __init__(self, alias, backend):
+        self.alias = alias
+        self.backend = backend
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def get(self, key, default=None, version=None):
+        value = self.backend.get(key, MISSING, version)
+        if value is MISSING:
+            record(self.alias, misses=1)
+            return default
+        record(self.alias, hits=1)
+        return value
+
+    def get_many(self, keys, version=None):
+        keys = list(keys)
+        values = self.backend.get_many(keys, version)
+        record(self.alias, hits=len(values), misses=len(keys) - len(values))
+        return values
+
+
+def get_cache(alias):
+    '''The named cache, or the default one when the alias is not set up'''
+    try:
+        backend = caches[alias]
+    except InvalidCacheBackendError:
+        backend = caches['default']
+    return InstrumentedCache(alias, backend)
+
+
+def get_or_compute(alias, key, compute, timeout, beta=1.0, lock_timeout=10):
+    '''Cached result of ``compute()``, protected against stampedes.
+
+    Entries remember how long they took to compute, and readers refresh
+    them a little early with a probability rising towards expiry, so a
+    hot entry is rebuilt by one request instead of all of them at once.
+    On a cold miss a short lock lets a single process compute while the
+    others wait for its result.
+    '''
+    cache = get_cache(alias)
+    entry = cache.get(key)
+    if entry is not None:
+        value, duration, expires = entry
+        # 1 - random() is in (0, 1], so the logarithm is defined
+        early = duration * beta * -math.log(1 - random.random())
+        if time.time() + early < expires:
+            return value
+        return store(cache, key, compute, timeout)
+    lock_key = f'{key}:lock'
+    if cache.add(lock_key, True, lock_timeout):
+        try:
+            return store(cache, key, compute, timeout)
+        finally:
+            cache.delete(lock_key)
+    deadline = time.monotonic() + lock_timeout
+    while time.monotonic() < deadline:
+        time.sleep(0.05)
+        entry = cache.backend.get(key)
+        if entry is not None:
+            return entry[0]
+    return store(cache, key, compute, timeout)
+
+
+def store(cache, key, compute, timeout):
+    started = time.time()
+    value = compute()
+    finished = time.time()
+    expires = finished + timeout if timeout is not None else math.inf
+    cache.set(key, (value, finished - started, expires), timeout)
+    return value
@@ -0,0 +1,415 @@
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, Exists, F, OuterRef, Q
+from django.utils import timezone
+
+from . import catalog
+from .caching import get_cache
+from .models import Item, Order, OrderItem, PaymentAttempt, PaymentInProgress
+
+
+CART_SUMMARY_TIMEOUT = getattr(settings, 'CART_SUMMARY_TIMEOUT', 60 * 15)
+
+EMPTY_CART_SUMMARY = {'count': 0, 'subtotal': 0, 'total': 0, 'version': 0}
+
+CartUpdate = namedtuple('CartUpdate', ['order', 'created', 'summary'])
+
+
+def cart_summary_key(user_id):
+    return f'cart-summary:{user_id}'
+
+
+def make_cart_summary(line_count, subtotal, total):
+    return {
+        'count': line_count,
+        'subtotal': subtotal,
+        'total': total,
+        'version': int(time.time() * 1000),
+    }
+
+
+def compute_cart_summary(user):
+    '''Read the stored totals of the user's open order'''
+    totals = Order.objects.filter(user=user, ordered=False).values_list(
+        'line_count', 'subtotal', 'total').first() or (0, 0, 0)
+    return make_cart_summary(*totals)
+
+
+def get_cart_summary(user):
+    if not user.is_authenticated:
+        return EMPTY_CART_SUMMARY
+    cache, key = get_cache('carts'), cart_summary_key(user.pk)
+    summary = cache.get(key)
+    if summary is None:
+        summary = compute_cart_summary(user)
+        cache.set(key, summary, CART_SUMMARY_TIMEOUT)
+    return summary
+
+
+def invalidate_cart_summary(user):
+    get_cache('carts').delete(cart_summary_key(user.pk))
+
+
+def invalidate_cart_summaries(user_ids):
+    '''Drop the summaries now and again once the transaction commits, in
+    case a request cached the old totals in between'''
+    cache = get_cache('carts')
+    keys = [cart_summary_key(user_id) for user_id in user_ids]
+    cache.delete_many(keys)
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def get_open_order(user, create=False):
+    '''Fetch and lock the user's open order for the current transaction.
+
+    Raises Order.DoesNotExist when there is none and ``create`` is false,
+    and PaymentInProgress when the order has a pending or successful
+    payment attempt: its cart is frozen until the attempt fails.
+    '''
+    orders = Order.objects.select_for_update().annotate(paying=Exists(
+        PaymentAttempt.objects.filter(
+            order=OuterRef('pk'), status__in=PaymentAttempt.LIVE_STATUSES)))
+    if not connection.features.has_select_for_update:
+        # SQLite has no row locks; a no-op write takes the database write
+        # lock first so concurrent cart updates queue up instead of failing
+        orders.filter(user=user, ordered=False).update(
+            line_count=F('line_count'))
+    if create:
+        order, created = orders.get_or_create(
+            user=user, ordered=False,
+            defaults={'ordered_date': timezone.now()})
+    else:
+        order, created = orders.get(user=user, ordered=False), False
+    if not created and order.paying:
+        raise PaymentInProgress
+    return order
+
+
+def apply_change(order, amount, lines=0):
+    '''Shift the locked order's totals and publish the new cart summary'''
+    if amount or lines:
+        order.adjust_totals(amount, lines)
+        # The row is locked, so the in-memory totals can be moved in step
+        order.subtotal += amount
+        order.total += amount
+        order.line_count += lines
+    return publish_cart_summary(order)
+
+
+def publish_cart_summary(order):
+    '''Cache the order's summary once the surrounding transaction commits'''
+    summary = make_cart_summary(
+        order.line_count, order.subtotal, order.total)
+    cache, key = get_cache('carts'), cart_summary_key(order.user_id)
+    cache.delete(key)
+    transaction.on_commit(
+        lambda: cache.set(key, summary, CART_SUMMARY_TIMEOUT))
+    return summary
+
+
+def add_line(order, item, quantity):
+    '''Increment the line of a locked order, returning whether it is new'''
+    created = not OrderItem.objects.filter(order=order, item=item).update(
+        quantity=F('quantity') + quantity)
+    if created:
+        order_item, _ = OrderItem.objects.update_or_create(
+            user_id=order.user_id, item=item, ordered=False,
+            defaults={'quantity': quantity})
+        Order.items.through.objects.create(
+            order=order, orderitem=order_item)
+    return created
+
+
+def remove_line(order, item, quantity=None, keep_line=False):
+    '''Decrement the line of a locked order.
+
+    Returns the quantity taken out and whether the line was deleted.
+    Raises OrderItem.DoesNotExist when the item is not in the order.
+    '''
+    order_items = OrderItem.objects.filter(order=order, item=item)
+    if quantity is not None and order_items.filter(
+            quantity__gt=quantity).update(quantity=F('quantity') - quantity):
+        return quantity, False
+    order_item = order_items.get()
+    if keep_line:
+        return 0, False
+    order_item.delete()
+    return order_item.quantity, True
+
+
+@transaction.atomic
+def add_item(user, item, quantity=1):
+    '''Add ``quantity`` of ``item`` to the user's open cart.
+
+    The open order is locked and the line is incremented with an UPDATE
+    before falling back to an INSERT, so concurrent adds can neither lose
+    increments nor create a second cart.
+    '''
+    order = get_open_order(user, create=True)
+    created = add_line(order, item, quantity)
+    summary = apply_change(order, item.get_price() * quantity,
+                           lines=int(created))
+    return CartUpdate(order, created, summary)
+
+
+@transaction.atomic
+def remove_item(user, item, quantity=None, keep_line=False):
+    '''Take ``quantity`` of ``item`` out of the user's open cart.
+
+    The whole line goes when ``quantity`` is None or covers everything in
+    the cart, unless ``keep_line`` asks to always leave one unit behind.
+    Raises Order.DoesNotExist without an open cart and
+    OrderItem.DoesNotExist when the item is not in it. Like every cart
+    change, it raises PaymentInProgress while the order is being paid.
+    '''
+    order = get_open_order(user)
+    removed, deleted = remove_line(order, item, quantity, keep_line)
+    summary = apply_change(order, -item.get_price() * removed,
+                           lines=-int(deleted))
+    return CartUpdate(order, False, summary)
+
+
+@transaction.atomic
+def update_cart(user, deltas):
+    '''Apply a batch of ``{item: quantity delta}`` changes at once.
+
+    The order is locked, so its lines are read once and written back with
+    a fixed number of bulk statements however large the batch is, and the
+    totals are written a single time. Removing an item that is not in the
+    cart is a no-op, so replayed or coalesced batches stay harmless.
+    Returns None when there is no open cart and nothing to add.
+    '''
+    try:
+        order = get_open_order(
+            user, create=any(delta > 0 for delta in deltas.values()))
+    except Order.DoesNotExist:
+        return None
+    # Open lines are unique per user and item; one missing from the order
+    # is a leftover and starts over, as add_line does
+    open_lines = {
+        line.item_id: line for line in OrderItem.objects.filter(
+            user=user, item__in=list(deltas), ordered=False,
+        ).annotate(in_order=Count('order', filter=Q(order=order)))
+    }
+    changed, new_items, attach, deleted = [], [], [], []
+    amount = lines = 0
+    for item, delta in deltas.items():
+        line = open_lines.get(item.pk)
+        in_cart = line.quantity if line and line.in_order else 0
+        quantity = max(in_cart + delta, 0)
+        if quantity == in_cart:
+            continue
+        amount += item.get_price() * (quantity - in_cart)
+        if not quantity:
+            deleted.append(line.pk)
+            lines -= 1
+            continue
+        if not in_cart:
+            lines += 1
+        if line is None:
+            new_items.append(OrderItem(user=user, item=item,
+                                       quantity=quantity))
+            continue
+        line.quantity = quantity
+        changed.append(line)
+        if not line.in_order:
+            attach.append(line.pk)
+    if deleted:
+        OrderItem.objects.filter(pk__in=deleted).delete()
+    if changed:
+        OrderItem.objects.bulk_update(changed, ['quantity'])
+    if new_items:
+        OrderItem.objects.bulk_create(new_items)
+        attach += OrderItem.objects.filter(
+            user=user, ordered=False,
+            item__in=[line.item for line in new_items],
+        ).values_list('pk', flat=True)
+    if attach:
+        Order.items.through.objects.bulk_create(
+            [Order.items.through(order=order, orderitem_id=pk)
+             for pk in attach])
+    created = bool(new_items or attach)
+    return CartUpdate(order, created, apply_change(order, amount, lines))
+
+
+@transaction.atomic
+def merge_lines(user, lines):
+    '''Merge ``{slug: quantity}`` lines into the user's open cart in bulk.
+
+    Runs a fixed number of queries however many lines are merged.
+    '''
+    items = Item.objects.in_bulk(list(lines), field_name='slug')
+    if not items:
+        return None
+    order = get_open_order(user, create=True)
+    open_lines = OrderItem.objects.filter(
+        user=user, item__in=items.values(), ordered=False)
+    slugs = {item.pk: slug for slug, item in items.items()}
+    existing = {line.item_id: line for line in open_lines.annotate(
+        in_order=Count('order', filter=Q(order=order)))}
+    for line in existing.values():
+        # A leftover line missing from the order starts over, as in
+        # update_cart
+        in_cart = line.quantity if line.in_order else 0
+        line.quantity = in_cart + lines[slugs[line.item_id]]
+    OrderItem.objects.bulk_update(existing.values(), ['quantity'])
+    OrderItem.objects.bulk_create(
+        OrderItem(user=user, item=item, quantity=lines[slug])
+        for slug, item in items.items() if item.pk not in existing)
+    Order.items.through.objects.bulk_create(
+        [Order.items.through(order=order, orderitem_id=pk)
+         for pk in open_lines.values_list('pk', flat=True)],
+        ignore_conflicts=True)
+    order.refresh_totals()
+    return CartUpdate(order, True, publish_cart_summary(order))
+
+
+def cart_lines(order):
+    if isinstance(order, SessionOrder):
+        order_items = order.items
+    else:
+        order_items = OrderItem.objects.filter(
+            order=order).select_related('item').order_by('pk')
+    return [
+        {
+            'slug': order_item.item.slug,
+            'title': order_item.item.title,
+            'quantity': order_item.quantity,
+            'price': order_item.item.get_price(),
+            'total': order_item.get_total_item_price(),
+        }
+        for order_item in order_items
+    ]
+
+
+class SessionCartItems(list):
+    '''List of unsaved order lines that quacks like ``order.items``'''
+
+    def all(self):
+        return self
+
+    def count(self):
+        return len(self)
+
+
+class SessionOrder:
+    '''Unsaved stand-in for an Order, so cart templates can render it'''
+    coupon = None
+    discount = 0
+
+    def __init__(self, order_items):
+        self.items = SessionCartItems(order_items)
+        self.line_count = len(self.items)
+        self.subtotal = self.total = sum(
+            order_item.get_total_item_price() for order_item in self.items)
+
+    def get_total(self):
+        return self.total
+
+
+class SessionCart:
+    '''Anonymous cart kept in the session as a ``{slug: quantity}`` map.
+
+    Nothing is written to the database for it; the lines are merged into
+    the visitor's open order when they log in. The methods mirror
+    add_item/remove_item/update_cart and raise the same exceptions.
+    Unit prices are kept beside the lines for the summary and reloaded
+    once the catalog version moves, so repriced and deleted items show
+    on the next read.
+    '''
+    lines_key = 'cart'
+    prices_key = 'cart_prices'
+    version_key = 'cart_catalog_version'
+
+    def __init__(self, session):
+        self.session = session
+        self.lines = session.get(self.lines_key, {})
+        self.prices = session.get(self.prices_key, {})
+        self.version = session.get(self.version_key)
+
+    def __bool__(self):
+        return bool(self.lines)
+
+    def save(self):
+        self.prices = {slug: price for slug, price in self.prices.items()
+                       if slug in self.lines}
+        self.session[self.lines_key] = self.lines
+        self.session[self.prices_key] = self.prices
+        self.session[self.version_key] = self.version
+
+    def clear(self):
+        for key in (self.lines_key, self.prices_key, self.version_key):
+            self.session.pop(key, None)
+        self.lines, self.prices, self.version = {}, {}, None
+
+    def add(self, item, quantity=1):
+        created = item.slug not in self.lines
+        if not self.lines:
+            self.version = catalog.get_catalog_version()
+        self.lines[item.slug] = self.lines.get(item.slug, 0) + quantity
+        self.prices[item.slug] = item.get_price()
+        self.save()
+        return created
+
+    def remove(self, item, quantity=None, keep_line=False):
+        if not self.lines:
+            raise Order.DoesNotExist
+        if item.slug not in self.lines:
+            raise OrderItem.DoesNotExist
+        in_cart = self.lines[item.slug]
+        if quantity is not None and in_cart > quantity:
+            self.lines[item.slug] -= quantity
+        elif keep_line:
+            return
+        else:
+            del self.lines[item.slug]
+        self.save()
+
+    def update(self, deltas):
+        for item, delta in deltas.items():
+            if delta > 0:
+                self.add(item, delta)
+            elif delta < 0 and item.slug in self.lines:
+                self.remove(item, -delta)
+
+    def set_prices(self, items, version):
+        '''Take the prices of ``items``, dropping lines of deleted ones'''
+        items = {item.slug: item for item in items}
+        lines = {slug: quantity for slug, quantity in self.lines.items()
+                 if slug in items}
+        prices = {slug: item.get_price() for slug, item in items.items()}
+        # Unchanged carts leave the session unmodified, so it is not saved
+        if (lines, prices, version) != (self.lines, self.prices,
+                                        self.version):
+            self.lines, self.prices, self.version = lines, prices, version
+            self.save()
+
+    def summary(self):
+        version = catalog.get_catalog_version()
+        if self.lines and (version != self.version
+                           or self.prices.keys() != self.lines.keys()):
+            self.set_prices(Item.objects.filter(slug__in=list(
+                self.lines)).only('slug', 'price', 'discount_price'),
+                version)
+        # Summed on read, so adds and removes cannot drift
+        subtotal = round(sum(quantity * self.prices[slug]
+                             for slug, quantity in self.lines.items()), 2)
+        return make_cart_summary(len(self.lines), subtotal, subtotal)
+
+    def order(self):
+        version = catalog.get_catalog_version()
+        items = Item.objects.in_bulk(list(self.lines), field_name='slug')
+        # The items are loaded anyway, so the summary needs no query
+        self.set_prices(items.values(), version)
+        return SessionOrder(
+            OrderItem(item=items[slug], quantity=quantity)
+            for slug, quantity in self.lines.items())
+
+
+def get_request_cart_summary(request):
+    if request.user.is_authenticated:
+        return get_cart_summary(request.user)
+    return SessionCart(request.session).summary()
@@ -0,0 +1,198 @@
+import time
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.validators import slug_re
+from django.db import transaction
+from django.db.models import Count, Q
+
+from . import cart
+from .caching import get_cache, get_or_compute
+from .models import CATEGORY_CHOICES, LABEL_CHOICES, Item, Order
+from .search import get_search_backend
+
+
+CATALOG_CACHE_TIMEOUT = getattr(settings, 'CATALOG_CACHE_TIMEOUT', 60 * 60)
+
+CATALOG_VERSION_KEY = 'catalog-version'
+
+
+def get_catalog_version():
+    cache = get_cache('catalog')
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        # Seed from the clock so an evicted counter never reuses old keys
+        cache.add(CATALOG_VERSION_KEY, int(time.time() * 1000), None)
+        version = cache.get(CATALOG_VERSION_KEY)
+    return version
+
+
+def bump_catalog_version():
+    try:
+        get_cache('catalog').incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        get_catalog_version()
+
+
+def catalog_cache_key(name, *parts):
+    '''Cache key that goes stale as soon as any Item changes'''
+    return ':'.join(
+        str(part) for part in (name, get_catalog_version()) + parts)
+
+
+# (value, name, lower bound, upper bound) of the price filter, applied to
+# the effective price; bounds include the lower and exclude the upper end
+PRICE_RANGES = (
+    ('under-25', 'Under $25', None, 25),
+    ('25-50', '$25 to $50', 25, 50),
+    ('50-100', '$50 to $100', 50, 100),
+    ('100-up', '$100 & above', 100, None),
+)
+
+
+def effective_price_q(lookup, value):
+    '''Compare the effective price of an item, as Item.get_price() does'''
+    full_price = Q(discount_price__isnull=True) | Q(discount_price=0)
+    return ((full_price & Q(**{f'price__{lookup}': value}))
+            | (~full_price & Q(**{f'discount_price__{lookup}': value})))
+
+
+def price_range_q(price_range):
+    for value, name, low, high in PRICE_RANGES:
+        if value == price_range:
+            q = Q()
+            if low is not None:
+                q &= effective_price_q('gte', low)
+            if high is not None:
+                q &= effective_price_q('lt', high)
+            return q
+    return Q()
+
+
+def filter_items(queryset, category=None, price_range=None):
+    '''Narrow an Item queryset by category and effective price range'''
+    if category:
+        queryset = queryset.filter(category=category)
+    if price_range:
+        queryset = queryset.filter(price_range_q(price_range))
+    return queryset
+
+
+def compute_catalog_facets(category=None, price_range=None):
+    '''Count items per category and per price range in one query.
+
+    Each facet is counted under the other active filter, so the numbers
+    tell how many items selecting that facet would show.
+    '''
+    category_q = Q(category=category) if category else Q()
+    price_q = price_range_q(price_range)
+    counts = Item.objects.aggregate(
+        all=Count('pk', filter=price_q or None),
+        **{f'category_{n}': Count('pk', filter=Q(category=value) & price_q)
+           for n, (value, name) in enumerate(CATEGORY_CHOICES)},
+        **{f'price_{n}': Count('pk', filter=price_range_q(value) & category_q)
+           for n, (value, *_) in enumerate(PRICE_RANGES)},
+    )
+    return {
+        'all': counts['all'],
+        'categories': [
+            (value, name, counts[f'category_{n}'])
+            for n, (value, name) in enumerate(CATEGORY_CHOICES)],
+        'price_ranges': [
+            (value, name, counts[f'price_{n}'])
+            for n, (value, name, *_) in enumerate(PRICE_RANGES)],
+    }
+
+
+def get_catalog_facets(category=None, price_range=None):
+    return get_or_compute(
+        'catalog',
+        catalog_cache_key('facets', category or '', price_range or ''),
+        lambda: compute_catalog_facets(category, price_range),
+        CATALOG_CACHE_TIMEOUT)
+
+
+ITEM_FIELDS = ['slug', 'title', 'price', 'discount_price', 'category',
+               'label', 'description', 'image']
+
+
+def clean_item_row(row):
+    '''Validate one imported row, returning the values for an Item.
+
+    Raises ValidationError describing every problem with the row.
+    '''
+    errors, values = [], {}
+    for field in ('slug', 'title', 'category', 'label', 'description',
+                  'image'):
+        value = row.get(field)
+        values[field] = '' if value is None else str(value).strip()
+        if not values[field]:
+            errors.append(f'{field} is required')
+    for field, optional in (('price', False), ('discount_price', True)):
+        value = row.get(field)
+        if value in (None, '') and optional:
+            values[field] = None
+            continue
+        try:
+            values[field] = float(value)
+        except (TypeError, ValueError):
+            errors.append(f'{field} must be a number')
+            continue
+        if values[field] < 0:
+            errors.append(f'{field} must not be negative')
+    if values['slug'] and not slug_re.match(values['slug']):
+        errors.append('slug may only contain letters, numbers, - and _')
+    for field, max_length in (('slug', 50), ('title', 100)):
+        if len(values[field]) > max_length:
+            errors.append(f'{field} is longer than {max_length}')
+    if values['category'] and values['category'] not in dict(
+            CATEGORY_CHOICES):
+        errors.append(f'unknown category {values["category"]!r}')
+    if values['label'] and values['label'] not in dict(LABEL_CHOICES):
+        errors.append(f'unknown label {values["label"]!r}')
+    if errors:
+        raise ValidationError(errors)
+    return values
+
+
+@transaction.atomic
+def import_item_batch(rows):
+    '''Create or update items keyed on slug with bulk statements.
+
+    Returns the number of items created and updated; rows identical to
+    the stored item are skipped. Bulk writes skip model signals, so the
+    catalog version is bumped, new and reworded items are reindexed for
+    search and open carts holding repriced items are re-totalled, and
+    their cached summaries dropped, here instead.
+    '''
+    rows = {row['slug']: row for row in rows}
+    existing = Item.objects.in_bulk(list(rows), field_name='slug')
+    changed, changed_fields, reindex = [], set(), []
+    for slug, item in existing.items():
+        fields = {field for field, value in rows[slug].items()
+                  if getattr(item, field) != value}
+        for field in fields:
+            setattr(item, field, rows[slug][field])
+        if fields:
+            changed.append(item)
+            changed_fields |= fields
+        if fields & {'title', 'description'}:
+            reindex.append(slug)
+    # Re-imports are mostly unchanged rows, so only what differs is written
+    if changed:
+        Item.objects.bulk_update(changed, sorted(changed_fields))
+    Item.objects.bulk_create(
+        Item(**row) for slug, row in rows.items() if slug not in existing)
+    reindex += [slug for slug in rows if slug not in existing]
+    if reindex:
+        get_search_backend().index_items(Item.objects.filter(slug__in=reindex))
+    if changed_fields & {'price', 'discount_price'}:
+        affected = dict(Order.objects.filter(
+            ordered=False, items__item__in=changed,
+        ).values_list('pk', 'user_id'))
+        if affected:
+            Order.objects.filter(pk__in=affected).rebuild_totals()
+            cart.invalidate_cart_summaries(set(affected.values()))
+    if changed or len(rows) > len(existing):
+        bump_catalog_version()
+    return len(rows) - len(existing), len(changed)
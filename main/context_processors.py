@@ -0,0 +1,11 @@
+from django.utils.functional import SimpleLazyObject
+
+from .cart import get_request_cart_summary
+
+
+def cart(request):
+    '''Expose the cached cart summary, looked up only if a template uses it'''
+    return {
+        'cart_summary': SimpleLazyObject(
+            lambda: get_request_cart_summary(request)),
+    }
@@ -0,0 +1,123 @@
+import os
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, features
+
+from .caching import get_cache
+
+
+IMAGE_VARIANT_WIDTHS = getattr(
+    settings, 'IMAGE_VARIANT_WIDTHS', (320, 640, 1024))
+
+IMAGE_VARIANT_QUALITY = getattr(settings, 'IMAGE_VARIANT_QUALITY', 80)
+
+IMAGE_VARIANT_CACHE_TIMEOUT = getattr(
+    settings, 'IMAGE_VARIANT_CACHE_TIMEOUT', 60 * 60 * 24)
+
+VARIANTS_DIR = 'variants'
+
+# (format, extension, content type), smallest encoding first
+FORMATS = [
+    ('WEBP', 'webp', 'image/webp'),
+    ('JPEG', 'jpg', 'image/jpeg'),
+]
+
+
+def variant_formats():
+    return [fmt for fmt in FORMATS
+            if fmt[0] != 'WEBP' or features.check('webp')]
+
+
+def variant_widths(source_width):
+    '''The configured widths narrower than the source, then its own'''
+    return [width for width in IMAGE_VARIANT_WIDTHS
+            if width < source_width] + [source_width]
+
+
+def variant_name(name, width, extension):
+    stem, _ = os.path.splitext(name)
+    return f'{VARIANTS_DIR}/{stem}-{width}w.{extension}'
+
+
+def render_variant(source, width, image_format):
+    '''Encode ``source`` scaled down to ``width``, never enlarging it'''
+    image = source.copy()
+    image.thumbnail((width, width * 10), Image.LANCZOS)
+    if image.mode not in ('RGB', 'L'):
+        background = Image.new('RGB', image.size, 'white')
+        image = image.convert('RGBA')
+        background.paste(image, mask=image.getchannel('A'))
+        image = background
+    output = BytesIO()
+    image.save(output, image_format, quality=IMAGE_VARIANT_QUALITY,
+               optimize=image_format == 'JPEG')
+    return output.getvalue()
+
+
+def generate_variants(name, force=False, storage=None):
+    '''Write every missing size and format of the image ``name``.
+
+    Images are never enlarged, so the sizes are the configured widths
+    below the source's and the source's own. Returns those widths and
+    how many variants were written. Raises OSError when the source is
+    missing or is not an image.
+    '''
+    storage = storage or default_storage
+    with storage.open(name) as f, Image.open(f) as source:
+        widths = variant_widths(source.width)
+        missing = [
+            (width, image_format, variant_name(name, width, extension))
+            for width in widths
+            for image_format, extension, _ in variant_formats()
+        ]
+        if not force:
+            missing = [variant for variant in missing
+                       if not storage.exists(variant[2])]
+        if missing:
+            source.load()
+    for width, image_format, target in missing:
+        if force and storage.exists(target):
+            storage.delete(target)
+        saved = storage.save(
+            target, ContentFile(render_variant(source, width, image_format)))
+        if saved != target:
+            # Another process wrote the same variant meanwhile
+            storage.delete(saved)
+    return widths, len(missing)
+
+
+def get_variant_widths(image):
+    '''Widths of the variants of a stored image, generating them lazily.
+
+    Cached per image name, so pages do not hit storage once they exist.
+    Returns None when no variants can be made.
+    '''
+    cache, key = get_cache('catalog'), f'image-variants:{image.name}'
+    widths = cache.get(key)
+    if widths is None:
+        try:
+            widths, _ = generate_variants(image.name, storage=image.storage)
+        except OSError:
+            return None
+        cache.set(key, widths, IMAGE_VARIANT_CACHE_TIMEOUT)
+    return widths
+
+
+def get_variant_sources(image):
+    '''``[(content type, srcset)]`` for a stored image, generating lazily.
+
+    Returns an empty list when no variants can be made, so callers fall
+    back to the original file.
+    '''
+    widths = get_variant_widths(image) if image else None
+    if not widths:
+        return []
+    return [
+        (content_type, ', '.join(
+            f'{image.storage.url(variant_name(image.name, width, extension))}'
+            f' {width}w' for width in widths))
+        for _, extension, content_type in variant_formats()
+    ]
@@ -0,0 +1,417 @@
+import asyncio
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import unquote, urlencode, urlsplit
+
+from django.conf import settings
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+from django.urls import reverse
+
+
+PERCENTILES = (50, 95, 99)
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PooledWSGIServer(ThreadedWSGIServer):
+    '''Handles connections on a fixed pool of threads, like the workers
+    of a production WSGI server'''
+
+    def __init__(self, *args, threads, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.executor = ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix='wsgi')
+
+    def process_request(self, request, client_address):
+        self.executor.submit(
+            self.process_request_thread, request, client_address)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
+
+
+class WSGITestServer:
+    '''A WSGI server for ``app`` on a free local port, with a thread per
+    connection or a pool of ``threads``'''
+
+    def __init__(self, app, host='127.0.0.1', threads=None):
+        if threads:
+            self.httpd = PooledWSGIServer(
+                (host, 0), QuietRequestHandler, threads=threads)
+        else:
+            self.httpd = ThreadedWSGIServer((host, 0), QuietRequestHandler)
+            self.httpd.daemon_threads = True
+        self.httpd.set_app(app)
+        self.host, self.port = self.httpd.server_address[:2]
+        self.thread = threading.Thread(
+            target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+
+class ASGITestServer:
+    '''A bare HTTP/1.1 server for an ASGI ``app`` on a free local port
+
+    It runs its own event loop on a thread and closes every connection
+    after one response, which is all ``HTTPClient`` needs.
+    '''
+
+    def __init__(self, app, host='127.0.0.1'):
+        self.app = app
+        self.host = host
+        self.loop = asyncio.new_event_loop()
+        self.started = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        self.started.wait()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        server = self.loop.run_until_complete(
+            asyncio.start_server(self.handle, self.host, 0))
+        self.port = server.sockets[0].getsockname()[1]
+        self.started.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            server.close()
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(
+                asyncio.gather(*tasks, return_exceptions=True))
+            self.loop.close()
+
+    async def handle(self, reader, writer):
+        try:
+            await self.serve(reader, writer)
+        # Cancelled connections are the slow clients left at shutdown
+        except (asyncio.IncompleteReadError, asyncio.CancelledError,
+                ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, reader, writer):
+        head = await reader.readuntil(b'\r\n\r\n')
+        request_line, *lines = head.decode('latin-1').split('\r\n')
+        method, target, version = request_line.split()
+        headers = [
+            tuple(part.strip().encode('latin-1')
+                  for part in line.split(':', 1))
+            for line in lines if line]
+        headers = [(name.lower(), value) for name, value in headers]
+        body = await reader.readexactly(
+            int(dict(headers).get(b'content-length', 0)))
+        path, _, query = target.partition('?')
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': version.split('/')[1],
+            'method': method,
+            'scheme': 'http',
+            'path': unquote(path),
+            'raw_path': path.encode('latin-1'),
+            'query_string': query.encode('latin-1'),
+            'root_path': '',
+            'headers': headers,
+            'client': writer.get_extra_info('peername')[:2],
+            'server': (self.host, self.port),
+        }
+        messages = [{'type': 'http.request', 'body': body}]
+
+        async def receive():
+            return messages.pop() if messages else {'type': 'http.disconnect'}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                writer.write(
+                    f'HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n'
+                    .encode('latin-1'))
+                for name, value in message['headers']:
+                    writer.write(name + b': ' + value + b'\r\n')
+                writer.write(b'Connection: close\r\n\r\n')
+            else:
+                writer.write(message.get('body', b''))
+            await writer.drain()
+
+        await self.app(scope, receive, send)
+
+
+async def slow_client(host, port, duration=2.0, interval=0.25):
+    '''Keep sending requests whose headers trickle in over ``duration``
+    seconds, like a client on a poor mobile link'''
+    while True:
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            writer.write(f'GET / HTTP/1.1\r\nHost: {host}:{port}\r\n'
+                         .encode())
+            for _ in range(int(duration / interval)):
+                await asyncio.sleep(interval)
+                writer.write(b'X-Slow: 1\r\n')
+                await writer.drain()
+            writer.write(b'Connection: close\r\n\r\n')
+            await reader.read()
+        finally:
+            writer.close()
+
+
+class Response:
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    @property
+    def location(self):
+        return self.headers.get('location', '')
+
+
+class LoadStats:
+    '''Latencies and failures of every request, grouped by endpoint'''
+
+    def __init__(self):
+        self.timings = defaultdict(list)
+        self.errors = Counter()
+
+    def record(self, endpoint, duration, ok=True):
+        self.timings[endpoint].append(duration)
+        if not ok:
+            self.errors[endpoint] += 1
+
+    def summary(self, elapsed):
+        '''``{endpoint: {...}}`` with an extra ``'total'`` entry'''
+        endpoints = dict(self.timings)
+        endpoints['total'] = [
+            duration for timings in self.timings.values()
+            for duration in timings]
+        errors = dict(self.errors, total=sum(self.errors.values()))
+        return {
+            endpoint: summarize(timings, elapsed, errors.get(endpoint, 0))
+            for endpoint, timings in sorted(endpoints.items())}
+
+
+def percentile(ordered, percent):
+    '''Nearest-rank percentile of an already sorted list'''
+    if not ordered:
+        return 0.0
+    rank = max(1, -(-len(ordered) * percent // 100))
+    return ordered[int(rank) - 1]
+
+
+def summarize(timings, elapsed, errors=0):
+    ordered = sorted(timings)
+    result = {
+        'requests': len(ordered),
+        'errors': errors,
+        'throughput': len(ordered) / elapsed if elapsed else 0.0,
+    }
+    for percent in PERCENTILES:
+        result[f'p{percent}'] = percentile(ordered, percent) * 1000
+    return result
+
+
+def compare(summary, baseline):
+    '''Relative p95 change per endpoint; positive means slower'''
+    changes = {}
+    for endpoint, current in summary.items():
+        before = baseline.get(endpoint)
+        if before and before['p95']:
+            changes[endpoint] = (current['p95'] - before['p95']) / (
+                before['p95'])
+    return changes
+
+
+class HTTPClient:
+    '''Minimal cookie-keeping HTTP/1.1 client, one connection per request
+
+    The CSRF cookie is echoed back in ``X-CSRFToken`` so forms can be
+    posted without parsing the pages.
+    '''
+
+    def __init__(self, host, port, stats):
+        self.host = host
+        self.port = port
+        self.stats = stats
+        self.cookies = {}
+
+    async def get(self, endpoint, path):
+        return await self.request(endpoint, 'GET', path)
+
+    async def post(self, endpoint, path, data):
+        return await self.request(endpoint, 'POST', path, data)
+
+    async def request(self, endpoint, method, path, data=None):
+        body = urlencode(data or {}, doseq=True).encode()
+        headers = {
+            'Host': f'{self.host}:{self.port}',
+            'Connection': 'close',
+            'User-Agent': 'load_test',
+        }
+        if self.cookies:
+            headers['Cookie'] = '; '.join(
+                f'{name}={value}' for name, value in self.cookies.items())
+        if method == 'POST':
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            headers['Content-Length'] = str(len(body))
+            if 'csrftoken' in self.cookies:
+                headers['X-CSRFToken'] = self.cookies['csrftoken']
+        head = ''.join(
+            f'{name}: {value}\r\n' for name, value in headers.items())
+
+        started = time.perf_counter()
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            writer.write(
+                f'{method} {path} HTTP/1.1\r\n{head}\r\n'.encode() + body)
+            await writer.drain()
+            raw = await reader.read()
+        finally:
+            writer.close()
+            await writer.wait_closed()
+        duration = time.perf_counter() - started
+
+        response = self.parse(raw)
+        self.stats.record(endpoint, duration, response.status < 400)
+        return response
+
+    def parse(self, raw):
+        head, _, body = raw.partition(b'\r\n\r\n')
+        lines = head.decode('latin-1').split('\r\n')
+        status = int(lines[0].split()[1])
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            name, value = name.strip().lower(), value.strip()
+            if name == 'set-cookie':
+                self.store_cookie(value)
+            else:
+                headers[name] = value
+        return Response(status, headers, body)
+
+    def store_cookie(self, header):
+        name, _, value = header.split(';', 1)[0].partition('=')
+        # Deleted cookies come back empty with an expiry in the past
+        if value in ('', '""'):
+            self.cookies.pop(name, None)
+        else:
+            self.cookies[name] = value
+
+
+class Shopper:
+    '''One simulated customer walking the whole purchase funnel'''
+
+    password = 'load-test-password'
+    status_polls = 100
+    status_poll_interval = 0.05
+
+    def __init__(self, client, number, slugs, seed=None):
+        self.client = client
+        self.username = f'shopper-{number}'
+        self.slugs = slugs
+        self.random = random.Random(seed)
+        self.has_addresses = False
+
+    async def run(self, iterations):
+        await self.sign_up()
+        for _ in range(iterations):
+            await self.browse()
+            await self.fill_cart()
+            await self.check_out()
+            await self.pay()
+
+    async def sign_up(self):
+        path = reverse('account_signup')
+        await self.client.get('signup', path)
+        response = await self.client.post('signup', path, {
+            'username': self.username,
+            'password1': self.password,
+            'password2': self.password,
+        })
+        self.check_redirect('signup', response, settings.LOGIN_REDIRECT_URL)
+
+    async def browse(self):
+        home = reverse('main:home')
+        await self.client.get('home', home)
+        await self.client.get('home', f'{home}?page=2')
+        await self.client.get(
+            'search', reverse('main:search') + '?q=item')
+
+    async def fill_cart(self):
+        slugs = self.random.sample(self.slugs, 3)
+        for slug in slugs:
+            await self.client.get(
+                'product', reverse('main:product', args=[slug]))
+            await self.client.get(
+                'add-to-cart', reverse('main:add-to-cart', args=[slug]))
+        await self.client.get(
+            'add-to-cart', reverse('main:add-to-cart', args=[slugs[0]]))
+        await self.client.get(
+            'remove-single-from-cart',
+            reverse('main:remove-single-from-cart', args=[slugs[0]]))
+        await self.client.get(
+            'remove-from-cart',
+            reverse('main:remove-from-cart', args=[slugs[1]]))
+        await self.client.get('order-summary', reverse('main:order-summary'))
+
+    async def check_out(self):
+        path = reverse('main:checkout')
+        await self.client.get('checkout', path)
+        if self.has_addresses:
+            data = {'use_default_shipping': 'on',
+                    'use_default_billing': 'on'}
+        else:
+            data = {'shipping_address': '1 Load Street',
+                    'shipping_country': 'US',
+                    'shipping_zip': '10001',
+                    'set_default_shipping': 'on',
+                    'same_shipping_address': 'on'}
+        data['payment_option'] = 'S'
+        response = await self.client.post('checkout', path, data)
+        self.check_redirect(
+            'checkout', response, reverse('main:payment', args=['stripe']))
+        self.has_addresses = True
+
+    async def pay(self):
+        path = reverse('main:payment', args=['stripe'])
+        await self.client.get('payment', path)
+        response = await self.client.post(
+            'payment', path, {'stripeToken': 'tok_visa'})
+        status_path = urlsplit(response.location).path
+        # Poll the status page until the payment worker is done
+        for _ in range(self.status_polls):
+            response = await self.client.get('payment-status', status_path)
+            if response.status != 200:
+                break
+            await asyncio.sleep(self.status_poll_interval)
+        self.check_redirect('payment-status', response, reverse('main:home'))
+
+    def check_redirect(self, endpoint, response, path):
+        # The views report most failures as a redirect with a message
+        if urlsplit(response.location).path != path:
+            self.client.stats.errors[endpoint] += 1
@@ -0,0 +1,46 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+
+class BenchmarkCommand(BaseCommand):
+    '''Base for benchmarks that run against a throwaway test database.
+
+    Subclasses implement ``run_benchmark``; the configured database is
+    never touched, so benchmarks are safe to run anywhere.
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--repeat', type=int, default=20,
+            help='Number of timed runs per measurement.')
+
+    def handle(self, *args, **options):
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False)
+        try:
+            self.run_benchmark(*args, **options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def run_benchmark(self, *args, **options):
+        raise NotImplementedError
+
+    @staticmethod
+    def measure(func, repeat):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - started)
+        return timings
+
+    def report(self, label, timings):
+        ordered = sorted(timings)
+        p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+        self.stdout.write(
+            f'{label:<40} median {statistics.median(ordered) * 1000:8.2f} ms'
+            f'  p95 {p95 * 1000:8.2f} ms  min {ordered[0] * 1000:8.2f} ms')
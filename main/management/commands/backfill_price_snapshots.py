@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from main.models import OrderItem
+
+
+class Command(BaseCommand):
+    help = ('Snapshot the prices of ordered lines that predate price '
+            'snapshots, from the current catalog prices.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Number of lines updated per transaction.')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        updated = OrderItem.objects.backfill_snapshots(
+            batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Snapshotted {updated} order lines '
+            f'in {time.monotonic() - started:.2f}s.'))
@@ -0,0 +1,90 @@
+from hashlib import md5
+
+from django.contrib import admin
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from main.admin import OrderAdmin
+from main.management.benchmark import BenchmarkCommand
+from main.models import Address, Coupon, Order, Payment
+
+
+class PlainOrderAdmin(admin.ModelAdmin):
+    '''OrderAdmin as it was: counted, unjoined and searched by LIKE'''
+    list_display = OrderAdmin.list_display
+    list_display_links = OrderAdmin.list_display_links
+    list_filter = OrderAdmin.list_filter
+    search_fields = ['user__username', 'ref_code']
+
+
+class Command(BenchmarkCommand):
+    help = ('Time the order changelist of a large table, with and without '
+            'joined rows, estimated counts and indexed search.')
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument(
+            '--orders', type=int, default=100000,
+            help='Number of orders in the table.')
+        parser.add_argument(
+            '--users', type=int, default=1000,
+            help='Number of users placing them.')
+
+    def run_benchmark(self, *args, **options):
+        self.create_orders(options['orders'], options['users'])
+        request_user = get_user_model().objects.create_superuser(
+            'admin', 'admin@example.com', 'password')
+        factory = RequestFactory()
+        ref_code = Order.objects.values_list('ref_code', flat=True).last()
+        for label, model_admin in (
+                ('plain', PlainOrderAdmin(Order, admin.site)),
+                ('tuned', OrderAdmin(Order, admin.site))):
+            for page, params in (('first page', {}),
+                                 ('ref code search', {'q': ref_code[:6]}),
+                                 ('username search', {'q': 'user-7'})):
+                request = factory.get('/admin/main/order/', params)
+                request.user = request_user
+
+                def render():
+                    model_admin.changelist_view(request).render()
+
+                # The timed runs overflow the query log otherwise
+                connection.queries_log.clear()
+                with CaptureQueriesContext(connection) as queries:
+                    render()
+                sql_ms = sum(float(query['time'])
+                             for query in queries.captured_queries) * 1000
+                self.stdout.write(f'{label}, {page}: {len(queries)} queries, '
+                                  f'{sql_ms:.1f} ms in SQL')
+                self.report(f'{label}, {page}',
+                            self.measure(render, options['repeat']))
+
+    @staticmethod
+    def create_orders(count, users):
+        get_user_model().objects.bulk_create(
+            get_user_model()(pk=n, username=f'user-{n}')
+            for n in range(1, users + 1))
+        Address.objects.bulk_create(
+            Address(pk=n, user_id=n, street_address=f'{n} Main Street',
+                    apartment_address='', country='US', zip_address=f'{n:05}',
+                    address_type='B')
+            for n in range(1, users + 1))
+        coupon = Coupon.objects.create(code='SPRING', amount=5.0)
+        ordered_date = timezone.now()
+        for start in range(1, count + 1, 10000):
+            stop = min(start + 10000, count + 1)
+            Payment.objects.bulk_create(
+                Payment(pk=n, stripe_charge_id=f'ch_{n}',
+                        user_id=n % users + 1, amount=20.0)
+                for n in range(start, stop))
+            Order.objects.bulk_create(
+                Order(pk=n, user_id=n % users + 1,
+                      ref_code=md5(str(n).encode()).hexdigest()[:20],
+                      ordered=True, ordered_date=ordered_date,
+                      billing_address_id=n % users + 1,
+                      shipping_address_id=n % users + 1, payment_id=n,
+                      coupon=coupon if n % 10 == 0 else None)
+                for n in range(start, stop))
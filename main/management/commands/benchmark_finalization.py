@@ -0,0 +1,82 @@
+import time
+
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from main.management.benchmark import BenchmarkCommand
+from main.models import Item, Order, OrderItem, Payment
+
+
+class Command(BenchmarkCommand):
+    help = ('Time closing paid orders of growing size with Order.finalize '
+            'against saving every line on its own.')
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument(
+            '--lines', type=int, nargs='+', default=[1, 50, 500],
+            help='Cart sizes to finalize.')
+
+    def run_benchmark(self, *args, **options):
+        Item.objects.bulk_create(
+            Item(title=f'Item {n}', price=10.0 + n % 90, category='S',
+                 label='P', slug=f'item-{n}', description='Synthetic item',
+                 image='item.jpg')
+            for n in range(max(options['lines'])))
+        items = list(Item.objects.order_by('pk'))
+        for size in options['lines']:
+            for label, finalize in (('row by row', self.finalize_rows),
+                                    ('bulk', self.finalize_bulk)):
+                timings, query_counts = [], set()
+                for n in range(options['repeat']):
+                    order = self.create_order(
+                        f'{label}-{size}-{n}', items[:size])
+                    payment = Payment.objects.create(
+                        stripe_charge_id=f'ch_{order.pk}',
+                        user_id=order.user_id, amount=order.total)
+                    with CaptureQueriesContext(connection) as queries:
+                        started = time.perf_counter()
+                        with transaction.atomic():
+                            finalize(order, payment)
+                        timings.append(time.perf_counter() - started)
+                    query_counts.add(len(queries))
+                queries = '/'.join(str(count) for count in sorted(
+                    query_counts))
+                self.report(f'{size} lines, {label} ({queries} queries)',
+                            timings)
+
+    @staticmethod
+    def create_order(username, items):
+        user = get_user_model().objects.create(username=username)
+        order = Order.objects.create(user=user, ordered_date=timezone.now())
+        OrderItem.objects.bulk_create(
+            OrderItem(user=user, item=item, quantity=2) for item in items)
+        # SQLite does not return the primary keys of bulk inserts
+        order.items.through.objects.bulk_create(
+            order.items.through(order_id=order.pk, orderitem_id=pk)
+            for pk in OrderItem.objects.filter(user=user).values_list(
+                'pk', flat=True))
+        order.refresh_totals()
+        return order
+
+    @staticmethod
+    def finalize_rows(order, payment):
+        '''The previous approach: a save per line and per order'''
+        for line in order.items.select_related('item'):
+            line.ordered = True
+            line.unit_price = line.item.get_price()
+            line.line_total = line.unit_price * line.quantity
+            line.save()
+        order.refresh_totals()
+        order.ordered = True
+        order.payment = payment
+        order.ref_code = f'ref-{order.pk}'
+        order.save()
+
+    @staticmethod
+    def finalize_bulk(order, payment):
+        '''The snapshot request_payment takes, then the worker's finalize'''
+        order.snapshot_prices()
+        order.finalize(payment, f'ref-{order.pk}')
@@ -0,0 +1,45 @@
+from django.core.paginator import Paginator
+
+from main.management.benchmark import BenchmarkCommand
+from main.models import Item
+from main.pagination import CursorPaginator, encode_cursor
+
+
+class Command(BenchmarkCommand):
+    help = ('Compare OFFSET and keyset (cursor) pagination latency of the '
+            'product listing at increasing page depths.')
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument(
+            '--items', type=int, default=100000,
+            help='Size of the synthetic catalog.')
+        parser.add_argument(
+            '--per-page', type=int, default=10)
+
+    def run_benchmark(self, *args, **options):
+        size, per_page = options['items'], options['per_page']
+        self.stdout.write(f'Creating {size} items...')
+        Item.objects.bulk_create(
+            (Item(title=f'Item {n}', price=10.0, category='S', label='P',
+                  slug=f'item-{n}', description='Synthetic item',
+                  image='item.jpg') for n in range(size)),
+            batch_size=500)
+        queryset = Item.objects.order_by('pk')
+        pks = list(queryset.values_list('pk', flat=True))
+
+        for depth in (0, size // 100, size // 10, size // 2, size - per_page):
+            number = depth // per_page + 1
+            cursor = encode_cursor(pks[depth - 1]) if depth else None
+
+            def offset_page():
+                # A fresh paginator, like every request, pays for COUNT(*)
+                list(Paginator(queryset, per_page).page(number).object_list)
+
+            def cursor_page():
+                CursorPaginator(queryset, per_page).page(after=cursor)
+
+            self.report(f'offset page {number}',
+                        self.measure(offset_page, options['repeat']))
+            self.report(f'cursor page {number}',
+                        self.measure(cursor_page, options['repeat']))
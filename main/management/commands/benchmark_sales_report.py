@@ -0,0 +1,132 @@
+import datetime
+import random
+import time
+
+from django.contrib.auth import get_user_model
+from django.db.models import Sum
+from django.utils import timezone
+
+from main.management.benchmark import BenchmarkCommand
+from main.models import (CATEGORY_CHOICES, Item, Order, OrderItem, Payment,
+                         line_total_expression)
+from main.reports import rollup_daily_sales, rollup_refunds, sales_report
+
+
+class Command(BenchmarkCommand):
+    help = ('Time a year of sales reports read from the daily rollups '
+            'against aggregating the order lines, and the incremental '
+            'rollup of a day of new orders.')
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument(
+            '--days', type=int, default=365,
+            help='Days of synthetic orders.')
+        parser.add_argument(
+            '--orders-per-day', type=int, default=100,
+            help='Paid orders per day.')
+        parser.add_argument(
+            '--items', type=int, default=40,
+            help='Number of catalog items.')
+        parser.add_argument(
+            '--seed', type=int, default=0,
+            help='Seed of the synthetic orders.')
+
+    def run_benchmark(self, *args, **options):
+        generator = random.Random(options['seed'])
+        user = get_user_model().objects.create(username='shopper')
+        Item.objects.bulk_create(
+            Item(pk=n, title=f'Item {n}', price=10.0 + n % 90,
+                 discount_price=(5.0 + n % 90) if n % 3 == 0 else None,
+                 category=CATEGORY_CHOICES[n % len(CATEGORY_CHOICES)][0],
+                 label='P', slug=f'item-{n}', description='Synthetic item',
+                 image='item.jpg')
+            for n in range(1, options['items'] + 1))
+        items = list(Item.objects.all())
+        end = timezone.localdate()
+        start = end - datetime.timedelta(days=options['days'] - 1)
+
+        started = time.perf_counter()
+        for day in range(options['days']):
+            self.create_day(generator, user, items,
+                            start + datetime.timedelta(days=day),
+                            options['orders_per_day'])
+        lines = OrderItem.objects.count()
+        self.stdout.write(
+            f'Created {Order.objects.count()} orders with {lines} lines '
+            f'in {time.perf_counter() - started:.1f}s.')
+
+        started = time.perf_counter()
+        rollup_daily_sales()
+        rollup_refunds()
+        self.stdout.write(
+            f'Rolled up the year in {time.perf_counter() - started:.2f}s.')
+
+        repeat = options['repeat']
+        for group in ('day', 'category'):
+            self.report(f'scan order lines, by {group}', self.measure(
+                lambda: self.scan_lines(start, end, group), repeat))
+            self.report(f'read rollups, by {group}', self.measure(
+                lambda: sales_report(start, end, group), repeat))
+
+        timings = []
+        for n in range(repeat):
+            self.create_day(generator, user, items, end,
+                            options['orders_per_day'])
+            began = time.perf_counter()
+            rollup_daily_sales()
+            rollup_refunds()
+            timings.append(time.perf_counter() - began)
+        self.report('roll up a day of new orders', timings)
+
+    @staticmethod
+    def scan_lines(start, end, group):
+        '''The report computed straight from the order lines'''
+        field = {'day': 'order__payment__timestamp',
+                 'category': 'item__category'}[group]
+        return list(OrderItem.objects.filter(
+            order__payment__timestamp__range=(start, end),
+        ).values(field).annotate(
+            units=Sum('quantity'), revenue=Sum(line_total_expression()),
+        ).order_by(field))
+
+    @staticmethod
+    def create_day(generator, user, items, date, count):
+        '''Paid orders of one day, inserted with explicit keys'''
+        first_payment = (Payment.objects.order_by('-pk').values_list(
+            'pk', flat=True).first() or 0) + 1
+        first_line = (OrderItem.objects.order_by('-pk').values_list(
+            'pk', flat=True).first() or 0) + 1
+        ordered_date = timezone.now()
+        payments, orders, lines, links = [], [], [], []
+        for pk in range(first_payment, first_payment + count):
+            subtotal = 0
+            order_items = generator.sample(items, generator.randint(1, 4))
+            for item in order_items:
+                quantity = generator.randint(1, 3)
+                unit_price = item.get_price()
+                lines.append(OrderItem(
+                    pk=first_line, user=user, item=item, quantity=quantity,
+                    ordered=True, list_price=item.price,
+                    unit_price=unit_price,
+                    discount=(item.price - unit_price) * quantity,
+                    line_total=unit_price * quantity))
+                links.append(Order.items.through(
+                    order_id=pk, orderitem_id=first_line))
+                subtotal += unit_price * quantity
+                first_line += 1
+            discount = 5.0 if pk % 10 == 0 else 0
+            payments.append(Payment(pk=pk, stripe_charge_id=f'ch_{pk}',
+                                    user=user, amount=subtotal - discount))
+            orders.append(Order(
+                pk=pk, user=user, ref_code=f'ref-{pk}', ordered=True,
+                ordered_date=ordered_date, payment_id=pk, subtotal=subtotal,
+                discount=discount, total=subtotal - discount,
+                line_count=len(order_items),
+                refund_granted=pk % 50 == 0))
+        Payment.objects.bulk_create(payments)
+        # The timestamp is set on insert
+        Payment.objects.filter(pk__gte=first_payment).update(timestamp=date)
+        OrderItem.objects.bulk_create(lines)
+        Order.objects.bulk_create(orders)
+        Order.items.through.objects.bulk_create(links)
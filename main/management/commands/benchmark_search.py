@@ -0,0 +1,64 @@
+import random
+import string
+import time
+
+from main.management.benchmark import BenchmarkCommand
+from main.models import CATEGORY_CHOICES, LABEL_CHOICES, Item
+from main.search import SimpleSearchBackend, get_search_backend
+
+
+WORDS = ('cotton', 'linen', 'wool', 'denim', 'classic', 'slim', 'relaxed',
+         'striped', 'plain', 'hooded', 'zip', 'running', 'training',
+         'winter', 'summer', 'rain', 'shell', 'fleece', 'jersey', 'polo',
+         'oxford', 'flannel', 'bomber', 'parka', 'windbreaker', 'tank',
+         'black', 'white', 'navy', 'olive', 'grey', 'red', 'sand')
+
+
+class Command(BenchmarkCommand):
+    help = ('Compare indexed full-text search with an unindexed icontains '
+            'scan over a synthetic catalog.')
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument(
+            '--items', type=int, default=100000,
+            help='Size of the synthetic catalog.')
+        parser.add_argument(
+            '--per-page', type=int, default=10)
+
+    def run_benchmark(self, *args, **options):
+        size, per_page = options['items'], options['per_page']
+        words = random.Random(0)
+        # Descriptions mostly draw from a long tail of filler words, so
+        # product words match a realistic share of the catalog
+        filler = [''.join(words.choices(string.ascii_lowercase, k=7))
+                  for _ in range(5000)]
+        self.stdout.write(f'Creating {size} items...')
+        Item.objects.bulk_create(
+            (Item(title=' '.join(words.sample(WORDS, 3)).title(),
+                  description=' '.join(words.sample(WORDS, 2)
+                                       + words.choices(filler, k=20)),
+                  price=10.0, category=words.choice(CATEGORY_CHOICES)[0],
+                  label=words.choice(LABEL_CHOICES)[0], slug=f'item-{n}',
+                  image='item.jpg') for n in range(size)),
+            batch_size=500)
+        backend = get_search_backend()
+        started = time.perf_counter()
+        backend.index_items(Item.objects.all())
+        self.stdout.write(f'{type(backend).__name__} indexed {size} items '
+                          f'in {time.perf_counter() - started:.2f} s')
+
+        # A frequent word, a title-only combination, a rare word and a
+        # prefix typed halfway through
+        queries = ('cotton', 'slim parka', 'windbreaker fleece navy', 'flan')
+        for query in queries:
+            for name, search in (('indexed', backend),
+                                 ('icontains', SimpleSearchBackend())):
+                def results_page():
+                    matches = search.search(Item.objects.all(), query)
+                    matches.count()
+                    list(matches[:per_page])
+                    search.facets(matches)
+
+                self.report(f'{name} "{query}"',
+                            self.measure(results_page, options['repeat']))
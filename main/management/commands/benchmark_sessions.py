@@ -0,0 +1,76 @@
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+
+from main.management.benchmark import BenchmarkCommand
+from main.models import Item
+
+
+SESSION_MESSAGES = 'django.contrib.messages.storage.session.SessionStorage'
+COOKIE_MESSAGES = 'django.contrib.messages.storage.cookie.CookieStorage'
+
+# The project defaults before sessions and messages were moved off the
+# database come first, as the baseline
+CONFIGURATIONS = [
+    ('db', SESSION_MESSAGES),
+    ('db', COOKIE_MESSAGES),
+    ('cached_db', COOKIE_MESSAGES),
+    ('cache', COOKIE_MESSAGES),
+    ('signed_cookies', COOKIE_MESSAGES),
+]
+
+WRITE_PREFIXES = ('INSERT', 'UPDATE', 'DELETE')
+
+
+class Command(BenchmarkCommand):
+    help = ('Count django_session writes of the add-to-cart and order '
+            'summary flow under each session engine and message storage.')
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument(
+            '--iterations', type=int, default=200,
+            help='Add-to-cart and order summary round trips per shopper.')
+
+    def run_benchmark(self, *args, **options):
+        items = [Item.objects.create(
+            title=f'Item {n}', price=10.0, category='S', label='P',
+            slug=f'item-{n}', description='Synthetic item',
+            image='item.jpg') for n in range(20)]
+        user = get_user_model().objects.create_user('benchmark')
+        for engine, storage in CONFIGURATIONS:
+            with override_settings(
+                    SESSION_ENGINE=settings.SESSION_ENGINES[engine],
+                    MESSAGE_STORAGE=storage,
+                    ALLOWED_HOSTS=['testserver']):
+                label = f'{engine} + {storage.rsplit(".", 1)[1]}'
+                for shopper in ('anonymous', 'logged in'):
+                    client = Client()
+                    if shopper == 'logged in':
+                        client.force_login(user)
+                    self.run_flow(f'{label}, {shopper}', client, items,
+                                  options['iterations'])
+
+    def run_flow(self, label, client, items, iterations):
+        writes = 0
+        started = time.perf_counter()
+        for n in range(iterations):
+            item = items[n % len(items)]
+            with CaptureQueriesContext(connection) as queries:
+                client.get(reverse('main:add-to-cart', args=[item.slug]))
+                client.get(reverse('main:order-summary'))
+            writes += sum(
+                1 for query in queries
+                if query['sql'].startswith(WRITE_PREFIXES)
+                and 'django_session' in query['sql'])
+        elapsed = time.perf_counter() - started
+        requests = iterations * 2
+        self.stdout.write(
+            f'{label:<45} {requests / elapsed:7.0f} req/s  '
+            f'{writes / requests:5.2f} session writes/req  '
+            f'{writes / elapsed:7.0f} writes/s')
@@ -0,0 +1,55 @@
+import csv
+import json
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+from main.catalog import ITEM_FIELDS
+from main.models import Item
+
+
+class Command(BaseCommand):
+    help = ('Stream every item to CSV or JSON Lines in the format read by '
+            'import_items.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path', nargs='?', default='-',
+            help='File to write, or - for standard output (default).')
+        parser.add_argument(
+            '--format', choices=['csv', 'jsonl'], default='csv')
+        parser.add_argument(
+            '--batch-size', type=int, default=2000,
+            help='Rows fetched from the database at a time.')
+
+    def handle(self, *args, **options):
+        to_stdout = options['path'] == '-'
+        stream = (sys.stdout if to_stdout
+                  else open(options['path'], 'w', newline='',
+                            encoding='utf-8'))
+        rows = (Item.objects.order_by('pk').values_list(*ITEM_FIELDS)
+                .iterator(chunk_size=options['batch_size']))
+        started = time.monotonic()
+        try:
+            count = self.write_rows(stream, rows, options['format'])
+        finally:
+            if not to_stdout:
+                stream.close()
+        elapsed = time.monotonic() - started
+        self.stderr.write(
+            f'Exported {count} items in {elapsed:.2f}s '
+            f'({count / elapsed if elapsed else 0:.0f} rows/s)')
+
+    @staticmethod
+    def write_rows(stream, rows, fmt):
+        count = 0
+        if fmt == 'csv':
+            writer = csv.writer(stream)
+            writer.writerow(ITEM_FIELDS)
+            for count, row in enumerate(rows, 1):
+                writer.writerow(row)
+            return count
+        for count, row in enumerate(rows, 1):
+            stream.write(json.dumps(dict(zip(ITEM_FIELDS, row))) + '\n')
+        return count
@@ -0,0 +1,54 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import django
+from django.core.management.base import BaseCommand
+
+from main.images import generate_variants
+from main.models import Item
+
+
+def backfill(name, force):
+    try:
+        return name, generate_variants(name, force=force)[1], None
+    except OSError as e:
+        return name, 0, str(e)
+
+
+class Command(BaseCommand):
+    help = ('Generate the resized WebP and JPEG variants of every item '
+            'image that does not have them yet.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count(),
+            help='Worker processes; 1 runs in this process.')
+        parser.add_argument(
+            '--force', action='store_true',
+            help='Regenerate variants that already exist.')
+
+    def handle(self, *args, **options):
+        names = list(Item.objects.exclude(image='').order_by()
+                     .values_list('image', flat=True).distinct())
+        work = partial(backfill, force=options['force'])
+        started = time.monotonic()
+        if options['workers'] > 1:
+            # Workers only touch storage, but set Django up for platforms
+            # that spawn rather than fork them
+            with ProcessPoolExecutor(options['workers'],
+                                     initializer=django.setup) as pool:
+                results = list(pool.map(work, names, chunksize=8))
+        else:
+            results = [work(name) for name in names]
+        written = failed = 0
+        for name, count, error in results:
+            written += count
+            if error:
+                failed += 1
+                self.stderr.write(f'{name}: {error}')
+        self.stdout.write(
+            f'Checked {len(names)} images in '
+            f'{time.monotonic() - started:.1f} s: wrote {written} variants, '
+            f'{failed} failed.')
@@ -0,0 +1,98 @@
+import csv
+import json
+import sys
+import time
+from itertools import islice
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from main.catalog import clean_item_row, import_item_batch
+
+
+class Command(BaseCommand):
+    help = ('Stream items from a CSV or JSON Lines file and create or '
+            'update them in bulk, keyed on slug.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path', help='File to read, or - for standard input.')
+        parser.add_argument(
+            '--format', choices=['csv', 'jsonl'],
+            help='Input format; guessed from the file extension if omitted.')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Rows validated and written per transaction.')
+        parser.add_argument(
+            '--max-errors', type=int, default=100,
+            help='Abort once this many rows have been rejected.')
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        fmt = options['format'] or self.guess_format(options['path'])
+        stream = (sys.stdin if options['path'] == '-'
+                  else open(options['path'], newline='', encoding='utf-8'))
+        with stream:
+            rows = self.read_rows(stream, fmt)
+            self.import_rows(rows, options['batch_size'],
+                             options['max_errors'])
+
+    @staticmethod
+    def guess_format(path):
+        if path.endswith('.csv'):
+            return 'csv'
+        if path.endswith(('.jsonl', '.ndjson')):
+            return 'jsonl'
+        raise CommandError('Cannot guess the format, pass --format.')
+
+    @staticmethod
+    def read_rows(stream, fmt):
+        '''Yield (line number, row) pairs without reading ahead'''
+        if fmt == 'csv':
+            reader = csv.DictReader(stream)
+            for row in reader:
+                yield reader.line_num, row
+            return
+        for number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield number, row if isinstance(row, dict) else {}
+
+    def import_rows(self, rows, batch_size, max_errors):
+        created = updated = rejected = processed = 0
+        started = time.monotonic()
+        while True:
+            batch, chunk = [], list(islice(rows, batch_size))
+            if not chunk:
+                break
+            for number, row in chunk:
+                try:
+                    batch.append(clean_item_row(row))
+                except ValidationError as e:
+                    rejected += 1
+                    self.stderr.write(
+                        f'Line {number}: {"; ".join(e.messages)}')
+                    if rejected >= max_errors:
+                        raise CommandError(
+                            f'Aborted after {rejected} rejected rows.')
+            batch_created, batch_updated = import_item_batch(batch)
+            created += batch_created
+            updated += batch_updated
+            processed += len(chunk)
+            if self.verbosity >= 2:
+                self.report(processed, started)
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {created}, updated {updated}, '
+            f'unchanged {processed - created - updated - rejected}, '
+            f'rejected {rejected}.'))
+        self.report(processed, started)
+
+    def report(self, rows, started):
+        elapsed = time.monotonic() - started
+        self.stdout.write(
+            f'{rows} rows in {elapsed:.2f}s '
+            f'({rows / elapsed if elapsed else 0:.0f} rows/s)')
@@ -0,0 +1,146 @@
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+from django.core.wsgi import get_wsgi_application
+from django.db import connection
+from django.test.utils import override_settings
+
+from main.asgi import get_asgi_application
+from main.loadtest import (ASGITestServer, HTTPClient, LoadStats, Shopper,
+                           WSGITestServer, compare, slow_client)
+from main.management.benchmark import BenchmarkCommand
+from main.models import Item, Order
+from main.search import get_search_backend
+
+
+class Command(BenchmarkCommand):
+    help = ('Drive concurrent shoppers through sign-up, browsing, cart, '
+            'checkout and payment against the app on a local WSGI or ASGI '
+            'server and report latency percentiles per endpoint. Compare '
+            'the two with --server wsgi --save PATH, then --server asgi '
+            '--compare PATH.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--users', type=int, default=10,
+            help='Number of concurrent shoppers.')
+        parser.add_argument(
+            '--iterations', type=int, default=3,
+            help='Purchases made by every shopper.')
+        parser.add_argument(
+            '--items', type=int, default=60,
+            help='Number of catalog items to create.')
+        parser.add_argument(
+            '--seed', type=int, default=0,
+            help='Seed of the shoppers\' item choices.')
+        parser.add_argument(
+            '--server', choices=('wsgi', 'asgi'), default='wsgi',
+            help='Protocol the app is served over.')
+        parser.add_argument(
+            '--threads', type=int, default=10,
+            help='Worker threads of the server running the views.')
+        parser.add_argument(
+            '--slow-clients', type=int, default=0,
+            help='Extra connections trickling their requests in slowly.')
+        parser.add_argument(
+            '--save', metavar='PATH',
+            help='Write the results to PATH as a JSON baseline.')
+        parser.add_argument(
+            '--compare', metavar='PATH',
+            help='Compare the results with a baseline saved by --save.')
+
+    def handle(self, *args, **options):
+        # In-memory SQLite databases fail with "table is locked" as soon as
+        # two server threads write, so the run gets a database file
+        if connection.vendor != 'sqlite':
+            return super().handle(*args, **options)
+        with tempfile.TemporaryDirectory() as directory:
+            test_settings = connection.settings_dict['TEST']
+            old_test_name = test_settings['NAME']
+            test_settings['NAME'] = os.path.join(directory, 'load.sqlite3')
+            try:
+                super().handle(*args, **options)
+            finally:
+                test_settings['NAME'] = old_test_name
+
+    def run_benchmark(self, *args, **options):
+        Item.objects.bulk_create(
+            Item(title=f'Item {n}', price=10.0 + n % 90, category='S',
+                 label='P', slug=f'item-{n}', description='Synthetic item',
+                 image='item.jpg')
+            for n in range(options['items']))
+        get_search_backend().index_items(Item.objects.all())
+        slugs = list(Item.objects.values_list('slug', flat=True))
+
+        stats = LoadStats()
+        # Payments go to the fake gateway, charged by this process's
+        # payment threads
+        with override_settings(
+                ALLOWED_HOSTS=['127.0.0.1'],
+                EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+                PAYMENT_GATEWAY='main.payments.FakeGateway',
+                SLOW_REQUEST_THRESHOLD=float('inf')), \
+                self.get_server(options) as server:
+            started = time.perf_counter()
+            asyncio.run(self.run_shoppers(server, stats, slugs, options))
+            elapsed = time.perf_counter() - started
+
+        summary = stats.summary(elapsed)
+        baseline = {}
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)['endpoints']
+        self.write_summary(summary, compare(summary, baseline))
+        self.stdout.write(
+            f'Paid orders: {Order.objects.filter(ordered=True).count()} '
+            f'of {options["users"] * options["iterations"]}')
+        if options['save']:
+            with open(options['save'], 'w') as f:
+                json.dump({
+                    'options': {name: options[name] for name in (
+                        'users', 'iterations', 'items', 'seed', 'server',
+                        'threads', 'slow_clients')},
+                    'elapsed': elapsed,
+                    'endpoints': summary,
+                }, f, indent=2, sort_keys=True)
+            self.stdout.write(f'Baseline saved to {options["save"]}')
+
+    def get_server(self, options):
+        if options['server'] == 'asgi':
+            return ASGITestServer(get_asgi_application(options['threads']))
+        return WSGITestServer(
+            get_wsgi_application(), threads=options['threads'])
+
+    async def run_shoppers(self, server, stats, slugs, options):
+        slow_clients = [
+            asyncio.ensure_future(slow_client(server.host, server.port))
+            for _ in range(options['slow_clients'])]
+        shoppers = [
+            Shopper(HTTPClient(server.host, server.port, stats), number,
+                    slugs, seed=options['seed'] + number)
+            for number in range(options['users'])]
+        try:
+            await asyncio.gather(*(
+                shopper.run(options['iterations']) for shopper in shoppers))
+        finally:
+            for client in slow_clients:
+                client.cancel()
+            await asyncio.gather(*slow_clients, return_exceptions=True)
+
+    def write_summary(self, summary, changes):
+        self.stdout.write(
+            f'{"endpoint":<25} {"requests":>8} {"errors":>6} {"req/s":>8} '
+            f'{"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}'
+            + ('  p95 change' if changes else ''))
+        for endpoint, result in summary.items():
+            line = (
+                f'{endpoint:<25} {result["requests"]:>8} '
+                f'{result["errors"]:>6} {result["throughput"]:>8.1f} '
+                f'{result["p50"]:>8.2f} {result["p95"]:>8.2f} '
+                f'{result["p99"]:>8.2f}')
+            if endpoint in changes:
+                line += f'  {changes[endpoint]:+10.1%}'
+            self.stdout.write(line)
@@ -0,0 +1,43 @@
+import time
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from main.models import PaymentAttempt
+from main.payments import process_due_payments
+
+
+class Command(BaseCommand):
+    help = ('Charge pending payments whose next try is due, retrying '
+            'transient gateway failures with exponential backoff.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Process the due payments once and exit.')
+        parser.add_argument(
+            '--interval', type=float, default=1.0,
+            help='Seconds to wait when no payment is due.')
+        parser.add_argument(
+            '--batch-size', type=int, default=100,
+            help='Payments processed per pass.')
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            attempts = process_due_payments(limit=options['batch_size'])
+            if attempts:
+                self.report(attempts)
+            if options['once']:
+                return
+            if not attempts:
+                time.sleep(options['interval'])
+
+    def report(self, attempts):
+        statuses = Counter(attempt.status for attempt in attempts)
+        self.stdout.write(
+            f'Processed {len(attempts)} payments: '
+            f'{statuses[PaymentAttempt.SUCCEEDED]} succeeded, '
+            f'{statuses[PaymentAttempt.FAILED]} failed, '
+            f'{statuses[PaymentAttempt.PENDING]} to retry.')
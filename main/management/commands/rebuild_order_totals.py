@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from main.models import Order
+
+
+class Command(BaseCommand):
+    help = ('Recompute the stored subtotal, discount, total and line count '
+            'of orders from their lines, updating only those that drifted.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Number of orders recomputed and written per batch.')
+        parser.add_argument(
+            '--open-only', action='store_true',
+            help='Only reconcile carts that have not been ordered yet.')
+
+    def handle(self, *args, **options):
+        orders = Order.objects.all()
+        if options['open_only']:
+            orders = orders.filter(ordered=False)
+        started = time.monotonic()
+        checked, updated = orders.rebuild_totals(
+            batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Checked {checked} orders, updated {updated} '
+            f'in {time.monotonic() - started:.2f}s.'))
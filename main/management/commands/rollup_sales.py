@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from main.reports import rebuild_rollups, rollup_daily_sales, rollup_refunds
+
+
+class Command(BaseCommand):
+    help = ('Roll the orders paid since the last run up into daily sales '
+            'per item, and bring refunds up to date.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of orders rolled up per transaction.')
+        parser.add_argument(
+            '--rebuild', action='store_true',
+            help='Drop the rollups and start again from the first order.')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        if options['rebuild']:
+            rebuild_rollups()
+        orders = rollup_daily_sales(batch_size=options['batch_size'])
+        refunds = rollup_refunds()
+        self.stdout.write(self.style.SUCCESS(
+            f'Rolled up {orders} orders and updated refunds on {refunds} '
+            f'rows in {time.monotonic() - started:.2f}s.'))
@@ -0,0 +1,245 @@
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import ExitStack
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+from django.template.backends.django import DjangoTemplates
+
+
+logger = logging.getLogger('main.performance')
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                    5.0, 10.0)
+
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+# Queries kept per request for the slow request log
+MAX_LOGGED_QUERIES = 100
+
+current_metrics = ContextVar('current_metrics', default=None)
+
+
+class RequestMetrics:
+    '''What one request spent on the database, templates and caches'''
+
+    def __init__(self):
+        self.duration = 0.0
+        self.query_count = 0
+        self.query_time = 0.0
+        self.queries = []
+        self.template_time = 0.0
+        self.template_depth = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def record_query(self, execute, sql, params, many, context):
+        '''Database execute wrapper timing every statement'''
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - started
+            self.query_count += 1
+            self.query_time += duration
+            if len(self.queries) < MAX_LOGGED_QUERIES:
+                self.queries.append((sql, duration))
+
+
+def record_cache(hits, misses):
+    metrics = current_metrics.get()
+    if metrics is not None:
+        metrics.cache_hits += hits
+        metrics.cache_misses += misses
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            yield bound, total
+
+
+class ViewStats:
+
+    def __init__(self):
+        self.duration = Histogram(DURATION_BUCKETS)
+        self.queries = Histogram(QUERY_COUNT_BUCKETS)
+        self.query_seconds = 0.0
+        self.template_seconds = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def observe(self, metrics):
+        self.duration.observe(metrics.duration)
+        self.queries.observe(metrics.query_count)
+        self.query_seconds += metrics.query_time
+        self.template_seconds += metrics.template_time
+        self.cache_hits += metrics.cache_hits
+        self.cache_misses += metrics.cache_misses
+
+
+class MetricsRegistry:
+    '''Per-view aggregates of this process, rendered for Prometheus'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.views = {}
+
+    def observe(self, view, metrics):
+        with self.lock:
+            self.views.setdefault(view, ViewStats()).observe(metrics)
+
+    def reset(self):
+        with self.lock:
+            self.views = {}
+
+    def render(self, cache_stats=None):
+        lines = []
+        with self.lock:
+            views = sorted(self.views.items())
+            for name, unit, attribute in (
+                    ('main_request_duration_seconds',
+                     'Wall time per request.', 'duration'),
+                    ('main_request_queries',
+                     'Database queries per request.', 'queries')):
+                lines += [f'# HELP {name} {unit}',
+                          f'# TYPE {name} histogram']
+                for view, stats in views:
+                    histogram = getattr(stats, attribute)
+                    for bound, count in histogram.cumulative():
+                        lines.append(f'{name}_bucket{{view="{view}",'
+                                     f'le="{bound}"}} {count}')
+                    lines.append(
+                        f'{name}_sum{{view="{view}"}} {histogram.sum}')
+                    lines.append(
+                        f'{name}_count{{view="{view}"}} {histogram.count}')
+            for name, help_text, attribute in (
+                    ('main_request_query_seconds_total',
+                     'Time spent in database queries.', 'query_seconds'),
+                    ('main_request_template_seconds_total',
+                     'Time spent rendering templates.', 'template_seconds'),
+                    ('main_request_cache_hits_total',
+                     'Cache hits made while serving requests.',
+                     'cache_hits'),
+                    ('main_request_cache_misses_total',
+                     'Cache misses made while serving requests.',
+                     'cache_misses')):
+                lines += [f'# HELP {name} {help_text}',
+                          f'# TYPE {name} counter']
+                lines += [f'{name}{{view="{view}"}} '
+                          f'{getattr(stats, attribute)}'
+                          for view, stats in views]
+        for outcome in ('hits', 'misses'):
+            name = f'main_cache_{outcome}_total'
+            lines += [f'# HELP {name} Cache {outcome} per alias.',
+                      f'# TYPE {name} counter']
+            lines += [f'{name}{{cache="{alias}"}} {counts[outcome]}'
+                      for alias, counts in (cache_stats or {}).items()]
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+def get_view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match else '<unresolved>'
+
+
+class PerformanceMiddleware:
+    '''Time each request and attribute the cost to its view.
+
+    Meant to be the outermost middleware so the numbers cover the whole
+    stack. Requests slower than SLOW_REQUEST_THRESHOLD seconds are logged
+    to ``main.performance`` together with their queries.
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.threshold = getattr(settings, 'SLOW_REQUEST_THRESHOLD', 0.5)
+
+    def __call__(self, request):
+        metrics = RequestMetrics()
+        token = current_metrics.set(metrics)
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(
+                        connection.execute_wrapper(metrics.record_query))
+                response = self.get_response(request)
+        finally:
+            metrics.duration = time.perf_counter() - started
+            current_metrics.reset(token)
+        view = get_view_name(request)
+        registry.observe(view, metrics)
+        response['Server-Timing'] = ', '.join([
+            f'app;dur={metrics.duration * 1000:.1f}',
+            f'db;dur={metrics.query_time * 1000:.1f}',
+            f'tpl;dur={metrics.template_time * 1000:.1f}',
+        ])
+        if metrics.duration >= self.threshold:
+            self.log_slow_request(request, view, metrics)
+        return response
+
+    def log_slow_request(self, request, view, metrics):
+        logger.warning(
+            'Slow request %s %s (%s): %.0f ms, %d queries in %.0f ms, '
+            'templates %.0f ms, cache %d hits / %d misses\n%s',
+            request.method, request.path, view, metrics.duration * 1000,
+            metrics.query_count, metrics.query_time * 1000,
+            metrics.template_time * 1000, metrics.cache_hits,
+            metrics.cache_misses,
+            '\n'.join(f'  {duration * 1000:7.1f} ms  {sql}'
+                      for sql, duration in metrics.queries))
+
+
+class TimedTemplate:
+    '''Backend template wrapper adding its render time to the request'''
+
+    def __init__(self, template):
+        self.template = template
+
+    def __getattr__(self, name):
+        return getattr(self.template, name)
+
+    def render(self, context=None, request=None):
+        metrics = current_metrics.get()
+        if metrics is None:
+            return self.template.render(context, request)
+        # Templates rendered from within templates are already counted
+        metrics.template_depth += 1
+        started = time.perf_counter()
+        try:
+            return self.template.render(context, request)
+        finally:
+            metrics.template_depth -= 1
+            if not metrics.template_depth:
+                metrics.template_time += time.perf_counter() - started
+
+
+class InstrumentedDjangoTemplates(DjangoTemplates):
+    '''DjangoTemplates backend whose templates report their render time'''
+
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
@@ -0,0 +1,84 @@
+# Generated by Django 2.2.28 on 2026-10-18 01:11
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def dedupe(queryset, field, max_length):
+    '''Suffix duplicate values with the row's pk so they can be unique'''
+    duplicates = (queryset.values(field).annotate(rows=Count('pk'))
+                  .filter(rows__gt=1).values_list(field, flat=True))
+    for value in list(duplicates):
+        for obj in queryset.filter(**{field: value}).order_by('pk')[1:]:
+            suffix = f'-{obj.pk}'
+            setattr(obj, field, value[:max_length - len(suffix)] + suffix)
+            obj.save(update_fields=[field])
+
+
+def merge_open_orders(Order):
+    '''Fold extra open carts of a user into their oldest one'''
+    users = (Order.objects.filter(ordered=False).values('user')
+             .annotate(carts=Count('pk')).filter(carts__gt=1)
+             .values_list('user', flat=True))
+    for user_id in list(users):
+        cart, *extras = Order.objects.filter(
+            user_id=user_id, ordered=False).order_by('pk')
+        for extra in extras:
+            cart.items.add(*extra.items.all())
+            extra.delete()
+
+
+def prepare_unique_values(apps, schema_editor):
+    Item = apps.get_model('main', 'Item')
+    Coupon = apps.get_model('main', 'Coupon')
+    Order = apps.get_model('main', 'Order')
+    dedupe(Item.objects.all(), 'slug', 50)
+    dedupe(Coupon.objects.all(), 'code', 15)
+    dedupe(Order.objects.exclude(ref_code=''), 'ref_code', 20)
+    merge_open_orders(Order)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0002_order_totals'),
+    ]
+
+    operations = [
+        migrations.RunPython(prepare_unique_values,
+                             migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='coupon',
+            name='code',
+            field=models.CharField(max_length=15, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='item',
+            name='slug',
+            field=models.SlugField(unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='address',
+            index=models.Index(fields=['user', 'address_type', 'default'], name='address_user_type_default_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', 'ordered'], name='order_user_ordered_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['ref_code'], name='order_ref_code_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='orderitem',
+            index=models.Index(fields=['user', 'item', 'ordered'], name='orderitem_user_item_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='order',
+            constraint=models.UniqueConstraint(condition=models.Q(ordered=False), fields=('user',), name='unique_open_order_per_user'),
+        ),
+        migrations.AddConstraint(
+            model_name='order',
+            constraint=models.UniqueConstraint(condition=models.Q(_negated=True, ref_code=''), fields=('ref_code',), name='unique_order_ref_code'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 2.2.28 on 2026-10-18 01:14
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def merge_open_lines(apps, schema_editor):
+    '''Fold duplicate open lines of a user and item into the oldest one'''
+    OrderItem = apps.get_model('main', 'OrderItem')
+    Order = apps.get_model('main', 'Order')
+    duplicates = (OrderItem.objects.filter(ordered=False)
+                  .values('user', 'item').annotate(lines=Count('pk'))
+                  .filter(lines__gt=1))
+    for group in list(duplicates):
+        kept, *extras = OrderItem.objects.filter(
+            user=group['user'], item=group['item'],
+            ordered=False).order_by('pk')
+        for extra in extras:
+            kept.quantity += extra.quantity
+            for order in Order.objects.filter(items=extra):
+                order.items.add(kept)
+            extra.delete()
+        kept.save(update_fields=['quantity'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0003_cart_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_open_lines, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='orderitem',
+            constraint=models.UniqueConstraint(condition=models.Q(ordered=False), fields=('user', 'item'), name='unique_open_line_per_user_item'),
+        ),
+    ]
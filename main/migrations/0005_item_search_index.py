@@ -0,0 +1,50 @@
+# Generated by Django 2.2.28 on 2026-10-18 01:24
+
+from django.db import migrations
+
+
+SQLITE_FORWARDS = [
+    "CREATE VIRTUAL TABLE main_item_fts USING fts5("
+    "title, description, tokenize='porter unicode61')",
+    "INSERT INTO main_item_fts(rowid, title, description) "
+    "SELECT id, title, description FROM main_item",
+]
+
+SQLITE_BACKWARDS = [
+    'DROP TABLE IF EXISTS main_item_fts',
+]
+
+# Must match main.search.POSTGRES_DOCUMENT for the index to be used
+POSTGRES_FORWARDS = [
+    "CREATE INDEX main_item_search_idx ON main_item USING GIN (("
+    "setweight(to_tsvector('english', coalesce(title, '')), 'A')"
+    " || setweight(to_tsvector('english', "
+    "coalesce(description, '')), 'B')))",
+]
+
+POSTGRES_BACKWARDS = [
+    'DROP INDEX IF EXISTS main_item_search_idx',
+]
+
+
+def run_for_vendor(statements):
+    def run(apps, schema_editor):
+        for statement in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(statement, params=None)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0004_unique_open_order_item'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run_for_vendor({'sqlite': SQLITE_FORWARDS,
+                            'postgresql': POSTGRES_FORWARDS}),
+            run_for_vendor({'sqlite': SQLITE_BACKWARDS,
+                            'postgresql': POSTGRES_BACKWARDS}),
+        ),
+    ]
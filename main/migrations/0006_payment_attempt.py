@@ -0,0 +1,43 @@
+# Generated by Django 2.2.28 on 2026-10-18 01:57
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import main.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('main', '0005_item_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentAttempt',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('idempotency_key', models.CharField(default=main.models.new_idempotency_key, max_length=32, unique=True)),
+                ('amount', models.FloatField()),
+                ('source', models.CharField(blank=True, max_length=255)),
+                ('status', models.CharField(choices=[('P', 'Pending'), ('S', 'Succeeded'), ('F', 'Failed')], default='P', max_length=1)),
+                ('tries', models.PositiveSmallIntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('charge_id', models.CharField(blank=True, max_length=50)),
+                ('error', models.TextField(blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='payment_attempts', to='main.Order')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='paymentattempt',
+            index=models.Index(fields=['status', 'next_attempt_at'], name='paymentattempt_due_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='paymentattempt',
+            constraint=models.UniqueConstraint(condition=models.Q(status__in=['P', 'S']), fields=('order',), name='unique_live_payment_attempt'),
+        ),
+    ]
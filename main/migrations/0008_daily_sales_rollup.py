@@ -0,0 +1,48 @@
+# Generated by Django 2.2.28 on 2026-10-18 02:23
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0007_orderitem_price_snapshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='rolled_up',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name='DailySales',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('category', models.CharField(choices=[('S', 'Shirt'), ('SW', 'Sport wear'), ('OW', 'Outwear')], max_length=2)),
+                ('units', models.PositiveIntegerField(default=0)),
+                ('gross', models.FloatField(default=0)),
+                ('discounts', models.FloatField(default=0)),
+                ('coupons', models.FloatField(default=0)),
+                ('refunds', models.FloatField(default=0)),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='main.Item')),
+            ],
+            options={
+                'verbose_name_plural': 'Daily sales',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='dailysales',
+            index=models.Index(fields=['date', 'category'], name='dailysales_date_category_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='dailysales',
+            constraint=models.UniqueConstraint(fields=('date', 'item'), name='unique_daily_sales_item'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(('ordered', True), ('rolled_up', False)), fields=['id'], name='order_rollup_pending_idx'),
+        ),
+    ]
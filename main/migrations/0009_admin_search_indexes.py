@@ -0,0 +1,28 @@
+# Generated by Django 2.2.28 on 2026-10-18 02:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0008_daily_sales_rollup'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='address',
+            name='zip_address',
+            field=models.CharField(db_index=True, max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='stripe_charge_id',
+            field=models.CharField(db_index=True, max_length=50),
+        ),
+        migrations.AlterField(
+            model_name='paymentattempt',
+            name='charge_id',
+            field=models.CharField(blank=True, db_index=True, max_length=50),
+        ),
+    ]
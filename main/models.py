@@ -1,6 +1,13 @@
+import uuid
+from math import isclose
+
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
+from django.db.models import (Count, ExpressionWrapper, F, FloatField,
+                              OuterRef, Prefetch, Q, Subquery, Sum, Value)
+from django.db.models.functions import Coalesce, NullIf
 from django.shortcuts import reverse
+from django.utils import timezone
 from django_countries.fields import CountryField
 
 
@@ -21,6 +28,12 @@ ADDRESS_CHOICES = (
     ('B', 'Billing'),
 )
 
+PAYMENT_STATUS_CHOICES = (
+    ('P', 'Pending'),
+    ('S', 'Succeeded'),
+    ('F', 'Failed'),
+)
+
 
 class Item(models.Model):
     title = models.CharField(max_length=100)
@@ -28,13 +41,16 @@ class Item(models.Model):
     discount_price = models.FloatField(blank=True, null=True)
     category = models.CharField(choices=CATEGORY_CHOICES, max_length=2)
     label = models.CharField(choices=LABEL_CHOICES, max_length=1)
-    slug = models.SlugField()
+    slug = models.SlugField(unique=True)
     description = models.TextField()
     image = models.ImageField()
 
     def __str__(self):
         return self.title
 
+    def get_price(self):
+        return self.discount_price or self.price
+
     def get_absolute_url(self):
         '''"product" from name in urls'''
         return reverse('main:product', kwargs={
@@ -52,22 +68,151 @@ class Item(models.Model):
         })
 
 
+def effective_price_expression(prefix=''):
+    '''Database counterpart of Item.get_price()'''
+    return Coalesce(NullIf(f'{prefix}discount_price', Value(0)),
+                    f'{prefix}price')
+
+
+def line_total_expression(prefix=''):
+    '''Line total computed by the database: the snapshot taken when the
+    line was ordered, else the effective item price times quantity'''
+    price = effective_price_expression(f'{prefix}item__')
+    return Coalesce(
+        f'{prefix}line_total',
+        ExpressionWrapper(F(f'{prefix}quantity') * price,
+                          output_field=FloatField()))
+
+
+class OrderItemQuerySet(models.QuerySet):
+
+    def totals(self):
+        totals = self.aggregate(subtotal=Sum(line_total_expression()),
+                                line_count=Count('pk'))
+        return totals['subtotal'] or 0, totals['line_count']
+
+    def snapshot_prices(self, **changes):
+        '''Copy current item prices onto the lines in two UPDATEs'''
+        item = Item.objects.filter(pk=OuterRef('item_id'))
+        self.update(
+            list_price=Subquery(item.values('price')[:1]),
+            unit_price=Subquery(
+                item.values_list(effective_price_expression())[:1]),
+            **changes)
+        self.update(
+            line_total=ExpressionWrapper(
+                F('quantity') * F('unit_price'), output_field=FloatField()),
+            discount=ExpressionWrapper(
+                F('quantity') * (F('list_price') - F('unit_price')),
+                output_field=FloatField()))
+
+    def clear_snapshots(self):
+        '''Drop snapshotted prices so the lines follow the catalog again'''
+        self.update(list_price=None, unit_price=None, discount=None,
+                    line_total=None)
+
+    def backfill_snapshots(self, batch_size=500):
+        '''Snapshot ordered lines that predate price snapshots, in batches.
+
+        Their original prices are gone, so current prices are used.
+        Returns the number of lines updated.
+        '''
+        missing = self.filter(ordered=True, unit_price__isnull=True)
+        updated = last_pk = 0
+        while True:
+            pks = list(missing.filter(pk__gt=last_pk).order_by('pk')
+                       .values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                return updated
+            with transaction.atomic():
+                self.model.objects.filter(pk__in=pks).snapshot_prices()
+            updated += len(pks)
+            last_pk = pks[-1]
+
+    def revenue(self):
+        '''Units sold, revenue and discounts from the order lines alone'''
+        return self.filter(ordered=True).aggregate(
+            units=Coalesce(Sum('quantity'), Value(0)),
+            revenue=Coalesce(Sum('line_total'), Value(0.0)),
+            discounts=Coalesce(Sum('discount'), Value(0.0)),
+        )
+
+
 class OrderItem(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL,
                              on_delete=models.CASCADE)
     item = models.ForeignKey(Item, on_delete=models.CASCADE)
     quantity = models.IntegerField(default=1)
     ordered = models.BooleanField(default=False)
+    # Prices the line was ordered at, kept when the item is repriced: the
+    # list and paid price per unit, and the discount and total of the line
+    list_price = models.FloatField(blank=True, null=True)
+    unit_price = models.FloatField(blank=True, null=True)
+    discount = models.FloatField(blank=True, null=True)
+    line_total = models.FloatField(blank=True, null=True)
+
+    objects = OrderItemQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'item', 'ordered'],
+                         name='orderitem_user_item_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'item'], condition=Q(ordered=False),
+                name='unique_open_line_per_user_item'),
+        ]
 
     def __str__(self):
         return f'{self.quantity} of {self.item}'
 
     def get_total_item_price(self):
-        if self.item.discount_price:
-            price = self.item.discount_price
-        else:
-            price = self.item.price
-        return price * self.quantity
+        if self.line_total is not None:
+            return self.line_total
+        return self.item.get_price() * self.quantity
+
+
+class PaymentInProgress(Exception):
+    '''The order has a pending or successful payment and cannot change'''
+
+
+class OrderQuerySet(models.QuerySet):
+
+    def with_items(self):
+        '''Load lines with their items and the coupon in two queries'''
+        return self.select_related('coupon').prefetch_related(
+            Prefetch('items',
+                     queryset=OrderItem.objects.select_related('item')))
+
+    def with_computed_totals(self):
+        '''Annotate totals recomputed from the lines, for reconciliation'''
+        return self.annotate(
+            computed_subtotal=Coalesce(
+                Sum(line_total_expression('items__')), Value(0.0)),
+            computed_line_count=Count('items'),
+            computed_discount=Coalesce(F('coupon__amount'), Value(0.0)),
+        )
+
+    def rebuild_totals(self, batch_size=500):
+        '''Recompute stored totals in batches, writing only stale orders.
+
+        Returns the number of orders checked and the number updated.
+        '''
+        checked = updated = 0
+        last_pk = 0
+        while True:
+            batch = list(self.filter(pk__gt=last_pk).order_by('pk')
+                         .with_computed_totals()[:batch_size])
+            if not batch:
+                return checked, updated
+            stale = [order for order in batch if order.set_totals(
+                order.computed_subtotal, order.computed_discount,
+                order.computed_line_count)]
+            self.model.objects.bulk_update(stale, self.model.TOTAL_FIELDS)
+            checked += len(batch)
+            updated += len(stale)
+            last_pk = batch[-1].pk
 
 
 class Order(models.Model):
@@ -96,17 +241,105 @@ class Order(models.Model):
     received = models.BooleanField(default=False)
     refund_requested = models.BooleanField(default=False)
     refund_granted = models.BooleanField(default=False)
+    subtotal = models.FloatField(default=0)
+    discount = models.FloatField(default=0)
+    total = models.FloatField(default=0)
+    line_count = models.PositiveIntegerField(default=0)
+    # Counted in DailySales by main.reports
+    rolled_up = models.BooleanField(default=False)
+
+    objects = OrderQuerySet.as_manager()
+
+    TOTAL_FIELDS = ['subtotal', 'discount', 'total', 'line_count']
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'ordered'],
+                         name='order_user_ordered_idx'),
+            # Lookups by ref_code cannot use the partial unique index
+            models.Index(fields=['ref_code'], name='order_ref_code_idx'),
+            models.Index(fields=['id'], name='order_rollup_pending_idx',
+                         condition=Q(ordered=True, rolled_up=False)),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user'], condition=Q(ordered=False),
+                name='unique_open_order_per_user'),
+            models.UniqueConstraint(
+                fields=['ref_code'], condition=~Q(ref_code=''),
+                name='unique_order_ref_code'),
+        ]
 
     def __str__(self):
         return self.user.username
 
     def get_total(self):
-        total = 0
-        for order_item in self.items.all():
-            total += order_item.get_total_item_price()
-        if self.coupon:
-            total -= self.coupon.amount
-        return total
+        return self.total
+
+    def set_totals(self, subtotal, discount, line_count):
+        '''Assign totals in memory, returning whether any of them changed'''
+        changed = (
+            line_count != self.line_count
+            or not isclose(subtotal, self.subtotal, abs_tol=1e-9)
+            or not isclose(discount, self.discount, abs_tol=1e-9)
+        )
+        self.subtotal = subtotal
+        self.discount = discount
+        self.total = subtotal - discount
+        self.line_count = line_count
+        return changed
+
+    def refresh_totals(self):
+        subtotal, line_count = self.items.totals()
+        discount = self.coupon.amount if self.coupon_id else 0
+        self.set_totals(subtotal, discount, line_count)
+        self.save(update_fields=self.TOTAL_FIELDS)
+
+    def snapshot_prices(self):
+        '''Fix the prices of the lines and store the totals they add up to'''
+        OrderItem.objects.filter(order=self.pk).snapshot_prices()
+        self.refresh_totals()
+
+    def finalize(self, payment, ref_code):
+        '''Close the order with its payment in two queries.
+
+        Prices and totals were fixed by snapshot_prices() when the payment
+        was requested, so the lines are only marked ordered, however many
+        there are. Call it inside a transaction.
+        '''
+        OrderItem.objects.filter(order=self.pk).update(ordered=True)
+        self.ordered = True
+        self.payment = payment
+        self.ref_code = ref_code
+        Order.objects.filter(pk=self.pk).update(
+            ordered=True, payment=payment, ref_code=ref_code)
+
+    def adjust_totals(self, amount, lines=0):
+        '''Shift the stored totals in a single UPDATE.
+
+        The change is applied with F() expressions so concurrent cart
+        updates do not overwrite each other; the in-memory totals of this
+        instance are left as they were.
+        '''
+        Order.objects.filter(pk=self.pk).update(
+            subtotal=F('subtotal') + amount,
+            total=F('total') + amount,
+            line_count=F('line_count') + lines,
+        )
+
+    def apply_coupon(self, coupon):
+        '''Raises PaymentInProgress once a payment of the order is queued'''
+        updated = Order.objects.filter(pk=self.pk).exclude(
+            payment_attempts__status__in=PaymentAttempt.LIVE_STATUSES,
+        ).update(
+            coupon=coupon,
+            discount=coupon.amount,
+            total=F('subtotal') - coupon.amount,
+        )
+        if not updated:
+            raise PaymentInProgress
+        self.coupon = coupon
+        self.discount = coupon.amount
 
 
 class Address(models.Model):
@@ -115,7 +348,7 @@ class Address(models.Model):
     street_address = models.CharField(max_length=100)
     apartment_address = models.CharField(max_length=100)
     country = CountryField(multiple=False)
-    zip_address = models.CharField(max_length=100)
+    zip_address = models.CharField(max_length=100, db_index=True)
     address_type = models.CharField(choices=ADDRESS_CHOICES, max_length=1)
     default = models.BooleanField(default=False)
 
@@ -124,10 +357,14 @@ class Address(models.Model):
 
     class Meta:
         verbose_name_plural = 'Addresses'
+        indexes = [
+            models.Index(fields=['user', 'address_type', 'default'],
+                         name='address_user_type_default_idx'),
+        ]
 
 
 class Payment(models.Model):
-    stripe_charge_id = models.CharField(max_length=50)
+    stripe_charge_id = models.CharField(max_length=50, db_index=True)
     user = models.ForeignKey(settings.AUTH_USER_MODEL,
                              on_delete=models.SET_NULL, blank=True, null=True)
     amount = models.FloatField()
@@ -137,14 +374,86 @@ class Payment(models.Model):
         return self.user.username
 
 
+def new_idempotency_key():
+    return uuid.uuid4().hex
+
+
+class PaymentAttempt(models.Model):
+    '''A charge queued by PaymentView for a payment worker to perform'''
+    PENDING, SUCCEEDED, FAILED = 'P', 'S', 'F'
+    LIVE_STATUSES = [PENDING, SUCCEEDED]
+
+    order = models.ForeignKey(Order, on_delete=models.CASCADE,
+                              related_name='payment_attempts')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL,
+                             on_delete=models.CASCADE)
+    # Sent with every try, so the gateway charges at most once
+    idempotency_key = models.CharField(
+        max_length=32, unique=True, default=new_idempotency_key)
+    amount = models.FloatField()
+    source = models.CharField(max_length=255, blank=True)
+    status = models.CharField(choices=PAYMENT_STATUS_CHOICES, max_length=1,
+                              default=PENDING)
+    tries = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    charge_id = models.CharField(max_length=50, blank=True,
+                                 db_index=True)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'],
+                         name='paymentattempt_due_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['order'], condition=Q(status__in=['P', 'S']),
+                name='unique_live_payment_attempt'),
+        ]
+
+    def __str__(self):
+        return self.idempotency_key
+
+
 class Coupon(models.Model):
-    code = models.CharField(max_length=15)
+    code = models.CharField(max_length=15, unique=True)
     amount = models.FloatField()
 
     def __str__(self):
         return self.code
 
 
+class DailySales(models.Model):
+    '''Sales of one item on one day, rolled up by main.reports'''
+    date = models.DateField()
+    item = models.ForeignKey(Item, on_delete=models.CASCADE)
+    category = models.CharField(choices=CATEGORY_CHOICES, max_length=2)
+    units = models.PositiveIntegerField(default=0)
+    # Before the item's discount
+    gross = models.FloatField(default=0)
+    discounts = models.FloatField(default=0)
+    # The item's share of its orders' coupons
+    coupons = models.FloatField(default=0)
+    refunds = models.FloatField(default=0)
+
+    class Meta:
+        verbose_name_plural = 'Daily sales'
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'item'],
+                                    name='unique_daily_sales_item'),
+        ]
+        indexes = [
+            models.Index(fields=['date', 'category'],
+                         name='dailysales_date_category_idx'),
+        ]
+
+    ROLLUP_FIELDS = ['units', 'gross', 'discounts', 'coupons']
+
+    def __str__(self):
+        return f'{self.item} on {self.date}'
+
+
 class Refund(models.Model):
     order = models.ForeignKey('Order', on_delete=models.CASCADE)
     message = models.TextField()
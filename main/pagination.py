@@ -0,0 +1,128 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Max
+from django.utils.functional import cached_property
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def encode_cursor(value):
+    return urlsafe_b64encode(str(value).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        return urlsafe_b64decode(cursor + padding).decode()
+    except (BinasciiError, UnicodeDecodeError, ValueError):
+        raise InvalidCursor(cursor)
+
+
+class CursorPage:
+
+    def __init__(self, object_list, has_next, has_previous, key):
+        self.object_list = object_list
+        self.has_next_page = has_next
+        self.has_previous_page = has_previous
+        self.key = key
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self.has_next_page
+
+    def has_previous(self):
+        return self.has_previous_page
+
+    def has_other_pages(self):
+        return self.has_next_page or self.has_previous_page
+
+    @property
+    def next_cursor(self):
+        if self.has_next_page:
+            return encode_cursor(getattr(self.object_list[-1], self.key))
+
+    @property
+    def previous_cursor(self):
+        if self.has_previous_page:
+            return encode_cursor(getattr(self.object_list[0], self.key))
+
+
+class CursorPaginator:
+    '''Keyset pagination over a unique, indexed key.
+
+    Pages are found with ``key > cursor`` / ``key < cursor`` and a LIMIT,
+    so the cost of a page does not grow with its depth and no COUNT(*) is
+    ever issued.
+    '''
+
+    def __init__(self, object_list, per_page, key='pk'):
+        self.object_list = object_list
+        self.per_page = per_page
+        self.key = key
+
+    def page(self, after=None, before=None):
+        queryset = self.object_list
+        try:
+            if before:
+                queryset = queryset.filter(
+                    **{f'{self.key}__lt': decode_cursor(before)})
+            elif after:
+                queryset = queryset.filter(
+                    **{f'{self.key}__gt': decode_cursor(after)})
+        except (TypeError, ValueError):
+            raise InvalidCursor(before or after)
+
+        if before:
+            rows = list(queryset.order_by(f'-{self.key}')[:self.per_page + 1])
+            has_more = len(rows) > self.per_page
+            rows = rows[:self.per_page][::-1]
+            return CursorPage(rows, True, has_more, self.key)
+
+        rows = list(queryset.order_by(self.key)[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        return CursorPage(rows[:self.per_page], has_more, bool(after),
+                          self.key)
+
+
+def estimate_count(queryset):
+    '''Rows in the queryset's table, estimated without a COUNT(*)'''
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s',
+                           [queryset.model._meta.db_table])
+            row = cursor.fetchone()
+        if row and row[0] > 0:
+            return int(row[0])
+    # SQLite keeps no row counts; the highest key is an index lookup away
+    # and only overcounts by the rows deleted
+    return queryset.model._default_manager.using(queryset.db).aggregate(
+        highest=Max('pk'))['highest'] or 0
+
+
+class EstimatedCountPaginator(Paginator):
+    '''Paginator that estimates the size of whole large tables.
+
+    Counting every row of a big table costs more than the page itself, so
+    an unfiltered queryset above ``exact_count_limit`` rows is given the
+    table's estimated size. Filtered querysets are still counted exactly.
+    '''
+    exact_count_limit = 10000
+
+    @cached_property
+    def count(self):
+        if not self.object_list.query.where:
+            estimate = estimate_count(self.object_list)
+            if estimate > self.exact_count_limit:
+                return estimate
+        return self.object_list.count()
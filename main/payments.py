@@ -0,0 +1,251 @@
+import logging
+import random
+import string
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from math import isclose
+
+import stripe
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .cart import get_open_order, invalidate_cart_summary
+from .models import OrderItem, Payment, PaymentAttempt, PaymentInProgress
+
+
+logger = logging.getLogger('main.payments')
+
+
+class PaymentError(Exception):
+    '''A failed charge; ``retry`` tells whether trying again may succeed'''
+
+    def __init__(self, message, retry=False):
+        super().__init__(message)
+        self.retry = retry
+
+
+class StripeGateway:
+    '''Charges cards through Stripe'''
+
+    # Network trouble and Stripe's own errors are worth another try;
+    # declined cards and bad requests are not
+    RETRY_ERRORS = (stripe.error.APIConnectionError, stripe.error.APIError,
+                    stripe.error.RateLimitError)
+
+    def charge(self, amount, source, idempotency_key, description=''):
+        try:
+            charge = stripe.Charge.create(
+                amount=int(round(amount * 100)),  # cents
+                currency='usd',
+                source=source,
+                description=description,
+                idempotency_key=idempotency_key,
+                api_key=settings.STRIPE_SECRET_KEY,
+            )
+        except stripe.error.StripeError as error:
+            raise PaymentError(
+                error.user_message or str(error),
+                retry=isinstance(error, self.RETRY_ERRORS)) from error
+        return charge['id']
+
+
+class FakeGateway:
+    '''Local stand-in for Stripe.
+
+    Like Stripe, it answers a repeated idempotency key with the first
+    charge instead of making another. ``failures`` transient errors are
+    raised before anything is charged.
+    '''
+
+    DECLINED_SOURCES = {'tok_chargeDeclined'}
+
+    # Shared by every instance, as Stripe's records would be
+    charges = {}
+    lock = threading.Lock()
+
+    def __init__(self, failures=0):
+        self.failures = failures
+
+    def charge(self, amount, source, idempotency_key, description=''):
+        with self.lock:
+            if self.failures:
+                self.failures -= 1
+                raise PaymentError('The payment gateway timed out.',
+                                   retry=True)
+            if source in self.DECLINED_SOURCES:
+                raise PaymentError('Your card was declined.')
+            if idempotency_key not in self.charges:
+                self.charges[idempotency_key] = {
+                    'id': f'ch_fake_{uuid.uuid4().hex[:20]}',
+                    'amount': amount,
+                }
+            return self.charges[idempotency_key]['id']
+
+
+def get_gateway():
+    return import_string(settings.PAYMENT_GATEWAY)()
+
+
+def create_ref_code():
+    return ''.join(random.choices(
+        string.ascii_lowercase + string.digits, k=20))
+
+
+def request_payment(user, source):
+    '''Queue a charge of the total of the user's open order.
+
+    The order is locked like any cart change and frozen by the attempt,
+    so the cart cannot change until it fails. Prices are snapshotted in
+    the same transaction, so the amount charged is what the order closes
+    at even if the catalog changes before the worker gets to it. A
+    repeated submit gets back the pending or successful attempt instead
+    of queueing another charge. Raises Order.DoesNotExist when there is
+    no open order.
+    '''
+    with transaction.atomic():
+        try:
+            order = get_open_order(user)
+        except PaymentInProgress:
+            return PaymentAttempt.objects.get(
+                order__user=user, order__ordered=False,
+                status__in=PaymentAttempt.LIVE_STATUSES)
+        # Charge current prices even if the catalog changed mid-checkout
+        order.snapshot_prices()
+        attempt = PaymentAttempt.objects.create(
+            order=order, user_id=order.user_id,
+            amount=order.get_total(), source=source)
+    transaction.on_commit(lambda: submit(attempt.pk))
+    return attempt
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def submit(pk, delay=0):
+    '''Hand an attempt to this process's payment threads, if it has any'''
+    if not settings.PAYMENT_WORKER_THREADS:
+        return
+    if delay > 0:
+        timer = threading.Timer(delay, submit, args=[pk])
+        timer.daemon = True
+        timer.start()
+        return
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.PAYMENT_WORKER_THREADS,
+                thread_name_prefix='payments')
+    _executor.submit(run_attempt, pk)
+
+
+def run_attempt(pk):
+    try:
+        attempt = process_attempt(pk)
+    except Exception:
+        logger.exception('Payment attempt %s failed to process.', pk)
+        # Try again once the lease the attempt may still hold runs out
+        submit(pk, settings.PAYMENT_LEASE)
+    else:
+        if attempt is not None and attempt.status == PaymentAttempt.PENDING:
+            submit(pk, (attempt.next_attempt_at - timezone.now())
+                   .total_seconds())
+    finally:
+        connection.close()
+
+
+def process_attempt(pk, gateway=None):
+    '''Charge a due attempt and record the outcome.
+
+    The attempt is claimed with a conditional UPDATE that also moves it a
+    lease into the future, so two workers never charge it at once and one
+    that dies mid-charge is retried when the lease runs out. Returns the
+    attempt, or None when it was not due.
+    '''
+    now = timezone.now()
+    claimed = PaymentAttempt.objects.filter(
+        pk=pk, status=PaymentAttempt.PENDING, next_attempt_at__lte=now,
+    ).update(tries=F('tries') + 1,
+             next_attempt_at=now + timedelta(seconds=settings.PAYMENT_LEASE))
+    if not claimed:
+        return None
+    attempt = PaymentAttempt.objects.select_related(
+        'user', 'order__coupon').get(pk=pk)
+    gateway = gateway or get_gateway()
+    try:
+        charge_id = gateway.charge(
+            attempt.amount, attempt.source, attempt.idempotency_key,
+            description=f'Order {attempt.order_id}')
+    except PaymentError as error:
+        attempt.error = str(error)
+        if error.retry and attempt.tries < settings.PAYMENT_MAX_TRIES:
+            attempt.next_attempt_at = timezone.now() + backoff(attempt.tries)
+        else:
+            attempt.status = PaymentAttempt.FAILED
+        with transaction.atomic():
+            attempt.save(
+                update_fields=['status', 'error', 'next_attempt_at'])
+            if attempt.status == PaymentAttempt.FAILED:
+                release_cart(attempt)
+        return attempt
+    finalize_payment(attempt, charge_id)
+    return attempt
+
+
+def backoff(tries):
+    '''Exponential delay after the given number of tries, with jitter'''
+    delay = min(settings.PAYMENT_RETRY_DELAY * 2 ** (tries - 1),
+                settings.PAYMENT_MAX_RETRY_DELAY)
+    return timedelta(seconds=random.uniform(delay / 2, delay))
+
+
+def finalize_payment(attempt, charge_id):
+    '''Record a successful charge and close its order in one transaction.
+
+    An order whose lines no longer total the amount charged is left open
+    and the attempt failed with its charge kept, to be refunded by hand.
+    '''
+    order = attempt.order
+    subtotal, _ = OrderItem.objects.filter(order=order).totals()
+    total = subtotal - (order.coupon.amount if order.coupon_id else 0)
+    with transaction.atomic():
+        if isclose(total, attempt.amount, abs_tol=0.005):
+            payment = Payment.objects.create(
+                stripe_charge_id=charge_id, user_id=attempt.user_id,
+                amount=attempt.amount)
+            order.finalize(payment, create_ref_code())
+            attempt.status = PaymentAttempt.SUCCEEDED
+            attempt.error = ''
+        else:
+            logger.error(
+                'Payment attempt %s charged %s but order %s totals %s.',
+                attempt.pk, attempt.amount, order.pk, total)
+            attempt.status = PaymentAttempt.FAILED
+            attempt.error = ('Your order changed while it was being paid '
+                             'for. Please contact us about the charge.')
+            release_cart(attempt)
+        attempt.charge_id = charge_id
+        attempt.save(update_fields=['status', 'charge_id', 'error'])
+    invalidate_cart_summary(attempt.user)
+
+
+def release_cart(attempt):
+    '''Let the cart of a failed attempt follow the catalog again'''
+    OrderItem.objects.filter(order=attempt.order_id).clear_snapshots()
+    attempt.order.refresh_totals()
+    transaction.on_commit(lambda: invalidate_cart_summary(attempt.user))
+
+
+def process_due_payments(limit=100, gateway=None):
+    '''Process up to ``limit`` attempts whose next try is due'''
+    due = PaymentAttempt.objects.filter(
+        status=PaymentAttempt.PENDING, next_attempt_at__lte=timezone.now(),
+    ).order_by('next_attempt_at').values_list('pk', flat=True)[:limit]
+    processed = (process_attempt(pk, gateway) for pk in list(due))
+    return [attempt for attempt in processed if attempt is not None]
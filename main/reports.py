@@ -0,0 +1,166 @@
+from functools import reduce
+from math import isclose
+from operator import or_
+
+from django.db import transaction
+from django.db.models import (Case, ExpressionWrapper, F, FloatField, Q, Sum,
+                              Value, When)
+from django.db.models.functions import Coalesce
+
+from .models import (CATEGORY_CHOICES, DailySales, OrderItem, Order,
+                     line_total_expression)
+
+
+REPORT_GROUPS = {
+    'day': ['date'],
+    'category': ['category'],
+    'item': ['item_id', 'item__title'],
+}
+
+REPORT_COLUMNS = ['units', 'gross', 'discounts', 'coupons', 'refunds', 'net']
+
+
+def coupon_share_expression():
+    '''A line's share of its order's coupon, pro rata to the line total'''
+    return Case(
+        When(order__subtotal__gt=0, then=ExpressionWrapper(
+            F('order__discount') * line_total_expression()
+            / F('order__subtotal'), output_field=FloatField())),
+        default=Value(0.0), output_field=FloatField())
+
+
+def group_lines(orders, **aggregates):
+    '''Aggregate the lines of paid orders per payment date and item'''
+    # Selecting the lines by key lets SQLite start from the orders instead
+    # of scanning every line ever ordered
+    lines = OrderItem.objects.filter(pk__in=Order.items.through.objects.filter(
+        order__in=orders).values('orderitem_id'))
+    return list(lines.values(
+        'item_id', date=F('order__payment__timestamp'),
+        category=F('item__category'),
+    ).annotate(**aggregates).order_by())
+
+
+def rollup_daily_sales(batch_size=1000):
+    '''Add the lines of paid orders not rolled up yet to DailySales.
+
+    Each batch of orders is locked and flagged rolled up in the
+    transaction that counts it, so an interrupted run resumes where it
+    stopped without counting anything twice. A flag rather than a
+    position in the payments also picks up orders whose payment
+    committed after a later one. Returns the number of orders.
+    '''
+    pending = Order.objects.filter(
+        ordered=True, rolled_up=False, payment__isnull=False)
+    rolled_up = 0
+    while True:
+        with transaction.atomic():
+            pks = list(pending.select_for_update().order_by(
+                'pk').values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                return rolled_up
+            orders = Order.objects.filter(pk__in=pks)
+            line_total = line_total_expression()
+            discount = Coalesce('discount', Value(0.0))
+            merge_rollups(group_lines(
+                orders,
+                units=Sum('quantity'),
+                gross=Sum(ExpressionWrapper(line_total + discount,
+                                            output_field=FloatField())),
+                discounts=Sum(discount),
+                coupons=Sum(coupon_share_expression()),
+            ))
+            orders.update(rolled_up=True)
+        rolled_up += len(pks)
+
+
+def merge_rollups(rows):
+    existing = {(sales.date, sales.item_id): sales
+                for sales in DailySales.objects.filter(
+                    date__in={row['date'] for row in rows},
+                    item_id__in={row['item_id'] for row in rows})}
+    changed, created = [], []
+    for row in rows:
+        sales = existing.get((row['date'], row['item_id']))
+        if sales is None:
+            created.append(DailySales(**row))
+            continue
+        # Added in SQL, so runs over other orders cannot overwrite it
+        for field in DailySales.ROLLUP_FIELDS:
+            setattr(sales, field, F(field) + row[field])
+        changed.append(sales)
+    DailySales.objects.bulk_update(
+        changed, DailySales.ROLLUP_FIELDS, batch_size=500)
+    DailySales.objects.bulk_create(created, batch_size=500)
+
+
+def rollup_refunds():
+    '''Recompute the refunds of DailySales from refunded orders.
+
+    Refunds are granted long after payment and can be taken back, so
+    they are not counted once like sales, but refunded orders are few:
+    their lines are aggregated whole and only rows whose refunds changed
+    are written. Returns the number of rows written.
+    '''
+    rows = {(row['date'], row['item_id']): row for row in group_lines(
+        Order.objects.filter(refund_granted=True, payment__isnull=False),
+        refunds=Sum(ExpressionWrapper(
+            line_total_expression() - coupon_share_expression(),
+            output_field=FloatField())))}
+    current = {(date, item_id): refunds
+               for date, item_id, refunds in DailySales.objects.exclude(
+                   refunds=0).values_list('date', 'item_id', 'refunds')}
+    amounts = dict.fromkeys(current, 0)
+    amounts.update((key, row['refunds']) for key, row in rows.items())
+    stale = [key for key, amount in amounts.items()
+             if not isclose(current.get(key, 0), amount, abs_tol=1e-9)]
+    changed, created = [], []
+    # Chunked to keep the OR of pairs within SQLite's expression depth
+    for start in range(0, len(stale), 100):
+        keys = stale[start:start + 100]
+        existing = {(sales.date, sales.item_id): sales
+                    for sales in DailySales.objects.filter(reduce(or_, (
+                        Q(date=date, item_id=item_id)
+                        for date, item_id in keys)))}
+        for key in keys:
+            sales = existing.get(key)
+            if sales is None:
+                created.append(DailySales(**rows[key]))
+            else:
+                sales.refunds = amounts[key]
+                changed.append(sales)
+    DailySales.objects.bulk_update(changed, ['refunds'], batch_size=500)
+    DailySales.objects.bulk_create(created, batch_size=500)
+    return len(stale)
+
+
+def rebuild_rollups():
+    '''Drop every rollup so the next run starts from the first order'''
+    with transaction.atomic():
+        DailySales.objects.all().delete()
+        Order.objects.filter(rolled_up=True).update(rolled_up=False)
+
+
+def sales_report(start, end, group='day'):
+    '''Sales between two dates, read from DailySales only'''
+    fields = REPORT_GROUPS[group]
+    rows = DailySales.objects.filter(date__range=(start, end)).values(
+        *fields).annotate(
+        units=Sum('units'),
+        gross=Sum('gross'),
+        discounts=Sum('discounts'),
+        coupons=Sum('coupons'),
+        refunds=Sum('refunds'),
+    ).order_by(*fields)
+    categories = dict(CATEGORY_CHOICES)
+    rows = list(rows)
+    for row in rows:
+        row['net'] = (row['gross'] - row['discounts'] - row['coupons']
+                      - row['refunds'])
+        if group == 'day':
+            row['label'] = row['date'].isoformat()
+        elif group == 'category':
+            row['label'] = categories.get(row['category'], row['category'])
+        else:
+            row['label'] = row['item__title']
+    return rows
@@ -0,0 +1,148 @@
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Count, Q
+from django.utils.module_loading import import_string
+
+from .models import Item
+
+
+SEARCH_TABLE = 'main_item_fts'
+
+# Weighted document used both by the PostgreSQL index and its queries;
+# the index is only used when the two expressions are identical
+POSTGRES_DOCUMENT = (
+    "setweight(to_tsvector('english', coalesce(main_item.title, '')), 'A')"
+    " || setweight(to_tsvector('english', "
+    "coalesce(main_item.description, '')), 'B')"
+)
+
+
+def search_terms(query):
+    return re.findall(r'\w+', query.lower())
+
+
+class SearchBackend:
+    '''Ranks items matching a free-text query.
+
+    ``search`` returns an Item queryset restricted to the matches and
+    ordered by relevance, so it can be filtered, paginated and counted
+    like any other queryset.
+    '''
+
+    def search(self, queryset, query):
+        raise NotImplementedError
+
+    def index_items(self, items):
+        '''(Re)index the items of a queryset; a no-op for live indexes'''
+
+    def remove_items(self, pks):
+        '''Drop deleted items from the index'''
+
+    def facets(self, queryset):
+        '''Count matches per category and per label in one grouped query'''
+        categories, labels = {}, {}
+        rows = (queryset.order_by().values_list('category', 'label')
+                .annotate(matches=Count('pk')))
+        for category, label, matches in rows:
+            categories[category] = categories.get(category, 0) + matches
+            labels[label] = labels.get(label, 0) + matches
+        return categories, labels
+
+
+class SQLiteFTS5Backend(SearchBackend):
+    '''BM25-ranked search over the ``main_item_fts`` FTS5 table.
+
+    The table is filled by the migration and kept in step with
+    ``main_item`` by the Item signals and the bulk catalog import.
+    '''
+
+    def index_items(self, items):
+        sql, params = items.values_list(
+            'pk', 'title', 'description').query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'DELETE FROM {SEARCH_TABLE} WHERE rowid IN '
+                f'(SELECT U0.id FROM ({sql}) U0)', params)
+            cursor.execute(
+                f'INSERT INTO {SEARCH_TABLE}(rowid, title, description) '
+                f'{sql}', params)
+
+    def remove_items(self, pks):
+        pks = list(pks)
+        if pks:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'DELETE FROM {SEARCH_TABLE} WHERE rowid IN '
+                    f'({", ".join(["%s"] * len(pks))})', pks)
+
+    def search(self, queryset, query):
+        terms = search_terms(query)
+        if not terms:
+            return queryset.none()
+        # Quote every term so user input can't form FTS5 syntax; the last
+        # one is a prefix so results update while the shopper types
+        match = ' '.join(f'"{term}"' for term in terms) + '*'
+        return queryset.extra(
+            tables=[SEARCH_TABLE],
+            where=[f'{SEARCH_TABLE}.rowid = main_item.id',
+                   f'{SEARCH_TABLE} MATCH %s'],
+            params=[match],
+            select={'rank': f'bm25({SEARCH_TABLE}, 10.0, 1.0)'},
+            order_by=['rank'],
+        )
+
+
+class PostgresSearchBackend(SearchBackend):
+    '''tsvector search backed by the ``main_item_search_idx`` GIN index'''
+
+    def search(self, queryset, query):
+        if not search_terms(query):
+            return queryset.none()
+        tsquery = "plainto_tsquery('english', %s)"
+        return queryset.extra(
+            where=[f'{POSTGRES_DOCUMENT} @@ {tsquery}'],
+            params=[query],
+            select={'rank': f'ts_rank({POSTGRES_DOCUMENT}, {tsquery})'},
+            select_params=[query],
+            order_by=['-rank'],
+        )
+
+
+class SimpleSearchBackend(SearchBackend):
+    '''Unindexed fallback for databases without a full-text backend'''
+
+    def search(self, queryset, query):
+        terms = search_terms(query)
+        if not terms:
+            return queryset.none()
+        for term in terms:
+            queryset = queryset.filter(
+                Q(title__icontains=term) | Q(description__icontains=term))
+        return queryset.order_by('title')
+
+
+VENDOR_BACKENDS = {
+    'sqlite': SQLiteFTS5Backend,
+    'postgresql': PostgresSearchBackend,
+}
+
+
+def get_search_backend():
+    backend = getattr(settings, 'SEARCH_BACKEND', None)
+    if backend:
+        return import_string(backend)()
+    return VENDOR_BACKENDS.get(connection.vendor, SimpleSearchBackend)()
+
+
+def search_items(query, category=None, label=None):
+    '''Ranked matches for ``query`` plus facet counts for all matches'''
+    backend = get_search_backend()
+    matches = backend.search(Item.objects.all(), query)
+    categories, labels = backend.facets(matches)
+    if category:
+        matches = matches.filter(category=category)
+    if label:
+        matches = matches.filter(label=label)
+    return matches, categories, labels
@@ -0,0 +1,216 @@
+import mimetypes
+import os
+import re
+import stat
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import (FileResponse, Http404, HttpResponse,
+                         HttpResponseNotModified)
+from django.urls import re_path
+from django.utils._os import safe_join
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date
+from django.views.decorators.http import require_safe
+
+
+# ManifestStaticFilesStorage puts a 12 character MD5 prefix in the name
+HASHED_NAME_RE = re.compile(r'\.[0-9a-f]{12}\.[^/]+$')
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+def make_etag(stat_result, encoding=None):
+    etag = f'{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}'
+    return f'"{etag}-{encoding}"' if encoding else f'"{etag}"'
+
+
+def etag_matches(request, etag):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+    return any(candidate.strip() in (etag, f'W/{etag}', '*')
+               for candidate in if_none_match.split(','))
+
+
+def parse_accept_encoding(header):
+    '''Map each coding of an ``Accept-Encoding`` header to its q-value'''
+    codings = {}
+    for part in (header or '').split(','):
+        coding, *params = [value.strip() for value in part.split(';')]
+        if not coding:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        codings[coding.lower()] = q
+    return codings
+
+
+def accepted_encodings(header):
+    '''Names in ENCODINGS the client accepts, most preferred first'''
+    codings = parse_accept_encoding(header)
+    wildcard = codings.get('*', 0.0)
+    weights = [(codings.get(name, wildcard), name) for name, _ in ENCODINGS]
+    # sorted() is stable, so equal weights keep the order of ENCODINGS
+    return [name for q, name in sorted(weights, key=lambda weight: -weight[0])
+            if q > 0]
+
+
+def parse_range(header, size):
+    '''Byte offsets of a single-range ``Range`` header, or None to ignore.
+
+    Raises ValueError when the range cannot be satisfied.
+    '''
+    match = RANGE_RE.match(header or '')
+    if not match or match.groups() == ('', ''):
+        return None
+    start, end = match.groups()
+    if not start:
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start = int(start)
+        end = min(int(end), size - 1) if end else size - 1
+    if start > end or start >= size:
+        raise ValueError
+    return start, end
+
+
+def serve_file(request, root, path, cache_control, encodings=False):
+    '''Serve ``path`` below ``root`` with validators and range support.
+
+    With ``encodings`` a precompressed ``.br``/``.gz`` sibling is served
+    when the client accepts it. When ``SENDFILE_HEADER`` is set the body
+    is left to the front-end server, e.g. nginx with X-Accel-Redirect.
+    '''
+    try:
+        full_path = safe_join(root, path)
+    except SuspiciousFileOperation:
+        raise Http404
+    content_type, _ = mimetypes.guess_type(full_path)
+    encoding = None
+    if encodings:
+        suffixes = dict(ENCODINGS)
+        for name in accepted_encodings(
+                request.META.get('HTTP_ACCEPT_ENCODING')):
+            if os.path.isfile(full_path + suffixes[name]):
+                full_path, encoding = full_path + suffixes[name], name
+                break
+    try:
+        stat_result = os.stat(full_path)
+    except OSError:
+        raise Http404
+    if not stat.S_ISREG(stat_result.st_mode):
+        raise Http404
+    etag = make_etag(stat_result, encoding)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(stat_result.st_mtime),
+        'Cache-Control': cache_control,
+        'Accept-Ranges': 'bytes',
+    }
+    if etag_matches(request, etag):
+        response = HttpResponseNotModified()
+    else:
+        response = file_response(request, full_path, stat_result.st_size,
+                                 content_type, encoding)
+    for header, value in headers.items():
+        response[header] = value
+    if encodings:
+        patch_vary_headers(response, ['Accept-Encoding'])
+    return response
+
+
+def file_response(request, full_path, size, content_type, encoding):
+    try:
+        byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+    except ValueError:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+    start, end = byte_range or (0, size - 1)
+    sendfile_header = getattr(settings, 'SENDFILE_HEADER', None)
+    if sendfile_header and not byte_range:
+        # The front-end server streams the file, ranges included
+        response = HttpResponse(
+            content_type=content_type or 'application/octet-stream')
+        response[sendfile_header] = sendfile_location(full_path)
+    else:
+        f = open(full_path, 'rb')
+        f.seek(start)
+        response = FileResponse(
+            LimitedReader(f, end - start + 1),
+            content_type=content_type or 'application/octet-stream')
+        response['Content-Length'] = end - start + 1
+    if byte_range:
+        response.status_code = 206
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    if encoding:
+        response['Content-Encoding'] = encoding
+    return response
+
+
+def sendfile_location(full_path):
+    '''Path handed to the front-end, optionally remapped to an internal URL'''
+    for root, prefix in getattr(settings, 'SENDFILE_ROOTS', {}).items():
+        root = os.path.join(root, '')
+        if full_path.startswith(root):
+            return prefix + full_path[len(root):]
+    return full_path
+
+
+class LimitedReader:
+    '''File wrapper returning at most ``remaining`` bytes'''
+
+    def __init__(self, f, remaining):
+        self.f = f
+        self.remaining = remaining
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+@require_safe
+def serve_static(request, path):
+    '''Collected static files; hashed names are cached for a year'''
+    cache_control = (IMMUTABLE_CACHE_CONTROL if HASHED_NAME_RE.search(path)
+                     else 'public, max-age=300')
+    return serve_file(request, settings.STATIC_ROOT, path, cache_control,
+                      encodings=True)
+
+
+@require_safe
+def serve_media(request, path):
+    max_age = getattr(settings, 'MEDIA_CACHE_MAX_AGE', 60 * 60 * 24)
+    return serve_file(request, settings.MEDIA_ROOT, path,
+                      f'public, max-age={max_age}')
+
+
+def asset_urlpatterns():
+    '''URLs for media and, in the production asset mode, static files.
+
+    Without PRODUCTION_ASSETS, runserver keeps serving static files
+    straight from the app directories.
+    '''
+    patterns = [
+        re_path(r'^%s(?P<path>.+)$' % re.escape(
+            settings.MEDIA_URL.lstrip('/')), serve_media),
+    ]
+    if settings.PRODUCTION_ASSETS:
+        patterns.append(re_path(r'^%s(?P<path>.+)$' % re.escape(
+            settings.STATIC_URL.lstrip('/')), serve_static))
+    return patterns
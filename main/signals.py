@@ -0,0 +1,69 @@
+from allauth.account.signals import user_logged_in
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from .cart import SessionCart, invalidate_cart_summaries, merge_lines
+from .catalog import bump_catalog_version
+from .models import Item, Order, PaymentInProgress
+from .search import get_search_backend
+
+
+@receiver(post_save, sender=Item)
+@receiver(post_delete, sender=Item)
+def invalidate_catalog_caches(sender, **kwargs):
+    bump_catalog_version()
+
+
+@receiver(post_save, sender=Item)
+def index_item(sender, instance, **kwargs):
+    get_search_backend().index_items(Item.objects.filter(pk=instance.pk))
+
+
+@receiver(post_delete, sender=Item)
+def unindex_item(sender, instance, **kwargs):
+    get_search_backend().remove_items([instance.pk])
+
+
+def open_orders_holding(item):
+    '''``{order pk: user pk}`` of the open carts with a line of ``item``'''
+    return dict(Order.objects.filter(
+        ordered=False, items__item=item).values_list('pk', 'user_id'))
+
+
+def rebuild_open_orders(affected):
+    if affected:
+        Order.objects.filter(pk__in=affected).rebuild_totals()
+        invalidate_cart_summaries(set(affected.values()))
+
+
+@receiver(post_save, sender=Item)
+def refresh_open_order_totals(sender, instance, created, raw, **kwargs):
+    '''Keep stored totals of open carts in line with repriced items'''
+    if created or raw:
+        return
+    rebuild_open_orders(open_orders_holding(instance))
+
+
+@receiver(pre_delete, sender=Item)
+def collect_open_orders(sender, instance, **kwargs):
+    '''Note the open carts whose lines the deletion cascades away'''
+    instance._open_orders = open_orders_holding(instance)
+
+
+@receiver(post_delete, sender=Item)
+def refresh_emptied_order_totals(sender, instance, **kwargs):
+    '''Re-total the carts noted by collect_open_orders without the lines'''
+    rebuild_open_orders(getattr(instance, '_open_orders', None))
+
+
+@receiver(user_logged_in)
+def merge_session_cart(sender, request, user, **kwargs):
+    '''Move what was put in the cart before logging in to the user's order'''
+    session_cart = SessionCart(request.session)
+    if session_cart:
+        try:
+            merge_lines(user, session_cart.lines)
+        except PaymentInProgress:
+            # Kept for the next login rather than changing a paid cart
+            return
+        session_cart.clear()
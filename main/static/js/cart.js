@@ -0,0 +1,55 @@
+// Cart buttons marked with data-cart-slug/data-cart-delta update the cart
+// in place. Clicks made within a short window are coalesced into a single
+// batched request to the cart API; if it fails, the last clicked link is
+// followed as it would have been without this script.
+(function ($) {
+  var badge = $('#cart-count');
+  var pending = {};
+  var timer = null;
+  var fallback = null;
+  var DELAY = 300;
+
+  if (!badge.length) {
+    return;
+  }
+
+  function getCookie(name) {
+    var match = document.cookie.match('(^|;)\\s*' + name + '=([^;]*)');
+    return match ? decodeURIComponent(match[2]) : null;
+  }
+
+  function flush() {
+    var operations = $.map(pending, function (delta, slug) {
+      return {slug: slug, delta: delta};
+    });
+    pending = {};
+    timer = null;
+    if (!operations.length) {
+      return;
+    }
+    $.ajax({
+      url: badge.data('cart-api'),
+      method: 'POST',
+      contentType: 'application/json',
+      data: JSON.stringify({operations: operations}),
+      headers: {'X-CSRFToken': getCookie('csrftoken')}
+    }).done(function (cart) {
+      badge.text(cart.count);
+      $(document).trigger('cart:updated', [cart]);
+    }).fail(function () {
+      if (fallback) {
+        window.location.href = fallback;
+      }
+    });
+  }
+
+  $(document).on('click', '[data-cart-slug]', function (event) {
+    var button = $(this);
+    var slug = button.data('cart-slug');
+    event.preventDefault();
+    fallback = button.attr('href') || fallback;
+    pending[slug] = (pending[slug] || 0) + Number(button.data('cart-delta'));
+    clearTimeout(timer);
+    timer = setTimeout(flush, DELAY);
+  });
+})(jQuery);
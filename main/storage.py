@@ -0,0 +1,50 @@
+import gzip
+import os
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.files.base import ContentFile
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.svg', '.txt', '.json', '.map',
+                           '.xml', '.html', '.eot', '.ttf', '.otf'}
+
+# Compressing tiny files gains nothing over the response headers
+MIN_COMPRESS_SIZE = 512
+
+
+def compressed_variants(content):
+    '''``[(suffix, data)]`` of the encodings worth storing for ``content``'''
+    variants = [('.gz', gzip.compress(content, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.append(('.br', brotli.compress(content)))
+    return [(suffix, data) for suffix, data in variants
+            if len(data) < len(content)]
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    '''Hashed static files with gzip (and brotli) copies next to them.
+
+    The copies are written during collectstatic, so serve_static only
+    has to pick the right file for the request's Accept-Encoding.
+    '''
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+        for name in list(self.hashed_files.values()):
+            if os.path.splitext(name)[1] not in COMPRESSIBLE_EXTENSIONS:
+                continue
+            with self.open(name) as f:
+                content = f.read()
+            if len(content) < MIN_COMPRESS_SIZE:
+                continue
+            for suffix, data in compressed_variants(content):
+                if self.exists(name + suffix):
+                    self.delete(name + suffix)
+                self.save(name + suffix, ContentFile(data))
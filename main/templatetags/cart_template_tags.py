@@ -1,5 +1,5 @@
 from django import template
-from main.models import Order
+from main.cart import get_cart_summary
 
 
 register = template.Library()
@@ -7,8 +7,4 @@ register = template.Library()
 
 @register.filter
 def cart_item_count(user):
-    if user.is_authenticated:
-        qs = Order.objects.filter(user=user, ordered=False)
-        if qs.exists():
-            return qs[0].items.count()
-    return 0
+    return get_cart_summary(user)['count']
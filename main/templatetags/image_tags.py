@@ -0,0 +1,20 @@
+from django import template
+from main.images import get_variant_sources
+
+
+register = template.Library()
+
+
+@register.inclusion_tag('responsive_image.html')
+def responsive_image(image, sizes='100vw', css_class='', alt=''):
+    '''Render ``image`` as a <picture> with WebP and JPEG srcsets'''
+    sources = get_variant_sources(image)
+    return {
+        'src': image.url if image else '',
+        # The last format is the JPEG every browser can decode
+        'sources': sources[:-1],
+        'srcset': sources[-1][1] if sources else '',
+        'sizes': sizes,
+        'css_class': css_class,
+        'alt': alt,
+    }
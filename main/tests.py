@@ -1,3 +1,1887 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import json
+import os
+import tempfile
+import time
+from io import BytesIO, StringIO
+from threading import Barrier, Thread
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+from django.test import (Client, LiveServerTestCase, RequestFactory,
+                         TestCase, TransactionTestCase, override_settings)
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+import stripe
+
+from . import cart
+from .asgi import WsgiToAsgi, get_asgi_application
+from .caching import (cache_stats, get_cache, get_or_compute,
+                      reset_cache_stats)
+from .cart import get_cart_summary
+from .catalog import get_catalog_facets
+from .images import generate_variants, variant_name
+from .loadtest import (ASGITestServer, HTTPClient, LoadStats, Shopper,
+                       compare)
+from .metrics import registry
+from .models import (Address, Coupon, DailySales, Item, Order, OrderItem,
+                     Payment, PaymentAttempt)
+from .pagination import (CursorPaginator, EstimatedCountPaginator,
+                         encode_cursor)
+from .payments import (FakeGateway, PaymentError, StripeGateway,
+                       process_due_payments)
+from .reports import rollup_daily_sales, rollup_refunds, sales_report
+from .search import get_search_backend, search_items
+from .serving import accepted_encodings, serve_static
+
+
+def clear_caches():
+    for alias in settings.CACHES:
+        caches[alias].clear()
+
+
+def create_item(slug='item', price=10.0, discount_price=None, **kwargs):
+    fields = {'title': slug.title(), 'category': 'S', 'label': 'P',
+              'description': 'Description', 'image': 'item.jpg'}
+    fields.update(kwargs)
+    return Item.objects.create(
+        slug=slug, price=price, discount_price=discount_price, **fields)
+
+
+def create_order(user, items=(), quantity=1, **kwargs):
+    order = Order.objects.create(
+        user=user, ordered_date=timezone.now(), **kwargs)
+    for item in items:
+        order.items.add(OrderItem.objects.create(
+            user=user, item=item, quantity=quantity))
+    order.refresh_totals()
+    return order
+
+
+class CartSummaryCacheTests(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        self.user = get_user_model().objects.create_user(
+            'shopper', 'shopper@example.com', 'password')
+        self.shirt = create_item('shirt', price=10.0)
+        self.jacket = create_item('jacket', price=50.0, discount_price=40.0)
+        create_order(self.user, [self.shirt, self.jacket], quantity=2)
+
+    def test_summary_counts_lines_and_subtotal(self):
+        summary = get_cart_summary(self.user)
+        self.assertEqual(summary['count'], 2)
+        self.assertEqual(summary['subtotal'], 100.0)
+
+    def test_warm_cache_costs_no_queries(self):
+        get_cart_summary(self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_cart_summary(self.user)['count'], 2)
+
+    def test_navbar_uses_cached_summary(self):
+        self.client.force_login(self.user)
+        get_cart_summary(self.user)
+        response = self.client.get(reverse('main:home'))
+        self.assertEqual(response.context['cart_summary']['count'], 2)
+
+    def test_cart_views_invalidate_summary(self):
+        self.client.force_login(self.user)
+        get_cart_summary(self.user)
+        self.client.get(reverse('main:remove-from-cart', args=['shirt']))
+        self.assertEqual(get_cart_summary(self.user)['count'], 1)
+        self.client.get(reverse('main:add-to-cart', args=['shirt']))
+        self.assertEqual(get_cart_summary(self.user)['count'], 2)
+        self.client.get(
+            reverse('main:remove-single-from-cart', args=['jacket']))
+        self.assertEqual(get_cart_summary(self.user)['subtotal'], 50.0)
+
+    def test_anonymous_user_has_empty_cart(self):
+        response = self.client.get(reverse('main:home'))
+        self.assertEqual(response.context['cart_summary']['count'], 0)
+
+
+class OrderTotalTests(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        self.user = get_user_model().objects.create_user(
+            'shopper', 'shopper@example.com', 'password')
+
+    def create_cart(self, size, **kwargs):
+        items = [
+            create_item(f'item-{size}-{n}', price=10.0, discount_price=8.0)
+            for n in range(size)]
+        return create_order(self.user, items, quantity=3, **kwargs)
+
+    def test_totals_are_aggregated_from_lines(self):
+        coupon = Coupon.objects.create(code='SAVE5', amount=5.0)
+        order = self.create_cart(4, coupon=coupon)
+        self.assertEqual(order.items.totals(), (96.0, 4))
+        order = Order.objects.get(pk=order.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(order.get_total(), 91.0)
+
+    def test_zero_discount_price_falls_back_to_price(self):
+        order = create_order(
+            self.user, [create_item('free', price=10.0, discount_price=0)])
+        self.assertEqual(order.get_total(), 10.0)
+        self.assertEqual(
+            Order.objects.with_items().get(pk=order.pk).get_total(), 10.0)
+
+    def count_page_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_summary_query_count_is_independent_of_cart_size(self):
+        self.client.force_login(self.user)
+        url = reverse('main:order-summary')
+        order = self.create_cart(1)
+        caches['carts'].clear()
+        small = self.count_page_queries(url)
+        order.delete()
+        self.create_cart(30)
+        caches['carts'].clear()
+        self.assertEqual(self.count_page_queries(url), small)
+
+
+class StoredOrderTotalsTests(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        self.user = get_user_model().objects.create_user(
+            'shopper', 'shopper@example.com', 'password')
+        self.client.force_login(self.user)
+        self.shirt = create_item('shirt', price=10.0)
+        self.jacket = create_item('jacket', price=50.0, discount_price=40.0)
+
+    def assertStoredTotals(self, subtotal, total, line_count):
+        order = Order.objects.get(user=self.user, ordered=False)
+        self.assertEqual(
+            (order.subtotal, order.total, order.line_count),
+            (subtotal, total, line_count))
+
+    def test_cart_views_maintain_totals(self):
+        self.client.get(reverse('main:add-to-cart', args=['shirt']))
+        self.client.get(reverse('main:add-to-cart', args=['jacket']))
+        self.client.get(reverse('main:add-to-cart', args=['jacket']))
+        self.assertStoredTotals(90.0, 90.0, 2)
+        self.client.get(
+            reverse('main:remove-single-from-cart', args=['jacket']))
+        self.assertStoredTotals(50.0, 50.0, 2)
+        self.client.get(reverse('main:remove-from-cart', args=['shirt']))
+        self.assertStoredTotals(40.0, 40.0, 1)
+
+    def test_coupon_view_maintains_total(self):
+        Coupon.objects.create(code='SAVE5', amount=5.0)
+        self.client.get(reverse('main:add-to-cart', args=['jacket']))
+        self.client.post(reverse('main:add-coupon'), {'code': 'SAVE5'})
+        self.assertStoredTotals(40.0, 35.0, 1)
+
+    def test_repricing_item_refreshes_open_carts(self):
+        self.client.get(reverse('main:add-to-cart', args=['shirt']))
+        self.shirt.price = 12.0
+        self.shirt.save()
+        self.assertStoredTotals(12.0, 12.0, 1)
+
+    def test_deleting_item_refreshes_open_carts(self):
+        self.client.get(reverse('main:add-to-cart', args=['shirt']))
+        self.client.get(reverse('main:add-to-cart', args=['jacket']))
+        self.assertEqual(get_cart_summary(self.user)['total'], 50.0)
+
+        self.jacket.delete()
+
+        self.assertStoredTotals(10.0, 10.0, 1)
+        self.assertEqual(get_cart_summary(self.user)['total'], 10.0)
+
+    def change_after_read(self, change):
+        '''Make a concurrent ``change`` land just after a view reads'''
+        get = Order.objects.get
+
+        def read(*args, **kwargs):
+            order = get(*args, **kwargs)
+            change(order)
+            return order
+        return mock.patch.object(Order.objects, 'get', side_effect=read)
+
+    def test_checkout_keeps_concurrent_cart_changes(self):
+        self.client.get(reverse('main:add-to-cart', args=['shirt']))
+        with self.change_after_read(
+                lambda order: cart.add_item(self.user, self.jacket)):
+            self.client.post(reverse('main:checkout'), {
+                'shipping_address': '1 New St', 'shipping_country': 'US',
+                'shipping_zip': '10002', 'same_shipping_address': 'on',
+                'payment_option': 'S'})
+        self.assertStoredTotals(50.0, 50.0, 2)
+        order = Order.objects.get(user=self.user, ordered=False)
+        self.assertEqual(order.billing_address.street_address, '1 New St')
+
+    def test_refund_request_keeps_concurrent_totals(self):
+        order = create_order(self.user, [self.shirt], ordered=True,
+                             ref_code='past')
+        with self.change_after_read(
+                lambda order: Order.objects.filter(pk=order.pk).update(
+                    total=F('total') - 1)):
+            self.client.post(reverse('main:refund-request'), {
+                'ref_code': 'past', 'message': 'Wrong size',
+                'email': 'shopper@example.com'})
+        order.refresh_from_db()
+        self.assertTrue(order.refund_requested)
+        self.assertEqual(order.total, 9.0)
+
+    def test_rebuild_command_fixes_only_stale_orders(self):
+        create_order(self.user, [self.shirt], ordered=True)
+        stale = create_order(self.user, [self.jacket], quantity=2)
+        Order.objects.filter(pk=stale.pk).update(subtotal=0, total=0)
+        out = StringIO()
+        call_command('rebuild_order_totals', batch_size=1, stdout=out)
+        self.assertIn('Checked 2 orders, updated 1', out.getvalue())
+        self.assertStoredTotals(80.0, 80.0, 1)
+
+
+class HomeGridCacheTests(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        self.items = [create_item(f'item-{n}') for n in range(12)]
+
+    def test_repeated_hits_are_served_from_cache(self):
+        self.client.get(reverse('main:home'))
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('main:home'))
+        self.assertContains(response, 'Item-0')
+
+    def test_pages_are_cached_separately(self):
+        self.client.get(reverse('main:home'))
+        response = self.client.get(reverse('main:home'), {'page': 2})
+        self.assertContains(response, '/product/item-11/')
+        self.assertNotContains(response, '/product/item-0/')
+
+    def test_page_spellings_share_one_entry(self):
+        self.client.get(reverse('main:home'), {'page': 2})
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('main:home'), {'page': '02'})
+        self.assertContains(response, '/product/item-11/')
+
+    def test_invalid_pages_are_not_found_before_caching(self):
+        for page in ('abc', '0', '-1'):
+            with self.assertNumQueries(0):
+                response = self.client.get(reverse('main:home'),
+                                           {'page': page})
+            self.assertEqual(response.status_code, 404)
+
+    def test_item_changes_are_visible_immediately(self):
+        self.client.get(reverse('main:home'))
+        self.items[0].title = 'Renamed'
+        self.items[0].save()
+        self.assertContains(self.client.get(reverse('main:home')), 'Renamed')
+        self.items[0].delete()
+        self.assertNotContains(
+            self.client.get(reverse('main:home')), 'Renamed')
+
+
+class HomeFilterTests(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        create_item('tee', price=15.0)
+        create_item('polo', price=30.0, discount_price=20.0, category='SW')
+        create_item('parka', price=120.0, category='OW')
+        create_item('coat', price=90.0, category='OW')
+
+    def get_slugs(self, **params):
+        response = self.client.get(reverse('main:home'), params)
+        return sorted(item.slug for item in response.context['object_list'])
+
+    def test_filters_use_the_effective_price(self):
+        self.assertEqual(self.get_slugs(price='under-25'), ['polo', 'tee'])
+        self.assertEqual(self.get_slugs(category='OW'), ['coat', 'parka'])
+        self.assertEqual(
+            self.get_slugs(category='OW', price='50-100'), ['coat'])
+        self.assertEqual(len(self.get_slugs(category='nope')), 4)
+
+    def test_facets_are_counted_in_one_query_and_cached(self):
+        with self.assertNumQueries(1):
+            facets = get_catalog_facets('OW')
+        self.assertEqual(facets['all'], 4)
+        self.assertEqual(facets['categories'],
+                         [('S', 'Shirt', 1), ('SW', 'Sport wear', 1),
+                          ('OW', 'Outwear', 2)])
+        self.assertEqual([count for *_, count in facets['price_ranges']],
+                         [0, 0, 1, 1])
+        with self.assertNumQueries(0):
+            get_catalog_facets('OW')
+
+    def test_filtered_grids_are_cached_separately(self):
+        self.client.get(reverse('main:home'), {'category': 'SW'})
+        self.client.get(reverse('main:home'), {'category': 'OW'})
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('main:home'),
+                                       {'category': 'OW'})
+        self.assertContains(response, '/product/parka/')
+        self.assertNotContains(response, '/product/polo/')
+
+
+class CursorPaginationTests(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        self.items = [create_item(f'item-{n}') for n in range(25)]
+
+    def get_page(self, **params):
+        response = self.client.get(reverse('main:home'), params)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_walks_forward_and_back_without_counting(self):
+        # Facet counts are cached on their own; only the grid is checked
+        get_catalog_facets()
+        with CaptureQueriesContext(connection) as queries:
+            first = self.get_page(after='')
+        self.assertFalse(any('COUNT' in q['sql'] for q in queries))
+        self.assertContains(first, '/product/item-9/')
+        page = CursorPaginator(Item.objects.all(), 10).page()
+        second = self.get_page(after=page.next_cursor)
+        self.assertContains(second, '/product/item-10/')
+        self.assertNotContains(second, '/product/item-9/')
+        page = CursorPaginator(Item.objects.all(), 10).page(
+            after=page.next_cursor)
+        back = self.get_page(before=page.previous_cursor)
+        self.assertContains(back, '/product/item-0/')
+        self.assertContains(back, '/product/item-9/')
+
+    def test_last_page_has_no_next_link(self):
+        page = CursorPaginator(Item.objects.all(), 10).page(
+            after=encode_cursor(self.items[19].pk))
+        self.assertEqual(len(page), 5)
+        self.assertFalse(page.has_next())
+        self.assertTrue(page.has_previous())
+
+    def test_invalid_cursor_is_not_found(self):
+        for after in ('!!', encode_cursor('item-9')):
+            with self.assertNumQueries(0):
+                response = self.client.get(reverse('main:home'),
+                                           {'after': after})
+            self.assertEqual(response.status_code, 404)
+
+    def test_cursor_spellings_share_one_entry(self):
+        pk = self.items[9].pk
+        self.get_page(after=encode_cursor(pk))
+        with self.assertNumQueries(0):
+            response = self.get_page(after=encode_cursor(f'0{pk}'),
+                                     before='')
+        self.assertContains(response, '/product/item-10/')
+
+
+@skipUnless(connection.vendor == 'sqlite', 'Plans are checked on SQLite')
+class CartLookupIndexTests(TestCase):
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = queryset.explain()
+        self.assertIn('SEARCH', plan)
+        self.assertIn(f'INDEX {index_name}', plan)
+
+    def test_open_order_lookup(self):
+        self.assertUsesIndex(
+            Order.objects.filter(user=1, ordered=False),
+            'order_user_ordered_idx')
+
+    def test_open_order_item_lookup(self):
+        self.assertUsesIndex(
+            OrderItem.objects.filter(user=1, item=1, ordered=False),
+            'orderitem_user_item_idx')
+
+    def test_default_address_lookup(self):
+        self.assertUsesIndex(
+            Address.objects.filter(user=1, address_type='S', default=True),
+            'address_user_type_default_idx')
+
+    def test_unique_key_lookups(self):
+        # SQLite names the indexes of UNIQUE columns itself
+        self.assertUsesIndex(Item.objects.filter(slug='shirt'),
+                             'sqlite_autoindex_main_item_1')
+        self.assertUsesIndex(Coupon.objects.filter(code='SAVE5'),
+                             'sqlite_autoindex_main_coupon_1')
+        self.assertUsesIndex(Order.objects.filter(ref_code='abc'),
+                             'order_ref_code_idx')
+
+    def test_partial_unique_constraints_are_named_indexes(self):
+        with connection.cursor() as cursor:
+            constraints = {
+                name: constraint for table in ('main_order', 'main_orderitem')
+                for name, constraint in connection.introspection
+                .get_constraints(cursor, table).items()}
+        for name, columns in (
+                ('unique_open_order_per_user', ['user_id']),
+                ('unique_order_ref_code', ['ref_code']),
+                ('unique_open_line_per_user_item', ['user_id', 'item_id'])):
+            self.assertTrue(constraints[name]['unique'])
+            self.assertTrue(constraints[name]['index'])
+            self.assertEqual(constraints[name]['columns'], columns)
+
+
+class CartConstraintTests(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            'shopper', 'shopper@example.com', 'password')
+
+    def test_one_open_order_per_user(self):
+        create_order(self.user, ordered=True)
+        create_order(self.user)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            create_order(self.user)
+
+    def test_ref_codes_are_unique_once_assigned(self):
+        create_order(self.user, ordered=True)
+        create_order(self.user, ordered=True, ref_code='abc')
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            create_order(self.user, ordered=True, ref_code='abc')
+
+    def test_slugs_and_coupon_codes_are_unique(self):
+        create_item('shirt')
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            create_item('shirt')
+        Coupon.objects.create(code='SAVE5', amount=5.0)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Coupon.objects.create(code='SAVE5', amount=1.0)
+
+
+class CartServiceTests(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        self.user = get_user_model().objects.create_user(
+            'shopper', 'shopper@example.com', 'password')
+        self.shirt = create_item('shirt', price=10.0)
+
+    def test_add_returns_new_cart_state(self):
+        update = cart.add_item(self.user, self.shirt)
+        self.assertTrue(update.created)
+        update = cart.add_item(self.user, self.shirt, quantity=2)
+        self.assertFalse(update.created)
+        self.assertEqual(update.summary['count'], 1)
+        self.assertEqual(update.summary['total'], 30.0)
+        self.assertEqual(OrderItem.objects.get().quantity, 3)
+
+    def test_adding_to_existing_line_is_a_few_queries(self):
+        cart.add_item(self.user, self.shirt)
+        with CaptureQueriesContext(connection) as queries:
+            cart.add_item(self.user, self.shirt)
+        statements = [query['sql'] for query in queries
+                      if 'SAVEPOINT' not in query['sql']]
+        self.assertLessEqual(len(statements), 4)
+
+    def test_remove_keeps_or_drops_the_line(self):
+        cart.add_item(self.user, self.shirt, quantity=2)
+        cart.remove_item(self.user, self.shirt, quantity=1, keep_line=True)
+        update = cart.remove_item(
+            self.user, self.shirt, quantity=1, keep_line=True)
+        self.assertEqual(OrderItem.objects.get().quantity, 1)
+        self.assertEqual(update.summary['total'], 10.0)
+        update = cart.remove_item(self.user, self.shirt, quantity=5)
+        self.assertFalse(OrderItem.objects.exists())
+        self.assertEqual(update.summary['count'], 0)
+
+    def test_remove_without_cart_or_line(self):
+        with self.assertRaises(Order.DoesNotExist):
+            cart.remove_item(self.user, self.shirt)
+        cart.add_item(self.user, create_item('jacket'))
+        with self.assertRaises(OrderItem.DoesNotExist):
+            cart.remove_item(self.user, self.shirt)
+
+
+class FileDatabaseMixin:
+    '''Run the test class on a database file instead of in memory.
+
+    Threads of an in-memory SQLite database fail as soon as one writes,
+    so, like load_test, the class gets a migrated temporary file.
+    '''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.memory_connection = None
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            # Closing the last connection would drop the in-memory database
+            cls.memory_connection = connection.connection
+            connection.connection = None
+            cls.directory = tempfile.TemporaryDirectory()
+            cls.memory_name = connection.settings_dict['NAME']
+            test_settings = connection.settings_dict['TEST']
+            test_name = test_settings['NAME']
+            test_settings['NAME'] = os.path.join(
+                cls.directory.name, 'test.sqlite3')
+            try:
+                connection.creation.create_test_db(
+                    verbosity=0, autoclobber=True, serialize=False)
+            finally:
+                test_settings['NAME'] = test_name
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        if cls.memory_connection is not None:
+            connection.creation.destroy_test_db(cls.memory_name, verbosity=0)
+            connection.connection = cls.memory_connection
+            cls.directory.cleanup()
+
+
+class ConcurrentAddToCartTests(FileDatabaseMixin, TransactionTestCase):
+    threads = 8
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            'shopper', 'shopper@example.com', 'password')
+        self.shirt = create_item('shirt', price=10.0)
+
+    def test_parallel_adds_keep_every_increment(self):
+        barrier = Barrier(self.threads)
+        errors = []
+
+        def add():
+            try:
+                barrier.wait()
+                cart.add_item(self.user, self.shirt)
+            except Exception as error:
+                errors.append(error)
+            finally:
+                connection.close()
+
+        workers = [Thread(target=add) for _ in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(errors, [])
+        order = Order.objects.get(user=self.user, ordered=False)
+        self.assertEqual(order.items.get().quantity, self.threads)
+        self.assertEqual(order.total, 10.0 * self.threads)
+        self.assertEqual(order.line_count, 1)
+
+
+class CartAPITests(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        self.user = get_user_model().objects.create_user(
+            'shopper', 'shopper@example.com', 'password')
+        self.client.force_login(self.user)
+        self.shirt = create_item('shirt', price=10.0)
+        self.jacket = create_item('jacket', price=50.0, discount_price=40.0)
+        self.url = reverse('main:cart-api')
+
+    def post(self, operations):
+        return self.client.post(
+            self.url, json.dumps({'operations': operations}),
+            content_type='application/json')
+
+    def test_batch_is_coalesced_and_applied(self):
+        response = self.post([
+            {'slug': 'shirt', 'delta': 1},
+            {'slug': 'jacket', 'delta': 2},
+            {'slug': 'shirt', 'delta': 2},
+            {'slug': 'jacket', 'delta': -1},
+        ])
+        self.assertEqual(response.status_code, 200)
+        state = response.json()
+        self.assertEqual(state['count'], 2)
+        self.assertEqual(state['total'], 70.0)
+        self.assertEqual(
+            [(line['slug'], line['quantity'], line['total'])
+             for line in state['lines']],
+            [('shirt', 3, 30.0), ('jacket', 1, 40.0)])
+        self.assertEqual(self.client.get(self.url).json(), state)
+
+    def test_removing_everything_drops_the_line(self):
+        self.post([{'slug': 'shirt', 'delta': 2}])
+        state = self.post([{'slug': 'shirt', 'delta': -5},
+                           {'slug': 'jacket', 'delta': -1}]).json()
+        self.assertEqual((state['lines'], state['total']), ([], 0))
+
+    def test_removing_without_cart_is_a_noop(self):
+        state = self.post([{'slug': 'shirt', 'delta': -1}]).json()
+        self.assertEqual(state['count'], 0)
+        self.assertFalse(Order.objects.exists())
+
+    def test_invalid_batches_change_nothing(self):
+        for operations in ([{'slug': 'shirt', 'delta': 1},
+                            {'slug': 'missing', 'delta': 1}],
+                           [{'slug': 'shirt', 'delta': '1'}],
+                           [{'slug': 'shirt'}],
+                           'shirt'):
+            self.assertEqual(self.post(operations).status_code, 400)
+        response = self.client.post(
+            self.url, 'not json', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(OrderItem.objects.exists())
+
+    def test_anonymous_batches_use_the_session_cart(self):
+        self.client.logout()
+        state = self.post([{'slug': 'shirt', 'delta': 2}]).json()
+        self.assertEqual((state['count'], state['total']), (1, 20.0))
+        self.assertEqual(self.client.get(self.url).json(), state)
+        self.assertFalse(Order.objects.exists())
+
+    def test_product_page_sets_the_csrf_cookie(self):
+        client = Client(enforce_csrf_checks=True)
+        client.get(self.shirt.get_absolute_url())
+        token = client.cookies['csrftoken'].value
+        response = client.post(
+            self.url, json.dumps({'operations': [
+                {'slug': 'shirt', 'delta': 1}]}),
+            content_type='application/json', HTTP_X_CSRFTOKEN=token)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['count'], 1)
+        response = Client(enforce_csrf_checks=True).post(
+            self.url, json.dumps({'operations': []}),
+            content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+
+
+class SessionCartTests(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        self.user = get_user_model().objects.create_user(
+            'shopper', 'shopper@example.com', 'password')
+        self.shirt = create_item('shirt', price=10.0)
+        self.jacket = create_item('jacket', price=50.0, discount_price=40.0)
+
+    def test_anonymous_cart_writes_no_order_rows(self):
+        self.client.get(reverse('main:add-to-cart', args=['shirt']))
+        self.client.get(reverse('main:add-to-cart', args=['shirt']))
+        self.client.get(reverse('main:add-to-cart', args=['jacket']))
+        self.client.get(
+            reverse('main:remove-single-from-cart', args=['shirt']))
+        self.assertFalse(OrderItem.objects.exists())
+        self.assertEqual(self.client.session['cart'],
+                         {'shirt': 1, 'jacket': 1})
+        response = self.client.get(reverse('main:order-summary'))
+        self.assertEqual(response.context['cart_summary']['count'], 2)
+        self.assertEqual(response.context['object'].get_total(), 50.0)
+
+    def test_removing_from_anonymous_cart(self):
+        url = reverse('main:remove-from-cart', args=['shirt'])
+        self.assertRedirects(
+            self.client.get(url), reverse('main:product', args=['shirt']))
+        self.client.get(reverse('main:add-to-cart', args=['shirt']))
+        self.assertRedirects(
+            self.client.get(url), reverse('main:order-summary'),
+            fetch_redirect_response=False)
+        self.assertEqual(self.client.session['cart'], {})
+
+    def test_session_cart_is_merged_on_login(self):
+        create_order(self.user, [self.shirt])
+        self.client.get(reverse('main:add-to-cart', args=['shirt']))
+        self.client.get(reverse('main:add-to-cart', args=['jacket']))
+        self.client.post(reverse('account_login'), {
+            'login': 'shopper', 'password': 'password'})
+        order = Order.objects.get(user=self.user, ordered=False)
+        self.assertEqual(
+            sorted(order.items.values_list('item__slug', 'quantity')),
+            [('jacket', 1), ('shirt', 2)])
+        self.assertEqual((order.total, order.line_count), (60.0, 2))
+        self.assertNotIn('cart', self.client.session)
+        self.assertEqual(get_cart_summary(self.user)['count'], 2)
+
+    def test_merge_starts_leftover_lines_over(self):
+        create_order(self.user, [self.shirt])
+        # An open line that is no longer in the order
+        OrderItem.objects.create(user=self.user, item=self.jacket,
+                                 quantity=7)
+        self.client.get(reverse('main:add-to-cart', args=['jacket']))
+        self.client.post(reverse('account_login'), {
+            'login': 'shopper', 'password': 'password'})
+        order = Order.objects.get(user=self.user, ordered=False)
+        self.assertEqual(
+            sorted(order.items.values_list('item__slug', 'quantity')),
+            [('jacket', 1), ('shirt', 1)])
+        self.assertEqual(order.total, 50.0)
+
+    def test_summary_follows_catalog_changes(self):
+        self.shirt.price = 0.1
+        self.shirt.save()
+        for _ in range(3):
+            self.client.get(reverse('main:add-to-cart', args=['shirt']))
+        self.client.get(reverse('main:add-to-cart', args=['jacket']))
+        summary = self.client.get(reverse('main:home')).context[
+            'cart_summary']
+        self.assertEqual((summary['count'], summary['total']), (2, 40.3))
+        self.shirt.price = 12.0
+        self.shirt.save()
+        self.jacket.delete()
+        summary = self.client.get(reverse('main:home')).context[
+            'cart_summary']
+        self.assertEqual((summary['count'], summary['total']), (1, 36.0))
+        self.assertEqual(self.client.session['cart'], {'shirt': 3})
+
+
+class CatalogImportExportTests(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def write(self, name, content):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def import_items(self, path, **options):
+        out, err = StringIO(), StringIO()
+        call_command('import_items', path, stdout=out, stderr=err, **options)
+        return out.getvalue(), err.getvalue()
+
+    def test_csv_import_creates_and_updates_by_slug(self):
+        user = get_user_model().objects.create_user('shopper')
+        create_order(user, [create_item('shirt', price=10.0)], quantity=2)
+        self.assertEqual(get_cart_summary(user)['total'], 20.0)
+        path = self.write('items.csv', (
+            'slug,title,price,discount_price,category,label,description,'
+            'image\n'
+            'shirt,Shirt,12,,S,P,A shirt,shirt.jpg\n'
+            'jacket,Jacket,50,40,OW,D,A jacket,jacket.jpg\n'
+            'coat,Coat,70,,OW,D,A coat,coat.jpg\n'))
+        out, _ = self.import_items(path, batch_size=2)
+        self.assertIn('Created 2, updated 1, unchanged 0, rejected 0', out)
+        self.assertEqual(Item.objects.get(slug='jacket').get_price(), 40.0)
+        self.assertEqual(Order.objects.get().total, 24.0)
+        self.assertEqual(get_cart_summary(user)['total'], 24.0)
+        out, _ = self.import_items(path)
+        self.assertIn('Created 0, updated 0, unchanged 3', out)
+
+    def test_invalid_rows_are_reported_and_skipped(self):
+        path = self.write('items.jsonl', '\n'.join([
+            json.dumps({'slug': 'shirt', 'title': 'Shirt', 'price': 10,
+                        'category': 'S', 'label': 'P',
+                        'description': 'A shirt', 'image': 'shirt.jpg'}),
+            json.dumps({'slug': 'bad slug', 'price': 'free',
+                        'category': 'X'}),
+            'not json',
+        ]))
+        out, err = self.import_items(path)
+        self.assertIn('Created 1, updated 0, unchanged 0, rejected 2', out)
+        self.assertIn('Line 2: title is required', err)
+        self.assertIn('price must be a number', err)
+        self.assertIn("unknown category 'X'", err)
+        with self.assertRaises(CommandError):
+            self.import_items(path, max_errors=1)
+
+    def test_export_round_trips_through_import(self):
+        create_item('shirt', price=10.0, discount_price=8.0)
+        create_item('jacket', price=50.0)
+        for fmt in ('csv', 'jsonl'):
+            path = os.path.join(self.directory.name, f'items.{fmt}')
+            call_command('export_items', path, format=fmt, stderr=StringIO())
+            Item.objects.all().delete()
+            self.import_items(path)
+            self.assertEqual(
+                sorted(Item.objects.values_list(
+                    'slug', 'price', 'discount_price')),
+                [('jacket', 50.0, None), ('shirt', 10.0, 8.0)])
+
+
+class SearchTests(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        self.parka = create_item('parka', category='OW', label='D')
+        self.parka_shirt = create_item(
+            'shirt', description='Goes well under a parka')
+        self.polo = create_item('polo', category='SW')
+
+    def slugs(self, query, **filters):
+        matches, _, _ = search_items(query, **filters)
+        return [item.slug for item in matches]
+
+    def test_title_matches_rank_first(self):
+        self.assertEqual(self.slugs('parka'), ['parka', 'shirt'])
+        self.assertEqual(self.slugs('Parka', category='S'), ['shirt'])
+        self.assertEqual(self.slugs(''), [])
+
+    def test_index_follows_saves_and_deletes(self):
+        self.polo.title = 'Rugby'
+        self.polo.save()
+        self.assertEqual(self.slugs('polo'), [])
+        self.assertEqual(self.slugs('rugby'), ['polo'])
+        self.polo.delete()
+        self.assertEqual(self.slugs('rugby'), [])
+
+    def test_imported_items_are_indexed(self):
+        path = os.path.join(tempfile.mkdtemp(), 'items.jsonl')
+        self.addCleanup(os.remove, path)
+        with open(path, 'w') as f:
+            f.write(json.dumps({
+                'slug': 'anorak', 'title': 'Anorak', 'price': 60,
+                'category': 'OW', 'label': 'P', 'description': 'Hooded',
+                'image': 'anorak.jpg'}))
+        call_command('import_items', path, stdout=StringIO())
+        self.assertEqual(self.slugs('hooded anorak'), ['anorak'])
+
+    def test_facets_come_from_one_grouped_query(self):
+        backend = get_search_backend()
+        matches = backend.search(Item.objects.all(), 'parka')
+        with self.assertNumQueries(1):
+            categories, labels = backend.facets(matches)
+        self.assertEqual(categories, {'OW': 1, 'S': 1})
+        self.assertEqual(labels, {'D': 1, 'P': 1})
+
+    @override_settings(SEARCH_BACKEND='main.search.SimpleSearchBackend')
+    def test_fallback_backend(self):
+        self.assertEqual(self.slugs('parka'), ['parka', 'shirt'])
+
+    def test_results_page(self):
+        response = self.client.get(
+            reverse('main:search'), {'q': 'parka "(', 'label': 'P'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.context['object_list']),
+                         [self.parka_shirt])
+        labels = dict(response.context['facet_groups'])['Label']
+        self.assertEqual([(facet['name'], facet['count'], facet['active'])
+                          for facet in labels],
+                         [('primary', 1, True), ('danger', 1, False)])
+
+
+class ImageVariantTests(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        media_root = self.settings(MEDIA_ROOT=media.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+
+    def upload(self, name, size=(800, 600)):
+        output = BytesIO()
+        Image.new('RGBA', size, 'red').save(output, 'PNG')
+        return default_storage.save(name, ContentFile(output.getvalue()))
+
+    def test_variants_are_generated_once_and_never_enlarged(self):
+        name = self.upload('shirt.png')
+        self.assertEqual(generate_variants(name), ([320, 640, 800], 6))
+        self.assertEqual(generate_variants(name), ([320, 640, 800], 0))
+        with default_storage.open(variant_name(name, 320, 'webp')) as f:
+            self.assertEqual(Image.open(f).size, (320, 240))
+        with default_storage.open(variant_name(name, 800, 'jpg')) as f:
+            self.assertEqual(Image.open(f).size, (800, 600))
+        self.assertFalse(
+            default_storage.exists(variant_name(name, 1024, 'jpg')))
+
+    def test_pages_render_srcsets(self):
+        item = create_item('shirt', image=self.upload('shirt.png'))
+        response = self.client.get(item.get_absolute_url())
+        self.assertContains(
+            response, '/media/variants/shirt-320w.webp 320w')
+        self.assertContains(response, '/media/variants/shirt-800w.jpg 800w')
+        self.assertNotContains(response, '1024w')
+        # Later renders read the widths from the cache, not the storage
+        with mock.patch('django.core.files.storage.FileSystemStorage.exists',
+                        side_effect=AssertionError):
+            self.assertContains(self.client.get(reverse('main:home')),
+                                'type="image/webp"')
+
+    def test_missing_source_falls_back_to_the_original(self):
+        item = create_item('ghost', image='ghost.jpg')
+        response = self.client.get(item.get_absolute_url())
+        self.assertContains(response, 'src="/media/ghost.jpg"')
+        self.assertNotContains(response, 'srcset')
+
+    def test_backfill_command(self):
+        for slug in ('shirt', 'parka'):
+            create_item(slug, image=self.upload(f'{slug}.png'))
+        create_item('ghost', image='ghost.jpg')
+        out, err = StringIO(), StringIO()
+        call_command('generate_image_variants', workers=2,
+                     stdout=out, stderr=err)
+        self.assertIn('Checked 3 images', out.getvalue())
+        self.assertIn('wrote 12 variants, 1 failed', out.getvalue())
+        self.assertIn('ghost.jpg', err.getvalue())
+        self.assertTrue(default_storage.exists('variants/parka-640w.jpg'))
+
+
+class AssetServingTests(TestCase):
+
+    def setUp(self):
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        self.root = root.name
+        roots = self.settings(MEDIA_ROOT=os.path.join(self.root, 'media'),
+                              STATIC_ROOT=os.path.join(self.root, 'static'))
+        roots.enable()
+        self.addCleanup(roots.disable)
+        os.mkdir(os.path.join(self.root, 'media'))
+        with open(os.path.join(self.root, 'media', 'shirt.jpg'), 'wb') as f:
+            f.write(bytes(range(256)) * 4)
+
+    def get_media(self, **headers):
+        return self.client.get('/media/shirt.jpg', **headers)
+
+    def test_media_revalidates_with_etag(self):
+        response = self.get_media()
+        self.assertEqual(response['Content-Length'], '1024')
+        self.assertIn('max-age=', response['Cache-Control'])
+        response = self.get_media(HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.client.get('/media/../secret').status_code, 404)
+
+    def test_media_byte_ranges(self):
+        response = self.get_media(HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/1024')
+        self.assertEqual(b''.join(response.streaming_content),
+                         bytes(range(10, 20)))
+        response = self.get_media(HTTP_RANGE='bytes=-4')
+        self.assertEqual(b''.join(response.streaming_content),
+                         bytes(range(252, 256)))
+        self.assertEqual(
+            self.get_media(HTTP_RANGE='bytes=2000-').status_code, 416)
+
+    @override_settings(SENDFILE_HEADER='X-Accel-Redirect')
+    def test_media_body_can_be_left_to_the_front_end(self):
+        with self.settings(SENDFILE_ROOTS={
+                os.path.join(self.root, 'media'): '/protected/'}):
+            response = self.get_media()
+        self.assertEqual(response['X-Accel-Redirect'], '/protected/shirt.jpg')
+        self.assertEqual(response.content, b'')
+
+    @override_settings(STATICFILES_STORAGE=(
+        'main.storage.CompressedManifestStaticFilesStorage'))
+    def test_collected_static_is_hashed_and_precompressed(self):
+        call_command('collectstatic', interactive=False, verbosity=0)
+        with open(os.path.join(settings.STATIC_ROOT,
+                               'staticfiles.json')) as f:
+            hashed = json.load(f)['paths']['css/mdb.min.css']
+        self.assertTrue(os.path.exists(
+            os.path.join(settings.STATIC_ROOT, hashed + '.gz')))
+        request = RequestFactory().get(
+            '/static/' + hashed, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        response = serve_static(request, hashed)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Content-Type'], 'text/css')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+
+    def test_encodings_follow_their_q_values(self):
+        for header, expected in (
+                ('gzip, deflate, br', ['br', 'gzip']),
+                ('gzip;q=1.0, br;q=0.5', ['gzip', 'br']),
+                ('br;q=0, gzip', ['gzip']),
+                ('gzip;q=0, *', ['br']),
+                ('*;q=0.5, br;q=0', ['gzip']),
+                ('identity', []), ('nobr, xgzip', []), ('', [])):
+            self.assertEqual(accepted_encodings(header), expected, header)
+
+
+class CacheLayerTests(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        reset_cache_stats()
+
+    def test_hits_and_misses_are_counted_per_alias(self):
+        user = get_user_model().objects.create_user('shopper')
+        get_cart_summary(user)
+        get_cart_summary(user)
+        self.assertEqual(cache_stats()['carts'], {'hits': 1, 'misses': 1})
+
+    def test_cold_miss_is_computed_once(self):
+        calls = []
+        barrier = Barrier(6)
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return 'grid'
+
+        def read():
+            barrier.wait()
+            results.append(get_or_compute('catalog', 'grid', compute, 60))
+
+        results = []
+        threads = [Thread(target=read) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['grid'] * 6)
+        self.assertEqual(len(calls), 1)
+
+    def test_entries_are_refreshed_early_near_expiry(self):
+        cache = get_cache('catalog')
+        cache.set('fresh', ('cached', 0.01, time.time() + 60))
+        cache.set('stale', ('cached', 1000, time.time() + 0.01))
+        self.assertEqual(
+            get_or_compute('catalog', 'fresh', lambda: 'new', 60), 'cached')
+        self.assertEqual(
+            get_or_compute('catalog', 'stale', lambda: 'new', 60), 'new')
+        self.assertEqual(cache.get('stale')[0], 'new')
+
+    def test_stats_are_staff_only(self):
+        url = reverse('main:cache-stats')
+        self.assertEqual(self.client.get(url).status_code, 302)
+        staff = get_user_model().objects.create_user(
+            'staff', password='password', is_staff=True)
+        self.client.force_login(staff)
+        get_cache('catalog').get('missing')
+        self.assertEqual(self.client.get(url).json()['caches']['catalog'],
+                         {'hits': 0, 'misses': 1})
+
+
+class SessionStorageTests(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        self.item = create_item('shirt')
+
+    def session_queries(self, *urls):
+        with CaptureQueriesContext(connection) as queries:
+            responses = [self.client.get(url, follow=True) for url in urls]
+        return responses, [query['sql'] for query in queries
+                           if 'django_session' in query['sql']]
+
+    def test_default_sessions_write_nothing_without_redis(self):
+        self.assertEqual(settings.SESSION_ENGINE,
+                         settings.SESSION_ENGINES['signed_cookies'])
+
+    @override_settings(
+        SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies')
+    def test_signed_cookie_sessions_never_touch_the_database(self):
+        responses, queries = self.session_queries(
+            reverse('main:add-to-cart', args=['shirt']),
+            reverse('main:order-summary'))
+        self.assertEqual(queries, [])
+        self.assertContains(responses[0], 'This item was added to your cart.')
+        self.assertEqual(responses[1].context['object'].line_count, 1)
+
+    @override_settings(
+        SESSION_ENGINE='django.contrib.sessions.backends.cached_db')
+    def test_cached_db_sessions_are_read_from_the_cache(self):
+        self.client.get(reverse('main:add-to-cart', args=['shirt']))
+        _, queries = self.session_queries(reverse('main:order-summary'))
+        self.assertEqual(queries, [])
+
+
+class PerformanceMiddlewareTests(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        registry.reset()
+        create_item('shirt')
+
+    def test_requests_are_attributed_to_their_view(self):
+        response = self.client.get(reverse('main:home'))
+        self.assertIn('db;dur=', response['Server-Timing'])
+        self.client.get(reverse('main:home'))
+        stats = registry.views['main:home']
+        self.assertEqual(stats.duration.count, 2)
+        self.assertGreater(stats.queries.sum, 0)
+        self.assertGreater(stats.template_seconds, 0)
+        self.assertGreater(stats.cache_hits, 0)
+        self.client.get('/no-such-page/')
+        self.assertIn('<unresolved>', registry.views)
+
+    @override_settings(SLOW_REQUEST_THRESHOLD=0)
+    def test_slow_requests_are_logged_with_their_queries(self):
+        with self.assertLogs('main.performance', 'WARNING') as logs:
+            self.client.get(reverse('main:product', args=['shirt']))
+        self.assertIn('(main:product)', logs.output[0])
+        self.assertIn('FROM "main_item"', logs.output[0])
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_prometheus_endpoint_needs_staff_or_token(self):
+        self.client.get(reverse('main:home'))
+        url = reverse('main:metrics')
+        self.assertEqual(self.client.get(url).status_code, 403)
+        response = self.client.get(url, HTTP_AUTHORIZATION='Bearer secret')
+        self.assertContains(response, 'main_request_duration_seconds_count'
+                                      '{view="main:home"} 1')
+        self.assertContains(response, 'main_cache_misses_total{cache=')
+
+
+@override_settings(SESSION_ENGINE='django.contrib.sessions.backends.cache')
+class QueryCountTests(TestCase):
+    '''Upper bounds on the queries of every view over realistic data.
+
+    The fixtures are large enough that a query per item, line or address
+    blows the bounds, so N+1 regressions fail here first. Sessions live in
+    the cache so only the application's own queries are counted.
+    '''
+    item_count = 300
+    line_count = 40
+    address_count = 30
+
+    @classmethod
+    def setUpTestData(cls):
+        Item.objects.bulk_create(
+            Item(title=f'Item {n}', price=10.0 + n % 90,
+                 discount_price=8.0 if n % 3 == 0 else None,
+                 category=('S', 'SW', 'OW')[n % 3], label='P',
+                 slug=f'item-{n}', description=f'Synthetic item {n}',
+                 image='item.jpg')
+            for n in range(cls.item_count))
+        get_search_backend().index_items(Item.objects.all())
+        cls.items = list(Item.objects.order_by('pk'))
+        cls.user = get_user_model().objects.create_user(
+            'shopper', 'shopper@example.com', 'password')
+        Address.objects.bulk_create(
+            Address(user=cls.user, street_address=f'{n} Main St',
+                    apartment_address='', country='US', zip_address='10001',
+                    address_type='SB'[n % 2], default=n < 2)
+            for n in range(cls.address_count))
+        for n in range(5):
+            past = create_order(cls.user, cls.items[n * 5:n * 5 + 5],
+                                ordered=True, ref_code=f'past-{n}')
+            past.items.update(ordered=True)
+        cls.order = create_order(
+            cls.user, cls.items[:cls.line_count], quantity=2,
+            billing_address=Address.objects.filter(address_type='B').first())
+        Coupon.objects.create(code='SAVE5', amount=5.0)
+
+    def setUp(self):
+        clear_caches()
+        self.client.force_login(self.user)
+
+    def assertMaxQueries(self, limit, method, url, data=None, **extra):
+        with CaptureQueriesContext(connection) as captured:
+            response = getattr(self.client, method)(url, data, **extra)
+        queries = [query['sql'] for query in captured
+                   if 'SAVEPOINT' not in query['sql']]
+        self.assertLessEqual(
+            len(queries), limit,
+            '\n'.join([f'{len(queries)} queries for {url}:'] + queries))
+        self.assertLess(response.status_code, 400)
+        return response
+
+    def test_home(self):
+        self.assertMaxQueries(5, 'get', reverse('main:home'))
+        self.assertMaxQueries(4, 'get', reverse('main:home'),
+                              {'category': 'OW', 'price': '50-100'})
+        self.assertMaxQueries(1, 'get', reverse('main:home'))
+
+    def test_product(self):
+        self.assertMaxQueries(
+            3, 'get', reverse('main:product', args=['item-7']))
+
+    def test_search(self):
+        self.assertMaxQueries(5, 'get', reverse('main:search'),
+                              {'q': 'synthetic', 'category': 'S'})
+
+    def test_order_summary(self):
+        self.assertMaxQueries(4, 'get', reverse('main:order-summary'))
+
+    def test_anonymous_order_summary(self):
+        self.client.logout()
+        session = self.client.session
+        session['cart'] = {item.slug: 1 for item in self.items[:40]}
+        session.save()
+        self.assertMaxQueries(1, 'get', reverse('main:order-summary'))
+
+    def test_checkout_get(self):
+        self.assertMaxQueries(6, 'get', reverse('main:checkout'))
+
+    def test_checkout_post_new_addresses(self):
+        self.assertMaxQueries(8, 'post', reverse('main:checkout'), {
+            'shipping_address': '1 New St', 'shipping_country': 'US',
+            'shipping_zip': '10002', 'set_default_shipping': 'on',
+            'same_shipping_address': 'on', 'payment_option': 'S'})
+
+    def test_checkout_post_default_addresses(self):
+        self.assertMaxQueries(8, 'post', reverse('main:checkout'), {
+            'use_default_shipping': 'on', 'use_default_billing': 'on',
+            'payment_option': 'S'})
+
+    def test_payment_get(self):
+        self.assertMaxQueries(
+            5, 'get', reverse('main:payment', args=['stripe']))
+
+    def test_payment_post(self):
+        # The submit locks the order and snapshots the prices
+        self.assertMaxQueries(
+            8, 'post', reverse('main:payment', args=['stripe']))
+        # The worker's charge and finalization do not grow with the lines
+        with CaptureQueriesContext(connection) as captured:
+            process_due_payments(gateway=FakeGateway())
+        self.assertLessEqual(len(
+            [query for query in captured if 'SAVEPOINT' not in query['sql']]
+        ), 8)
+        self.assertFalse(OrderItem.objects.filter(
+            order=self.order, ordered=False).exists())
+
+    def test_add_coupon(self):
+        self.assertMaxQueries(
+            4, 'post', reverse('main:add-coupon'), {'code': 'SAVE5'})
+
+    def test_cart_views(self):
+        slug = self.items[3].slug
+        self.assertMaxQueries(
+            6, 'get', reverse('main:add-to-cart', args=[slug]))
+        self.assertMaxQueries(
+            9, 'get', reverse('main:add-to-cart', args=['item-299']))
+        self.assertMaxQueries(
+            6, 'get', reverse('main:remove-single-from-cart', args=[slug]))
+        self.assertMaxQueries(
+            8, 'get', reverse('main:remove-from-cart', args=[slug]))
+
+    def test_cart_api(self):
+        operations = [{'slug': item.slug, 'delta': 1}
+                      for item in self.items[30:80]]
+        self.assertMaxQueries(3, 'get', reverse('main:cart-api'))
+        self.assertMaxQueries(
+            11, 'post', reverse('main:cart-api'),
+            json.dumps({'operations': operations}),
+            content_type='application/json')
+
+    def test_refund_request(self):
+        self.assertMaxQueries(2, 'get', reverse('main:refund-request'))
+        self.assertMaxQueries(4, 'post', reverse('main:refund-request'), {
+            'ref_code': 'past-3', 'message': 'Wrong size',
+            'email': 'shopper@example.com'})
+
+
+# The live server, payment and ASGI threads write concurrently, which an
+# in-memory SQLite database reports as an error instead of waiting
+class LoadTestTests(FileDatabaseMixin, LiveServerTestCase):
+
+    def setUp(self):
+        clear_caches()
+
+    def run_shopper(self, host, port):
+        slugs = [create_item(f'item-{n}', 10.0 + n).slug for n in range(12)]
+        stats = LoadStats()
+        client = HTTPClient(host, port, stats)
+        asyncio.run(Shopper(client, 1, slugs, seed=1).run(2))
+        return stats
+
+    def test_shopper_completes_every_purchase(self):
+        stats = self.run_shopper(
+            self.server_thread.host, self.server_thread.port)
+
+        self.assertEqual(stats.errors, {})
+        self.assertEqual(len(stats.timings['payment']), 4)
+        self.assertEqual(
+            Order.objects.filter(user__username='shopper-1',
+                                 ordered=True).count(), 2)
+        self.assertEqual(Address.objects.filter(default=True).count(), 2)
+
+    @override_settings(ALLOWED_HOSTS=['127.0.0.1'])
+    def test_shopper_completes_every_purchase_over_asgi(self):
+        with ASGITestServer(get_asgi_application(threads=2)) as server:
+            stats = self.run_shopper(server.host, server.port)
+
+        self.assertEqual(stats.errors, {})
+        self.assertEqual(
+            Order.objects.filter(ordered=True).count(), 2)
+
+    def test_asgi_adapter_passes_the_body_and_answers_lifespan(self):
+        def echo(environ, start_response):
+            start_response('201 Created', [('X-Path', environ['PATH_INFO'])])
+            return [environ['wsgi.input'].read(), b'!']
+
+        app = WsgiToAsgi(echo, threads=1)
+        sent = []
+
+        async def run(scope, messages):
+            async def receive():
+                return messages.pop(0)
+
+            async def send(message):
+                sent.append(message)
+            await app(scope, receive, send)
+
+        asyncio.run(run({'type': 'lifespan'}, [
+            {'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]))
+        app = WsgiToAsgi(echo, threads=1)
+        asyncio.run(run(
+            {'type': 'http', 'method': 'POST', 'path': '/caf\u00e9/',
+             'headers': [(b'content-type', b'text/plain')]},
+            [{'type': 'http.request', 'body': b'ab', 'more_body': True},
+             {'type': 'http.request', 'body': b'c'}]))
+
+        self.assertEqual([message['type'] for message in sent[:2]], [
+            'lifespan.startup.complete', 'lifespan.shutdown.complete'])
+        self.assertEqual(sent[2]['status'], 201)
+        self.assertEqual(sent[2]['headers'], [(b'x-path', b'/caf\xc3\xa9/')])
+        self.assertEqual(b''.join(m['body'] for m in sent[3:]), b'abc!')
+        self.assertFalse(sent[-1].get('more_body'))
+
+    def test_summary_percentiles_and_baseline_comparison(self):
+        stats = LoadStats()
+        for n in range(1, 101):
+            stats.record('home', n / 1000)
+        stats.record('checkout', 0.2, ok=False)
+
+        summary = stats.summary(elapsed=2.0)
+
+        self.assertEqual(summary['home']['p50'], 50.0)
+        self.assertEqual(summary['home']['p99'], 99.0)
+        self.assertEqual(summary['total']['requests'], 101)
+        self.assertEqual(summary['total']['errors'], 1)
+        self.assertEqual(summary['home']['throughput'], 50.0)
+        changes = compare(summary, {'home': dict(summary['home'], p95=47.5)})
+        self.assertEqual(changes, {'home': 1.0})
+
+
+class PaymentTests(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        FakeGateway.charges.clear()
+        self.user = get_user_model().objects.create_user(
+            'buyer', 'buyer@example.com', 'password')
+        self.client.force_login(self.user)
+        self.order = create_order(
+            self.user, [create_item('shirt', 10.0), create_item('hat', 5.0)],
+            quantity=2)
+        self.url = reverse('main:payment', args=['stripe'])
+
+    def pay(self, source='tok_visa'):
+        response = self.client.post(self.url, {'stripeToken': source})
+        return response, PaymentAttempt.objects.latest('pk')
+
+    def make_due(self, attempt):
+        PaymentAttempt.objects.filter(pk=attempt.pk).update(
+            next_attempt_at=timezone.now())
+
+    def test_submit_queues_the_charge_once(self):
+        response, attempt = self.pay()
+        again, _ = self.pay()
+
+        self.assertRedirects(
+            response, reverse('main:payment-status',
+                              args=[attempt.idempotency_key]),
+            fetch_redirect_response=False)
+        self.assertEqual(again.url, response.url)
+        self.assertEqual(PaymentAttempt.objects.count(), 1)
+        self.assertEqual(attempt.amount, 30.0)
+        self.assertEqual(FakeGateway.charges, {})
+        self.assertEqual(
+            self.client.get(response.url).templates[0].name,
+            'payment_status.html')
+
+    def test_worker_charges_and_closes_the_order(self):
+        response, attempt = self.pay()
+
+        processed = process_due_payments(gateway=FakeGateway())
+
+        self.assertEqual([a.pk for a in processed], [attempt.pk])
+        attempt.refresh_from_db()
+        self.order.refresh_from_db()
+        self.assertEqual(attempt.status, PaymentAttempt.SUCCEEDED)
+        self.assertTrue(self.order.ordered)
+        self.assertEqual(len(self.order.ref_code), 20)
+        self.assertEqual(self.order.payment.stripe_charge_id,
+                         attempt.charge_id)
+        self.assertEqual(self.order.payment.amount, 30.0)
+        self.assertFalse(self.order.items.filter(ordered=False).exists())
+        self.assertRedirects(self.client.get(response.url),
+                             reverse('main:home'))
+        # Paying again finds no open order rather than charging twice
+        self.assertRedirects(
+            self.client.post(self.url, {'stripeToken': 'tok_visa'}),
+            reverse('main:home'))
+        self.assertEqual(len(FakeGateway.charges), 1)
+
+    def test_transient_failures_are_retried_with_backoff(self):
+        _, attempt = self.pay()
+        gateway = FakeGateway(failures=2)
+
+        process_due_payments(gateway=gateway)
+        attempt.refresh_from_db()
+        self.assertEqual(attempt.status, PaymentAttempt.PENDING)
+        self.assertEqual(attempt.tries, 1)
+        self.assertGreater(attempt.next_attempt_at, timezone.now())
+        self.assertEqual(process_due_payments(gateway=gateway), [])
+
+        for _ in range(2):
+            self.make_due(attempt)
+            process_due_payments(gateway=gateway)
+
+        attempt.refresh_from_db()
+        self.assertEqual(attempt.status, PaymentAttempt.SUCCEEDED)
+        self.assertEqual(attempt.tries, 3)
+        self.assertEqual(list(FakeGateway.charges),
+                         [attempt.idempotency_key])
+
+    @override_settings(PAYMENT_MAX_TRIES=2)
+    def test_retries_give_up_after_max_tries(self):
+        _, attempt = self.pay()
+        gateway = FakeGateway(failures=5)
+
+        process_due_payments(gateway=gateway)
+        self.make_due(attempt)
+        process_due_payments(gateway=gateway)
+
+        attempt.refresh_from_db()
+        self.assertEqual(attempt.status, PaymentAttempt.FAILED)
+        self.assertEqual(attempt.error, 'The payment gateway timed out.')
+        self.assertFalse(Order.objects.get(pk=self.order.pk).ordered)
+
+    def test_declined_card_fails_and_can_be_paid_again(self):
+        response, attempt = self.pay('tok_chargeDeclined')
+
+        process_due_payments(gateway=FakeGateway())
+
+        attempt.refresh_from_db()
+        self.assertEqual(attempt.status, PaymentAttempt.FAILED)
+        self.assertEqual(attempt.tries, 1)
+        self.assertRedirects(self.client.get(response.url), self.url,
+                             fetch_redirect_response=False)
+        _, retry = self.pay()
+        self.assertNotEqual(retry.idempotency_key, attempt.idempotency_key)
+
+    def test_cart_is_frozen_while_paying(self):
+        create_item('console', 99.0)
+        Coupon.objects.create(code='SAVE5', amount=5.0)
+        self.pay()
+
+        self.client.get(reverse('main:add-to-cart', args=['console']))
+        self.client.get(reverse('main:remove-from-cart', args=['shirt']))
+        response = self.client.post(
+            reverse('main:cart-api'), json.dumps({'operations': [
+                {'slug': 'console', 'delta': 1}]}),
+            content_type='application/json')
+        self.assertEqual(response.status_code, 409)
+        self.client.post(reverse('main:add-coupon'), {'code': 'SAVE5'})
+        process_due_payments(gateway=FakeGateway())
+
+        order = Order.objects.get(pk=self.order.pk)
+        self.assertTrue(order.ordered)
+        self.assertEqual((order.total, order.payment.amount), (30.0, 30.0))
+        self.assertIsNone(order.coupon)
+        self.assertEqual(sorted(order.items.values_list(
+            'item__slug', 'quantity', 'ordered')),
+            [('hat', 2, True), ('shirt', 2, True)])
+
+    def test_login_keeps_the_session_cart_while_paying(self):
+        create_item('console', 99.0)
+        self.pay()
+        self.client.logout()
+        self.client.get(reverse('main:add-to-cart', args=['console']))
+
+        self.client.post(reverse('account_login'), {
+            'login': 'buyer', 'password': 'password'})
+
+        self.assertEqual(Order.objects.get(pk=self.order.pk).total, 30.0)
+        self.assertEqual(self.client.session['cart'], {'console': 1})
+
+    def test_failed_payment_unfreezes_the_cart(self):
+        create_item('console', 99.0)
+        self.pay('tok_chargeDeclined')
+        process_due_payments(gateway=FakeGateway())
+
+        self.client.get(reverse('main:add-to-cart', args=['console']))
+
+        self.assertEqual(Order.objects.get(pk=self.order.pk).total, 129.0)
+
+    def test_changed_total_fails_the_charged_attempt(self):
+        _, attempt = self.pay()
+        # Added behind the cart's back, as an admin edit would
+        self.order.items.add(OrderItem.objects.create(
+            user=self.user, item=create_item('console', 99.0)))
+
+        with self.assertLogs('main.payments', 'ERROR'):
+            process_due_payments(gateway=FakeGateway())
+
+        attempt.refresh_from_db()
+        self.assertEqual(attempt.status, PaymentAttempt.FAILED)
+        self.assertEqual(attempt.charge_id,
+                         FakeGateway.charges[attempt.idempotency_key]['id'])
+        self.assertFalse(Order.objects.get(pk=self.order.pk).ordered)
+        self.assertFalse(Payment.objects.exists())
+        self.assertFalse(self.order.items.filter(ordered=True).exists())
+        # The open cart follows the catalog again
+        self.assertFalse(self.order.items.filter(
+            line_total__isnull=False).exists())
+        self.assertEqual(Order.objects.get(pk=self.order.pk).total, 129.0)
+
+    def test_repricing_after_submit_keeps_the_charged_prices(self):
+        _, attempt = self.pay()
+        shirt = Item.objects.get(slug='shirt')
+        shirt.price = 25.0
+        shirt.save()
+
+        process_due_payments(gateway=FakeGateway())
+
+        attempt.refresh_from_db()
+        order = Order.objects.get(pk=self.order.pk)
+        self.assertEqual(attempt.status, PaymentAttempt.SUCCEEDED)
+        self.assertEqual((order.total, order.payment.amount), (30.0, 30.0))
+        self.assertEqual(
+            FakeGateway.charges[attempt.idempotency_key]['amount'], 30.0)
+        self.assertEqual(sorted(order.items.values_list(
+            'item__slug', 'unit_price', 'line_total', 'ordered')),
+            [('hat', 5.0, 10.0, True), ('shirt', 10.0, 20.0, True)])
+
+    def test_retry_after_a_worker_crash_does_not_charge_twice(self):
+        _, attempt = self.pay()
+        # A worker charged, then died before recording the outcome
+        charge_id = FakeGateway().charge(
+            attempt.amount, attempt.source, attempt.idempotency_key)
+
+        process_due_payments(gateway=FakeGateway())
+
+        attempt.refresh_from_db()
+        self.assertEqual(attempt.charge_id, charge_id)
+        self.assertEqual(len(FakeGateway.charges), 1)
+
+    def test_stripe_errors_map_to_retryable_payment_errors(self):
+        gateway = StripeGateway()
+        errors = [(stripe.error.APIConnectionError('down'), True),
+                  (stripe.error.CardError('declined', 'card', 'x'), False)]
+        for error, retry in errors:
+            with mock.patch('stripe.Charge.create', side_effect=error):
+                with self.assertRaises(PaymentError) as raised:
+                    gateway.charge(10.0, 'tok_visa', 'key')
+            self.assertEqual(raised.exception.retry, retry)
+
+    def test_process_payments_command(self):
+        self.pay()
+        out = StringIO()
+
+        # Closing the connection would end the test's transaction
+        with override_settings(
+                PAYMENT_GATEWAY='main.payments.FakeGateway'), mock.patch(
+                'main.management.commands.process_payments'
+                '.close_old_connections') as close_old_connections:
+            call_command('process_payments', once=True, stdout=out)
+
+        close_old_connections.assert_called_once_with()
+        self.assertIn('Processed 1 payments: 1 succeeded', out.getvalue())
+
+
+class OrderFinalizeTests(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('buyer')
+        self.payment = Payment.objects.create(
+            stripe_charge_id='ch_1', user=self.user, amount=55.0)
+
+    def finalize(self, order):
+        with CaptureQueriesContext(connection) as captured:
+            with transaction.atomic():
+                order.finalize(self.payment, f'ref-{order.pk}')
+        return len(captured)
+
+    def test_finalize_closes_the_order_at_snapshotted_prices(self):
+        shirt = create_item('shirt', 10.0)
+        jacket = create_item('jacket', 50.0, discount_price=40.0)
+        order = create_order(self.user, [shirt], quantity=2,
+                             coupon=Coupon.objects.create(code='C',
+                                                          amount=5.0))
+        order.items.add(OrderItem.objects.create(user=self.user, item=jacket))
+
+        order.snapshot_prices()
+        jacket.price, jacket.discount_price = 80.0, None
+        jacket.save()
+        self.finalize(order)
+
+        order = Order.objects.get(pk=order.pk)
+        self.assertTrue(order.ordered)
+        self.assertEqual(order.payment, self.payment)
+        self.assertEqual(order.ref_code, f'ref-{order.pk}')
+        self.assertEqual((order.subtotal, order.total, order.line_count),
+                         (60.0, 55.0, 2))
+        self.assertEqual(
+            sorted(order.items.values_list(
+                'ordered', 'unit_price', 'discount', 'line_total')),
+            [(True, 10.0, 0.0, 20.0), (True, 40.0, 10.0, 40.0)])
+
+    def test_queries_do_not_grow_with_the_cart(self):
+        items = [create_item(f'item-{n}') for n in range(50)]
+        small = create_order(self.user, items[:1])
+        small_queries = self.finalize(small)
+        other = get_user_model().objects.create_user('other')
+
+        self.assertEqual(self.finalize(create_order(other, items)),
+                         small_queries)
+
+
+class PriceSnapshotTests(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('buyer')
+        self.jacket = create_item('jacket', 50.0, discount_price=40.0)
+        self.order = create_order(self.user, [self.jacket], quantity=3)
+
+    def reprice(self, price, discount_price=None):
+        self.jacket.price = price
+        self.jacket.discount_price = discount_price
+        self.jacket.save()
+
+    def test_ordered_lines_keep_their_prices_after_repricing(self):
+        OrderItem.objects.all().snapshot_prices(ordered=True)
+        self.reprice(80.0)
+
+        line = OrderItem.objects.get()
+        self.assertEqual(
+            (line.list_price, line.unit_price, line.discount,
+             line.line_total),
+            (50.0, 40.0, 30.0, 120.0))
+        self.assertEqual(line.get_total_item_price(), 120.0)
+        self.assertEqual(self.order.items.totals(), (120.0, 1))
+        Order.objects.all().rebuild_totals()
+        self.assertEqual(Order.objects.get().total, 120.0)
+
+    def test_open_lines_follow_the_catalog(self):
+        self.reprice(80.0)
+
+        self.assertEqual(OrderItem.objects.get().get_total_item_price(),
+                         240.0)
+        self.assertEqual(self.order.items.totals(), (240.0, 1))
+
+    def test_revenue_reads_the_order_lines_only(self):
+        shirt = create_item('shirt', 10.0)
+        OrderItem.objects.create(user=self.user, item=shirt, quantity=2)
+        OrderItem.objects.all().snapshot_prices(ordered=True)
+        # Open carts are not revenue
+        OrderItem.objects.create(user=self.user, item=shirt, quantity=5)
+
+        with CaptureQueriesContext(connection) as captured:
+            revenue = OrderItem.objects.revenue()
+
+        self.assertEqual(revenue, {'units': 5, 'revenue': 140.0,
+                                   'discounts': 30.0})
+        self.assertEqual(len(captured), 1)
+        self.assertNotIn('JOIN', captured[0]['sql'])
+
+    def test_backfill_command_snapshots_old_ordered_lines_in_batches(self):
+        shirt = create_item('shirt', 10.0)
+        OrderItem.objects.filter(pk=self.order.items.get().pk).update(
+            ordered=True)
+        OrderItem.objects.bulk_create(
+            OrderItem(user=self.user, item=shirt, ordered=True)
+            for _ in range(4))
+        open_line = OrderItem.objects.create(user=self.user, item=shirt)
+        out = StringIO()
+
+        call_command('backfill_price_snapshots', batch_size=2, stdout=out)
+
+        self.assertIn('Snapshotted 5 order lines', out.getvalue())
+        self.assertFalse(OrderItem.objects.filter(
+            ordered=True, line_total__isnull=True).exists())
+        open_line.refresh_from_db()
+        self.assertIsNone(open_line.unit_price)
+        self.assertEqual(OrderItem.objects.backfill_snapshots(), 0)
+
+
+class SalesRollupTests(TestCase):
+
+    def setUp(self):
+        self.shirt = create_item('shirt', 10.0)
+        self.jacket = create_item('jacket', 50.0, discount_price=40.0,
+                                  category='OW')
+        self.today = timezone.localdate()
+        self.yesterday = self.today - datetime.timedelta(days=1)
+
+    def pay(self, username, items, quantity=1, date=None, **kwargs):
+        user = get_user_model().objects.create_user(username)
+        order = create_order(user, items, quantity=quantity, **kwargs)
+        payment = Payment.objects.create(
+            stripe_charge_id=f'ch_{username}', user=user, amount=0)
+        order.snapshot_prices()
+        order.finalize(payment, f'ref-{order.pk}')
+        if date:
+            Payment.objects.filter(pk=payment.pk).update(timestamp=date)
+        return order
+
+    def rollups(self):
+        return {title: values for title, *values in
+                DailySales.objects.values_list(
+                    'item__title', 'units', 'gross', 'discounts', 'coupons',
+                    'refunds')}
+
+    def test_rollup_adds_only_newly_paid_orders(self):
+        self.pay('first', [self.shirt, self.jacket], quantity=2,
+                 coupon=Coupon.objects.create(code='C', amount=5.0))
+        # Open carts are not sales
+        create_order(get_user_model().objects.create_user('browser'),
+                     [self.shirt])
+
+        self.assertEqual(rollup_daily_sales(), 1)
+        self.assertEqual(rollup_daily_sales(), 0)
+        self.pay('second', [self.shirt])
+        self.assertEqual(rollup_daily_sales(batch_size=1), 1)
+
+        self.assertEqual(self.rollups(), {
+            'Shirt': [3, 30.0, 0.0, 1.0, 0.0],
+            'Jacket': [2, 100.0, 20.0, 4.0, 0.0],
+        })
+
+    def test_rollup_picks_up_payments_committed_out_of_order(self):
+        late = create_order(get_user_model().objects.create_user('late'),
+                            [self.jacket])
+        # Its payment row exists, but the order closes after a later one
+        payment = Payment.objects.create(
+            stripe_charge_id='ch_late', user=late.user, amount=40.0)
+        self.pay('early', [self.shirt])
+        self.assertEqual(rollup_daily_sales(), 1)
+
+        late.snapshot_prices()
+        late.finalize(payment, f'ref-{late.pk}')
+
+        self.assertEqual(rollup_daily_sales(), 1)
+        self.assertEqual(self.rollups(), {
+            'Shirt': [1, 10.0, 0.0, 0.0, 0.0],
+            'Jacket': [1, 50.0, 10.0, 0.0, 0.0],
+        })
+
+    def test_refunds_follow_granted_refunds(self):
+        order = self.pay('first', [self.shirt, self.jacket],
+                         coupon=Coupon.objects.create(code='C', amount=5.0))
+        rollup_daily_sales()
+
+        order.refund_granted = True
+        order.save()
+        self.assertEqual(rollup_refunds(), 2)
+        self.assertEqual(rollup_refunds(), 0)
+        self.assertEqual(self.rollups()['Jacket'], [1, 50.0, 10.0, 4.0, 36.0])
+
+        order.refund_granted = False
+        order.save()
+        self.assertEqual(rollup_refunds(), 2)
+        self.assertFalse(DailySales.objects.exclude(refunds=0).exists())
+
+    def test_report_reads_only_the_rollups(self):
+        self.pay('first', [self.shirt, self.jacket], date=self.yesterday)
+        self.pay('second', [self.jacket], quantity=2)
+        call_command('rollup_sales', stdout=StringIO())
+
+        with CaptureQueriesContext(connection) as captured:
+            by_day = sales_report(self.yesterday, self.today)
+            by_category = sales_report(self.yesterday, self.today,
+                                       'category')
+
+        self.assertEqual(
+            [(row['label'], row['units'], row['net']) for row in by_day],
+            [(self.yesterday.isoformat(), 2, 50.0),
+             (self.today.isoformat(), 2, 80.0)])
+        self.assertEqual(
+            [(row['label'], row['units']) for row in by_category],
+            [('Outwear', 3), ('Shirt', 1)])
+        for query in captured:
+            self.assertNotIn('main_orderitem', query['sql'])
+
+    def test_rebuild_recounts_from_the_first_order(self):
+        self.pay('first', [self.shirt])
+        rollup_daily_sales()
+        out = StringIO()
+
+        call_command('rollup_sales', rebuild=True, stdout=out)
+
+        self.assertIn('Rolled up 1 orders', out.getvalue())
+        self.assertEqual(self.rollups(), {'Shirt': [1, 10.0, 0.0, 0.0, 0.0]})
+
+    def test_report_view_is_staff_only_and_exports_csv(self):
+        self.pay('first', [self.jacket])
+        rollup_daily_sales()
+        url = reverse('main:sales-report')
+        self.assertEqual(self.client.get(url).status_code, 302)
+        self.client.force_login(get_user_model().objects.create_user(
+            'staff', is_staff=True))
+
+        response = self.client.get(url, {'group': 'item'})
+        self.assertContains(response, 'Jacket')
+        response = self.client.get(reverse('main:sales-report-csv'), {
+            'start': self.today.isoformat(), 'group': 'category'})
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(
+            response.content.decode().splitlines(),
+            ['category,units,gross,discounts,coupons,refunds,net',
+             'Outwear,1,50.0,10.0,0.0,0.0,40.0'])
+
+
+class AdminChangelistTests(TestCase):
+
+    def setUp(self):
+        self.client.force_login(get_user_model().objects.create_superuser(
+            'admin', 'admin@example.com', 'password'))
+        self.url = reverse('admin:main_order_changelist')
+
+    def create_orders(self, count):
+        first = Order.objects.count()
+        for n in range(first, first + count):
+            user = get_user_model().objects.create_user(f'buyer-{n}')
+            address = Address.objects.create(
+                user=user, street_address='Street', apartment_address='1',
+                country='US', zip_address=f'{n:05}', address_type='B')
+            order = Order.objects.create(
+                user=user, ref_code=f'ref{n}', ordered=True,
+                ordered_date=timezone.now(), billing_address=address,
+                shipping_address=address,
+                payment=Payment.objects.create(
+                    stripe_charge_id=f'ch_{n}', user=user, amount=10.0))
+            PaymentAttempt.objects.create(
+                order=order, user=user, amount=10.0, charge_id=f'ch_{n}',
+                status=PaymentAttempt.SUCCEEDED)
+
+    def get(self, url, **params):
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return response, [query['sql'] for query in captured]
+
+    def count_queries(self):
+        return [len(self.get(reverse(f'admin:main_{name}_changelist'))[1])
+                for name in ('order', 'orderitem', 'payment', 'address',
+                             'paymentattempt')]
+
+    def test_queries_do_not_grow_with_the_page(self):
+        self.create_orders(1)
+        OrderItem.objects.create(user=get_user_model().objects.first(),
+                                 item=create_item('shirt'))
+        few = self.count_queries()
+        self.create_orders(10)
+        OrderItem.objects.create(user=get_user_model().objects.last(),
+                                 item=create_item('jacket'))
+
+        self.assertEqual(self.count_queries(), few)
+
+    def test_large_tables_are_estimated_not_counted(self):
+        self.create_orders(3)
+
+        with mock.patch.object(EstimatedCountPaginator, 'exact_count_limit',
+                               2):
+            response, queries = self.get(self.url)
+
+        self.assertGreaterEqual(response.context_data['cl'].result_count, 3)
+        self.assertFalse([sql for sql in queries if 'COUNT(' in sql])
+
+    def test_search_uses_prefix_and_exact_lookups(self):
+        self.create_orders(12)
+
+        for term, expected in (('ref1', ['ref1', 'ref10', 'ref11']),
+                               ('buyer-4', ['ref4']), ('ef1', []),
+                               ('buyer', [])):
+            response, queries = self.get(self.url, q=term)
+            self.assertEqual(sorted(
+                order.ref_code
+                for order in response.context_data['cl'].result_list),
+                expected)
+            self.assertFalse([sql for sql in queries
+                              if 'main_order' in sql and 'LIKE' in sql])
+        response, _ = self.get(reverse('admin:main_address_changelist'),
+                               q='0000')
+        self.assertEqual(response.context_data['cl'].result_count, 10)
+        response, queries = self.get(
+            reverse('admin:main_paymentattempt_changelist'), q='ch_4')
+        self.assertEqual(
+            [attempt.order.ref_code
+             for attempt in response.context_data['cl'].result_list],
+            ['ref4'])
+        self.assertFalse([sql for sql in queries if 'LIKE' in sql])
@@ -2,13 +2,16 @@ from django.urls import path
 from .views import (HomeView, ItemDetailView, OrderSummaryView,
                     CheckoutView, add_to_cart, remove_from_cart,
                     remove_single_from_cart, PaymentView,
-                    AddCouponView, RequestRefundView)
+                    AddCouponView, RequestRefundView, CartAPIView,
+                    PaymentStatusView, SearchView, cache_stats_view,
+                    metrics_view, sales_report_view)
 
 
 app_name = 'main'
 
 urlpatterns = [
     path('', HomeView.as_view(), name='home'),
+    path('search/', SearchView.as_view(), name='search'),
     path('product/<slug>/', ItemDetailView.as_view(), name='product'),
     path('order-summary/', OrderSummaryView.as_view(), name='order-summary'),
     path('checkout/', CheckoutView.as_view(), name='checkout'),
@@ -19,5 +22,13 @@ urlpatterns = [
     path('remove-single-from-cart/<slug>', remove_single_from_cart,
          name='remove-single-from-cart'),
     path('payment/<payment_option>', PaymentView.as_view(), name='payment'),
+    path('payment/status/<key>/', PaymentStatusView.as_view(),
+         name='payment-status'),
     path('refund-request/', RequestRefundView.as_view(), name='refund-request'),
+    path('api/cart/', CartAPIView.as_view(), name='cart-api'),
+    path('stats/cache/', cache_stats_view, name='cache-stats'),
+    path('stats/metrics/', metrics_view, name='metrics'),
+    path('stats/sales/', sales_report_view, name='sales-report'),
+    path('stats/sales/csv/', sales_report_view, {'export': True},
+         name='sales-report-csv'),
 ]
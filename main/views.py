@@ -1,39 +1,231 @@
-import string
-import random
-import stripe
+import csv
+import datetime
+import json
 from django.conf import settings
 from django.contrib import messages
+from django.contrib.admin.views.decorators import staff_member_required
 from django.core.exceptions import ObjectDoesNotExist
-from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import HttpResponseRedirect
-from django.views.generic import DetailView, ListView, View
+from django.http import (Http404, HttpResponse, HttpResponseRedirect,
+                         JsonResponse)
+from django.template.loader import render_to_string
 from django.utils import timezone
-from .models import (Item, OrderItem, Order, Address,
-                     Payment, Coupon, Refund)
+from django.utils.crypto import constant_time_compare
+from django.utils.dateparse import parse_date
+from django.utils.decorators import method_decorator
+from django.utils.http import urlencode
+from django.views.decorators.csrf import ensure_csrf_cookie
+from django.views.generic import DetailView, ListView, View
+from .models import (Item, OrderItem, Order, Address, Coupon, Refund,
+                     PaymentAttempt, PaymentInProgress, CATEGORY_CHOICES,
+                     LABEL_CHOICES)
 from .forms import CheckoutForm, CouponForm, RefundForm
-
-
-stripe.api_key = settings.STRIPE_SECRET_KEY
+from . import cart
+from .caching import cache_stats, get_or_compute
+from .catalog import (CATALOG_CACHE_TIMEOUT, PRICE_RANGES, catalog_cache_key,
+                      filter_items, get_catalog_facets)
+from .metrics import registry
+from .pagination import (CursorPaginator, InvalidCursor, decode_cursor,
+                         encode_cursor)
+from .payments import request_payment
+from .reports import REPORT_COLUMNS, REPORT_GROUPS, sales_report
+from .search import search_items
 
 
 class HomeView(ListView):
     model = Item
+    ordering = ['pk']
     paginate_by = 10
     template_name = 'home.html'
+    grid_template_name = 'product_grid.html'
 
+    def get(self, *args, **kwargs):
+        self.category, self.price_range = self.get_filters()
+        # The grid does not depend on the visitor, so it is rendered once
+        # per filter, page and catalog version and shared by everyone
+        product_grid = get_or_compute(
+            'catalog', catalog_cache_key('home-grid', *self.get_page_key()),
+            self.render_grid, CATALOG_CACHE_TIMEOUT)
+        context = {'product_grid': product_grid}
+        context.update(self.get_facet_context())
+        return render(self.request, self.template_name, context)
+
+    def render_grid(self):
+        self.object_list = self.get_queryset()
+        return render_to_string(
+            self.grid_template_name, self.get_context_data())
+
+    def get_filters(self):
+        '''Selected category and price range; unknown values are ignored'''
+        category = self.request.GET.get('category')
+        price_range = self.request.GET.get('price')
+        return (
+            category if category in dict(CATEGORY_CHOICES) else None,
+            price_range if price_range in {
+                value for value, *_ in PRICE_RANGES} else None,
+        )
+
+    def get_filter_query(self, **changes):
+        params = {'category': self.category, 'price': self.price_range}
+        params.update(changes)
+        return urlencode({name: value for name, value in params.items()
+                          if value})
+
+    def get_facet_context(self):
+        facets = get_catalog_facets(self.category, self.price_range)
+        return {
+            'all_count': facets['all'],
+            'all_query': self.get_filter_query(category=None),
+            'category': self.category,
+            'category_facets': [
+                {'name': name, 'count': count,
+                 'active': value == self.category,
+                 'query_string': self.get_filter_query(category=value)}
+                for value, name, count in facets['categories']],
+            'price_facets': [
+                {'name': name, 'count': count,
+                 'active': value == self.price_range,
+                 'query_string': self.get_filter_query(
+                     price=None if value == self.price_range else value)}
+                for value, name, count in facets['price_ranges']],
+        }
 
+    def get_queryset(self):
+        return filter_items(
+            super().get_queryset(), self.category, self.price_range)
+
+    def uses_cursor_pagination(self):
+        return (settings.HOME_PAGINATION == 'cursor'
+                or 'after' in self.request.GET
+                or 'before' in self.request.GET)
+
+    def get_page_key(self):
+        '''Cache key parts of the requested page.
+
+        Built from the validated page number or cursors, so spellings of
+        the same page share one entry and bad ones are a 404 before
+        anything is cached.
+        '''
+        filters = ('category', self.category or '',
+                   'price', self.price_range or '')
+        if self.uses_cursor_pagination():
+            self.after, self.before = self.get_cursors()
+            return filters + ('after', self.after or '',
+                              'before', self.before or '')
+        self.page_number = self.get_page_number()
+        return filters + ('page', self.page_number)
+
+    def get_page_number(self):
+        page = (self.kwargs.get(self.page_kwarg)
+                or self.request.GET.get(self.page_kwarg) or 1)
+        if page == 'last':
+            return page
+        try:
+            page = int(page)
+        except ValueError:
+            page = 0
+        if page < 1:
+            raise Http404('Invalid page.')
+        return page
+
+    def get_cursors(self):
+        '''The after and before cursors, re-encoded from their keys'''
+        # A before cursor wins, as in CursorPaginator.page
+        before = self.request.GET.get('before')
+        after = None if before else self.request.GET.get('after')
+        try:
+            return tuple(encode_cursor(int(decode_cursor(cursor)))
+                         if cursor else None for cursor in (after, before))
+        except (InvalidCursor, ValueError):
+            raise Http404('Invalid cursor.')
+
+    def paginate_queryset(self, queryset, page_size):
+        if not self.uses_cursor_pagination():
+            self.kwargs[self.page_kwarg] = self.page_number
+            return super().paginate_queryset(queryset, page_size)
+        paginator = CursorPaginator(queryset, page_size)
+        page = paginator.page(after=self.after, before=self.before)
+        return (paginator, page, page.object_list, page.has_other_pages())
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['cursor_pagination'] = self.uses_cursor_pagination()
+        filter_query = self.get_filter_query()
+        context['filter_query'] = f'{filter_query}&' if filter_query else ''
+        return context
+
+
+class SearchView(ListView):
+    paginate_by = 10
+    template_name = 'search.html'
+
+    def get_queryset(self):
+        self.query = self.request.GET.get('q', '').strip()
+        matches, self.category_counts, self.label_counts = search_items(
+            self.query,
+            category=self.request.GET.get('category'),
+            label=self.request.GET.get('label'))
+        return matches
+
+    def get_facets(self, param, choices, counts):
+        selected = self.request.GET.get(param)
+        facets = []
+        for value, name in choices:
+            if not counts.get(value):
+                continue
+            params = self.request.GET.copy()
+            params.pop('page', None)
+            if value == selected:
+                params.pop(param)
+            else:
+                params[param] = value
+            facets.append({
+                'name': name,
+                'count': counts[value],
+                'active': value == selected,
+                'query_string': params.urlencode(),
+            })
+        return facets
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        params = self.request.GET.copy()
+        params.pop('page', None)
+        context.update({
+            'query': self.query,
+            'query_string': params.urlencode(),
+            'facet_groups': [
+                ('Category', self.get_facets(
+                    'category', CATEGORY_CHOICES, self.category_counts)),
+                ('Label', self.get_facets(
+                    'label', LABEL_CHOICES, self.label_counts)),
+            ],
+        })
+        return context
+
+
+# Its cart button posts to the cart API with the CSRF cookie
+@method_decorator(ensure_csrf_cookie, name='dispatch')
 class ItemDetailView(DetailView):
     model = Item
     template_name = 'product.html'
 
 
-class OrderSummaryView(LoginRequiredMixin, View):
+class OrderSummaryView(View):
 
     def get(self, *args, **kwargs):
+        if not self.request.user.is_authenticated:
+            session_cart = cart.SessionCart(self.request.session)
+            if not session_cart:
+                messages.warning(self.request, 'You have no active order.')
+                return redirect('main:home')
+            context = {
+                'object': session_cart.order()
+            }
+            return render(self.request, 'order_summary.html', context)
         try:
-            order = Order.objects.get(
+            order = Order.objects.with_items().get(
                 user=self.request.user, ordered=False)
             context = {
                 'object': order
@@ -49,7 +241,7 @@ class CheckoutView(LoginRequiredMixin, View):
     def get(self, *args, **kwargs):
         form, couponform = CheckoutForm(), CouponForm()
         try:
-            order = Order.objects.get(
+            order = Order.objects.with_items().get(
                 user=self.request.user, ordered=False)
         except ObjectDoesNotExist:
             messages.warning(self.request, 'You have no active order.')
@@ -60,23 +252,23 @@ class CheckoutView(LoginRequiredMixin, View):
             'order': order,
             'DISPLAY_COUPON_FORM': True,
         }
-        shipping_address_qs = Address.objects.filter(
+        shipping_address = Address.objects.filter(
             user=self.request.user,
             address_type='S',
             default=True,
-        )
-        if shipping_address_qs.exists():
+        ).first()
+        if shipping_address:
             context.update(
-                {'shipping_address': shipping_address_qs[0]})
+                {'shipping_address': shipping_address})
 
-        billing_address_qs = Address.objects.filter(
+        billing_address = Address.objects.filter(
             user=self.request.user,
             address_type='B',
             default=True,
-        )
-        if billing_address_qs.exists():
+        ).first()
+        if billing_address:
             context.update(
-                {'billing_address': billing_address_qs[0]})
+                {'billing_address': billing_address})
 
         return render(self.request, 'checkout.html', context)
 
@@ -97,7 +289,9 @@ class CheckoutView(LoginRequiredMixin, View):
             shipping_address.save()
 
             order.shipping_address = shipping_address
-            order.save()
+            # Only this field: the totals may have moved since the order
+            # was read
+            order.save(update_fields=['shipping_address'])
 
             same_shipping_address = form.cleaned_data.get(
                 'same_shipping_address')
@@ -114,7 +308,7 @@ class CheckoutView(LoginRequiredMixin, View):
             billing_address.save()
 
             order.billing_address = billing_address
-            order.save()
+            order.save(update_fields=['billing_address'])
 
             payment_option = form.cleaned_data.get('payment_option')
 
@@ -134,14 +328,12 @@ class CheckoutView(LoginRequiredMixin, View):
         use_default_shipping = form.cleaned_data.get(
             'use_default_shipping')
         if use_default_shipping:
-            default_shipping_qs = Address.objects.filter(
+            shipping_address = Address.objects.filter(
                 user=self.request.user,
                 address_type='S',
                 default=True,
-            )
-            if default_shipping_qs.exists():
-                shipping_address = default_shipping_qs[0]
-            else:
+            ).first()
+            if shipping_address is None:
                 messages.warning(
                     self.request, 'You have no default shipping address.')
                 return redirect('main:checkout')
@@ -182,14 +374,12 @@ class CheckoutView(LoginRequiredMixin, View):
     def get_billing_address(self, form):
         use_default_billing = form.cleaned_data.get('use_default_billing')
         if use_default_billing:
-            default_billing_qs = Address.objects.filter(
+            billing_address = Address.objects.filter(
                 user=self.request.user,
                 address_type='B',
                 default=True,
-            )
-            if default_billing_qs.exists():
-                billing_address = default_billing_qs[0]
-            else:
+            ).first()
+            if billing_address is None:
                 messages.warning(
                     self.request, 'You have no default billing address.')
                 return redirect('main:checkout')
@@ -228,21 +418,18 @@ class CheckoutView(LoginRequiredMixin, View):
         return billing_address
 
     def update_users_default_addresses(self, address_type):
-        user_default_addresses = Address.objects.filter(
+        Address.objects.filter(
             user=self.request.user,
             address_type=address_type,
             default=True,
-        )
-        user_default_addresses.update(default=False)
-        for address in user_default_addresses:
-            address.save()
+        ).update(default=False)
 
 
 class PaymentView(LoginRequiredMixin, View):
 
     def get(self, *args, **kwargs):
         try:
-            order = Order.objects.get(
+            order = Order.objects.with_items().get(
                 user=self.request.user, ordered=False)
         except ObjectDoesNotExist:
             messages.warning(self.request, 'You have no active order.')
@@ -260,138 +447,178 @@ class PaymentView(LoginRequiredMixin, View):
 
     def post(self, *args, **kwargs):
         try:
-            order = Order.objects.get(user=self.request.user, ordered=False)
-            # token = self.request.POST.get('stripeToken')
-            # amount = int(order.get_total() * 100)
-
-            # Use Stripe's library to make requests
-            # charge = stripe.Charge.create(
-            #     amount=amount,  # cents
-            #     currency="usd",
-            #     source=token,
-            # )
-
-            # Create the payment
-            payment = Payment()
-            # payment.stripe_charge_id = charge['id']
-
-            # TEMP: Create random payment number
-            payment.stripe_charge_id = random.randint(0, 1000)
-
-            payment.user = self.request.user
-            payment.amount = order.get_total()
-            payment.save()
-
-            # Update order_items status to "ordered"
-            order_items = order.items.all()
-            order_items.update(ordered=True)
-            for item in order_items:
-                item.save()
-
-            # Assign the payment to the order
-            order.ordered = True
-            order.payment = payment
-            # TEMP: Create random reference code
-            order.ref_code = self.create_ref_code()
-            order.save()
-
-            messages.success(self.request, 'Your order was successfully paid!')
-            return redirect('main:home')
+            # The charge itself is made by a payment worker
+            attempt = request_payment(
+                self.request.user, self.request.POST.get('stripeToken', ''))
         except ObjectDoesNotExist:
             messages.warning(self.request, 'You have no active order.')
             return redirect('main:home')
-        except (
-            stripe.error.CardError,
-            stripe.error.RateLimitError,
-            stripe.error.InvalidRequestError,
-            stripe.error.AuthenticationError,
-            stripe.error.APIConnectionError,
-            stripe.error.StripeError,
-        ) as e:
-            messages.warning(self.request, f'{e.error.message}')
-            return redirect('main:payment', payment_option='stripe')
-        except Exception:
-            messages.warning(
-                self.request, 'Serious error occured. Please try again.')
+        return redirect('main:payment-status', key=attempt.idempotency_key)
+
+
+class PaymentStatusView(LoginRequiredMixin, View):
+    '''Waits for the payment worker, then reports the outcome'''
+    refresh_seconds = 2
+
+    def get(self, *args, **kwargs):
+        attempt = get_object_or_404(
+            PaymentAttempt, idempotency_key=kwargs['key'],
+            user=self.request.user)
+        if attempt.status == PaymentAttempt.SUCCEEDED:
+            messages.success(self.request, 'Your order was successfully paid!')
             return redirect('main:home')
+        if attempt.status == PaymentAttempt.FAILED:
+            messages.warning(self.request, attempt.error)
+            return redirect('main:payment', payment_option='stripe')
+        return render(self.request, 'payment_status.html', {
+            'attempt': attempt,
+            'refresh_seconds': self.refresh_seconds,
+        })
 
-    @staticmethod
-    def create_ref_code():
-        return ''.join(random.choices(
-            string.ascii_lowercase + string.digits, k=20))
+
+PAYMENT_IN_PROGRESS = 'Your order is being paid for and cannot change.'
 
 
-@login_required
 def add_to_cart(request, slug):
     item = get_object_or_404(Item, slug=slug)
-    order_item, created = OrderItem.objects.get_or_create(
-        user=request.user, item=item, ordered=False)
-    # Check if order exists
-    order_qs = Order.objects.filter(user=request.user, ordered=False)
-    if order_qs.exists():
-        order = order_qs[0]
-        # If Item already in the order add another instance of Item
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item.quantity += 1
-            order_item.save()
-            # messages.info(request, "This item's quantity was updated.")
+    try:
+        if request.user.is_authenticated:
+            created = cart.add_item(request.user, item).created
         else:
-            order.items.add(order_item)
-            messages.info(request, 'This item was added to your cart.')
-    else:
-        order = Order.objects.create(user=request.user,
-                                     ordered_date=timezone.now())
-        order.items.add(order_item)
+            created = cart.SessionCart(request.session).add(item)
+    except PaymentInProgress:
+        messages.warning(request, PAYMENT_IN_PROGRESS)
+        return redirect('main:order-summary')
+    if created:
         messages.info(request, 'This item was added to your cart.')
     return redirect('main:order-summary')
 
 
-@login_required
 def remove_single_from_cart(request, slug):
     item = get_object_or_404(Item, slug=slug)
-    order_qs = Order.objects.filter(user=request.user, ordered=False)
-    if order_qs.exists():
-        order = order_qs[0]
-        # if the item in the order than remove it
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item = OrderItem.objects.filter(
-                user=request.user, item=item, ordered=False)[0]
-            if order_item.quantity > 1:
-                order_item.quantity -= 1
-                order_item.save()
-            return redirect('main:order-summary')
-        # if the item is NOT in the order - dislpay message
+    try:
+        if request.user.is_authenticated:
+            cart.remove_item(request.user, item, quantity=1, keep_line=True)
         else:
-            messages.warning(request, 'This item is not in your cart.')
-            return redirect('main:product', slug=slug)
-    else:
+            cart.SessionCart(request.session).remove(
+                item, quantity=1, keep_line=True)
+    except Order.DoesNotExist:
         # This user has no orders exists
         messages.warning(request, 'You have no active orders.')
         return redirect('main:product', slug=slug)
+    except OrderItem.DoesNotExist:
+        # if the item is NOT in the order - dislpay message
+        messages.warning(request, 'This item is not in your cart.')
+        return redirect('main:product', slug=slug)
+    except PaymentInProgress:
+        messages.warning(request, PAYMENT_IN_PROGRESS)
+        return redirect('main:order-summary')
+    return redirect('main:order-summary')
 
 
-@login_required
 def remove_from_cart(request, slug):
     item = get_object_or_404(Item, slug=slug)
-    order_qs = Order.objects.filter(user=request.user, ordered=False)
-    if order_qs.exists():
-        order = order_qs[0]
-        # if the item in the order than remove it
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item = OrderItem.objects.filter(
-                user=request.user, item=item, ordered=False)[0]
-            order_item.delete()
-            # order.items.remove(order_item)
-            messages.info(request, 'This item was removed from your cart.')
-            return redirect('main:order-summary')
-        # if the item is NOT in the order - dislpay message
+    try:
+        if request.user.is_authenticated:
+            cart.remove_item(request.user, item)
         else:
-            messages.warning(request, 'This item is not in your cart.')
-            return redirect('main:product', slug=slug)
-    else:
+            cart.SessionCart(request.session).remove(item)
+    except Order.DoesNotExist:
         # This user has no orders exists
         messages.warning(request, 'You have no active orders.')
         return redirect('main:product', slug=slug)
+    except OrderItem.DoesNotExist:
+        # if the item is NOT in the order - dislpay message
+        messages.warning(request, 'This item is not in your cart.')
+        return redirect('main:product', slug=slug)
+    except PaymentInProgress:
+        messages.warning(request, PAYMENT_IN_PROGRESS)
+        return redirect('main:order-summary')
+    messages.info(request, 'This item was removed from your cart.')
+    return redirect('main:order-summary')
+
+
+class CartAPIView(View):
+    '''Read the cart or apply a batch of ``{slug, delta}`` operations.
+
+    POST bodies look like ``{"operations": [{"slug": "shirt", "delta": 2}]}``;
+    operations on the same slug are coalesced and the whole batch is
+    applied in one transaction. Both methods answer with the cart lines
+    and totals.
+    '''
+    max_operations = 100
+
+    def get(self, *args, **kwargs):
+        if self.request.user.is_authenticated:
+            order = Order.objects.filter(
+                user=self.request.user, ordered=False).first()
+        else:
+            order = self.get_session_order()
+        return JsonResponse(self.get_cart_state(order))
+
+    def post(self, *args, **kwargs):
+        try:
+            deltas = self.get_deltas()
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        items = Item.objects.in_bulk(list(deltas), field_name='slug')
+        unknown = sorted(set(deltas) - set(items))
+        if unknown:
+            return JsonResponse(
+                {'error': f'Unknown items: {", ".join(unknown)}.'},
+                status=400)
+        deltas = {items[slug]: delta for slug, delta in deltas.items()}
+        if self.request.user.is_authenticated:
+            try:
+                update = cart.update_cart(self.request.user, deltas)
+            except PaymentInProgress:
+                return JsonResponse({'error': PAYMENT_IN_PROGRESS},
+                                    status=409)
+            order = update and update.order
+        else:
+            cart.SessionCart(self.request.session).update(deltas)
+            order = self.get_session_order()
+        return JsonResponse(self.get_cart_state(order))
+
+    def get_session_order(self):
+        session_cart = cart.SessionCart(self.request.session)
+        return session_cart.order() if session_cart else None
+
+    def get_deltas(self):
+        try:
+            operations = json.loads(self.request.body)['operations']
+        except (ValueError, TypeError, KeyError):
+            raise ValueError(
+                'Expected a JSON object with an "operations" list.')
+        if not isinstance(operations, list):
+            raise ValueError('"operations" must be a list.')
+        if len(operations) > self.max_operations:
+            raise ValueError(
+                f'At most {self.max_operations} operations per request.')
+        deltas = {}
+        for operation in operations:
+            if not isinstance(operation, dict):
+                raise ValueError('Each operation must be an object.')
+            slug, delta = operation.get('slug'), operation.get('delta')
+            if (not isinstance(slug, str) or isinstance(delta, bool)
+                    or not isinstance(delta, int)):
+                raise ValueError(
+                    'Each operation needs a "slug" and an integer "delta".')
+            deltas[slug] = deltas.get(slug, 0) + delta
+        return deltas
+
+    @staticmethod
+    def get_cart_state(order):
+        if order is None:
+            return {'lines': [], 'count': 0,
+                    'subtotal': 0, 'discount': 0, 'total': 0}
+        return {
+            'lines': cart.cart_lines(order),
+            'count': order.line_count,
+            'subtotal': order.subtotal,
+            'discount': order.discount,
+            'total': order.total,
+        }
 
 
 class AddCouponView(LoginRequiredMixin, View):
@@ -403,8 +630,10 @@ class AddCouponView(LoginRequiredMixin, View):
                 code = form.cleaned_data.get('code')
                 order = Order.objects.get(
                     user=self.request.user, ordered=False)
-                order.coupon = self.get_coupon(code)
-                order.save()
+                coupon = self.get_coupon(code)
+                if isinstance(coupon, HttpResponseRedirect):
+                    return coupon
+                order.apply_coupon(coupon)
                 messages.success(
                     self.request, 'Successfully added coupon.')
                 return redirect('main:checkout')
@@ -412,6 +641,9 @@ class AddCouponView(LoginRequiredMixin, View):
                 messages.warning(
                     self.request, 'You have no active order.')
                 return redirect('main:home')
+            except PaymentInProgress:
+                messages.warning(self.request, PAYMENT_IN_PROGRESS)
+                return redirect('main:order-summary')
 
     def get_coupon(self, code):
         try:
@@ -442,7 +674,7 @@ class RequestRefundView(LoginRequiredMixin, View):
                 order = Order.objects.get(
                     ref_code=ref_code)
                 order.refund_requested = True
-                order.save()
+                order.save(update_fields=['refund_requested'])
             except ObjectDoesNotExist:
                 messages.warning(self.request, 'This order does not exist.')
                 return redirect('main:refund-request')
@@ -455,3 +687,58 @@ class RequestRefundView(LoginRequiredMixin, View):
             messages.success(
                 self.request, 'You refund request was received.')
             return redirect('main:refund-request')
+
+
+@staff_member_required
+def cache_stats_view(request):
+    '''Hit and miss counters of this process's caches, for monitoring'''
+    return JsonResponse({'caches': cache_stats()})
+
+
+def report_date(value, default):
+    try:
+        return parse_date(value or '') or default
+    except ValueError:
+        return default
+
+
+@staff_member_required
+def sales_report_view(request, export=False):
+    '''Sales over a period, read from the daily rollups'''
+    end = report_date(request.GET.get('end'), timezone.localdate())
+    start = report_date(request.GET.get('start'),
+                        end - datetime.timedelta(days=29))
+    group = request.GET.get('group')
+    if group not in REPORT_GROUPS:
+        group = 'day'
+    rows = sales_report(start, end, group)
+    if export:
+        response = HttpResponse(content_type='text/csv')
+        response['Content-Disposition'] = (
+            f'attachment; filename="sales-{start}-{end}.csv"')
+        writer = csv.writer(response)
+        writer.writerow([group] + REPORT_COLUMNS)
+        for row in rows:
+            writer.writerow([row['label']] + [
+                round(row[column], 2) for column in REPORT_COLUMNS])
+        return response
+    return render(request, 'sales_report.html', {
+        'rows': rows,
+        'start': start,
+        'end': end,
+        'group': group,
+        'groups': list(REPORT_GROUPS),
+        'query': urlencode({'start': start, 'end': end, 'group': group}),
+    })
+
+
+def metrics_view(request):
+    '''Per-view request metrics of this process in Prometheus text format'''
+    token = settings.METRICS_TOKEN
+    authorized = request.user.is_staff or (
+        token and constant_time_compare(
+            request.META.get('HTTP_AUTHORIZATION', ''), f'Bearer {token}'))
+    if not authorized:
+        return HttpResponse(status=403)
+    return HttpResponse(registry.render(cache_stats()),
+                        content_type='text/plain; version=0.0.4')